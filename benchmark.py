@@ -0,0 +1,685 @@
+"""
+Replays gateway events through ZoteBot with the cogs of a profile loaded (--profile, full by default), offline.
+Discord's http api is faked and the database is kept in memory, or in an in-memory sqlite database with
+--db sqlite, so the numbers are the bot's own overhead plus any latency given with --db-latency-ms and
+--rest-latency-ms.
+
+Reports events/s, handler latency per event type, and database queries and rest calls per event.
+The bot reads its settings from the environment as usual, so runs can be compared with eg.
+ZOTE_WRITE_BEHIND=1 or ZOTE_USER_CACHE_SIZE=0.
+
+    python benchmark.py --events 20000 --rate 2000
+    python benchmark.py --save events.jsonl   # also write the synthetic stream
+    python benchmark.py --replay events.jsonl
+
+Streams are json lines of gateway dispatches, {"t": "MESSAGE_CREATE", "d": {...}}. GUILD_CREATE lines
+add guilds to the cache and ZOTE_GUILD_ROW lines add guild rows to the database before the replay starts,
+streams without them use the synthetic guilds built from --guilds, --members and --seed.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import typing
+
+from bot import ZoteBot, create_bot
+from collections import Counter, deque
+from time import perf_counter
+from utils.database import BaseDBConnection, COLUMNS, DBException
+from utils.profiles import PROFILES, get_profile
+from utils.sqlite import SQLiteConnection
+
+import discord
+
+BOT_ID = 100000000000000001
+EVENT_TYPES = {  # Gateway dispatch -> short name used in the mix and the report
+    'MESSAGE_CREATE': 'message',
+    'MESSAGE_UPDATE': 'message_edit',
+    'MESSAGE_DELETE': 'message_delete',
+    'VOICE_STATE_UPDATE': 'voice',
+    'MESSAGE_REACTION_ADD': 'reaction',
+    'GUILD_MEMBER_UPDATE': 'member_update'
+}
+MENU_EMOJIS = ('🍎', '🍌', '🍇')
+
+_current: contextvars.ContextVar[typing.Optional['EventRecord']] = contextvars.ContextVar('event', default=None)
+
+
+class EventRecord:
+    """
+    One replayed event, done once every listener task and lane handler it started has finished.
+    """
+    __slots__ = ('kind', 'start', 'pending', 'queries', 'rest', 'report')
+
+    def __init__(self, kind: str, report: 'Report'):
+        self.kind = kind
+        self.start = perf_counter()
+        self.pending = 1  # Held by the replay until the event has been parsed
+        self.queries = 0  # Made while handling this event, batched queries count for the event that started them
+        self.rest = 0
+        self.report = report
+
+    def finish(self, _=None):
+        self.pending -= 1
+        if self.pending == 0:
+            self.report.add(self)
+
+
+class Report:
+    def __init__(self):
+        self.latency: typing.Dict[str, typing.List[float]] = {}  # event type -> ms
+        self.queries = Counter()  # event type -> queries made while handling it
+        self.rest = Counter()  # event type -> rest calls made while handling it
+        self.outstanding = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def started(self):
+        self.outstanding += 1
+        self.idle.clear()
+
+    def add(self, record: EventRecord):
+        self.latency.setdefault(record.kind, []).append((perf_counter() - record.start) * 1000)
+        self.queries[record.kind] += record.queries
+        self.rest[record.kind] += record.rest
+
+        self.outstanding -= 1
+        if self.outstanding == 0:
+            self.idle.set()
+
+
+def percentile(values: typing.List[float], q: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+# Database
+
+
+def guild_row(guild_id: int, **data) -> dict:
+    return {'id': guild_id, 'prefix': None, 'logs': 0, 'timezone': None, 'afk_channel': 0, 'rolemenu': {}, **data}
+
+
+class MemoryConnection(BaseDBConnection):
+    """
+    Storage backend keeping its tables in dicts, with an optional latency added to every call.
+    """
+    def __init__(self, latency_ms: float = 0):
+        super().__init__(COLUMNS)
+        self.latency = latency_ms / 1000
+        self.connected = False
+        self.tables: typing.Dict[str, typing.Dict[int, dict]] = {'guilds': {}, 'users': {}}
+        self.voice_times: typing.Dict[typing.Tuple[int, int], dict] = {}
+
+    async def _wait(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def connect(self):
+        self.connected = True
+
+    async def close(self):
+        self.connected = False
+
+    @property
+    def is_connected(self) -> bool:
+        return self.connected
+
+    @staticmethod
+    def _user_row(user_id: int) -> dict:
+        return {'id': user_id, 'access_level': 0, 'voice': {}}
+
+    async def get_guilds(self, guild_ids):
+        await self._wait()
+        return [dict(self.tables['guilds'][i]) for i in guild_ids if i in self.tables['guilds']]
+
+    async def load_guilds(self, shard_ids=None, shard_count=None):
+        await self._wait()
+        return [dict(g) for i, g in self.tables['guilds'].items()
+                if shard_ids is None or not shard_count or (i >> 22) % shard_count in shard_ids]
+
+    async def new_guild(self, guild_id):
+        await self._wait()
+        if guild_id in self.tables['guilds']:
+            raise DBException(f'Guild {guild_id} exists')
+
+        return dict(self.tables['guilds'].setdefault(guild_id, guild_row(guild_id)))
+
+    async def get_users(self, user_ids):
+        await self._wait()
+        return [dict(self.tables['users'][i]) for i in user_ids if i in self.tables['users']]
+
+    async def get_or_create_users(self, user_ids):
+        await self._wait()
+        return [dict(self.tables['users'].setdefault(i, self._user_row(i))) for i in user_ids]
+
+    async def new_user(self, user_id):
+        await self._wait()
+        if user_id in self.tables['users']:
+            raise DBException(f'User {user_id} exists')
+
+        self.tables['users'][user_id] = self._user_row(user_id)
+
+    async def update(self, table, row_id, data, returning=False):
+        self.check_update(table, data)
+        await self._wait()
+        if (row := self.tables[table].get(row_id)) is None:
+            return None
+
+        row.update(data)
+        return dict(row) if returning else None
+
+    async def update_many(self, updates):
+        updates = list(updates)
+        for table, _, data in updates:
+            self.check_update(table, data)
+
+        await self._wait()
+        for table, row_id, data in updates:
+            if (row := self.tables[table].get(row_id)) is not None:
+                row.update(data)
+
+    async def get_voice_time(self, guild_id, user_id):
+        await self._wait()
+        row = self.voice_times.get((guild_id, user_id))
+        return dict(row) if row else None
+
+    async def add_voice_times(self, entries):
+        await self._wait()
+        for guild_id, user_id, ms in entries:
+            row = self.voice_times.setdefault(
+                (guild_id, user_id), {'voice_time_spent_ms': 0.0, 'voice_last_joined_ms': 0.0})
+            row['voice_time_spent_ms'] += ms
+
+    async def get_top_voice_times(self, guild_id, limit):
+        await self._wait()
+        rows = [{'user_id': u, 'voice_time_spent_ms': v['voice_time_spent_ms']}
+                for (g, u), v in self.voice_times.items() if g == guild_id and v['voice_time_spent_ms'] > 0]
+        return sorted(rows, key=lambda r: -r['voice_time_spent_ms'])[:limit]
+
+    async def migrate_voice_times(self):
+        await self._wait()
+        inserted = 0
+        for user_id, user in self.tables['users'].items():
+            for guild_id, voice in (user.get('voice') or {}).items():
+                if isinstance(voice, dict) and (key := (int(guild_id), user_id)) not in self.voice_times:
+                    self.voice_times[key] = {
+                        'voice_time_spent_ms': voice.get('voice_time_spent_ms', 0),
+                        'voice_last_joined_ms': voice.get('voice_last_joined_ms', 0)
+                    }
+                    inserted += 1
+
+        return inserted
+
+
+BACKEND_METHODS = ('get_guilds', 'load_guilds', 'new_guild', 'get_users', 'get_or_create_users', 'new_user',
+                   'update', 'update_many', 'get_voice_time', 'add_voice_times', 'get_top_voice_times',
+                   'migrate_voice_times')
+
+
+def count_queries(backend: BaseDBConnection) -> Counter:
+    """Count calls to the backend, each is one query or transaction, against the event being handled"""
+    counts = Counter()
+
+    for name in BACKEND_METHODS:
+        def counted(*args, _name=name, _method=getattr(backend, name), **kwargs):
+            counts[_name] += 1
+            if (record := _current.get()) is not None:
+                record.queries += 1
+
+            return _method(*args, **kwargs)
+
+        setattr(backend, name, counted)
+
+    return counts
+
+
+# Discord
+
+
+class FakeHTTP:
+    """
+    Answers discord api requests in memory, replacing HTTPClient.request.
+    """
+    def __init__(self, world: 'World', latency_ms: float = 0):
+        self.world = world
+        self.latency = latency_ms / 1000
+        self.calls = Counter()  # 'METHOD /path/{template}' -> calls
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        self.calls[f'{route.method} {route.path}'] += 1
+        if (record := _current.get()) is not None:
+            record.rest += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if route.method == 'POST' and route.path == '/channels/{channel_id}/messages':
+            payload = kwargs.get('json') or {}
+            return {
+                **self.world.message(route.channel_id, self.world.bot_user, payload.get('content') or ''),
+                'embeds': [payload['embed']] if payload.get('embed') else []
+            }
+
+        if route.method == 'GET' and route.path == '/guilds/{guild_id}/members/{user_id}' \
+                and route.guild_id in self.world.state:
+            return self.world.member(route.guild_id, int(route.url.rsplit('/', 1)[-1]))
+
+        if route.method == 'GET' and route.path == '/guilds/{guild_id}/audit-logs':
+            return {'audit_log_entries': [], 'users': [], 'webhooks': [], 'integrations': []}
+
+        return None
+
+
+class World:
+    """
+    Synthetic guilds, members and database rows, and a generator of gateway events for them.
+    """
+    def __init__(self, guilds: int, members: int, configured: float, seed: int):
+        self.rng = random.Random(seed)
+        self._next_id = 200000000000000000
+        self.bot_user = {'id': str(BOT_ID), 'username': 'zote', 'discriminator': '0001', 'avatar': None,
+                         'bot': True}
+        self.guilds: typing.Dict[int, dict] = {}  # guild id -> GUILD_CREATE payload
+        self.rows: typing.List[dict] = []  # guild rows in the database
+        self.state: typing.Dict[int, dict] = {}  # guild id -> ids used to generate events
+
+        for _ in range(guilds):
+            self._add_guild(members, self.rng.random() < configured)
+
+    def snowflake(self) -> int:
+        self._next_id += self.rng.randint(1, 1 << 22)
+        return self._next_id
+
+    @staticmethod
+    def user(user_id: int) -> dict:
+        return {'id': str(user_id), 'username': f'user{user_id % 100000}', 'discriminator': '0001',
+                'avatar': None, 'bot': False}
+
+    def member(self, guild_id: int, user_id: int) -> dict:
+        state = self.state[guild_id]
+        return {
+            'user': self.bot_user if user_id == BOT_ID else self.user(user_id),
+            'roles': [str(r) for r in state['member_roles'].get(user_id, ())],
+            'nick': state['nicks'].get(user_id),
+            'joined_at': '2021-01-01T00:00:00+00:00',
+            'deaf': False,
+            'mute': False
+        }
+
+    def message(self, channel_id: int, author: dict, content: str, guild_id: typing.Optional[int] = None) -> dict:
+        data = {
+            'id': str(self.snowflake()), 'channel_id': str(channel_id), 'author': author, 'content': content,
+            'timestamp': '2021-01-01T00:00:00+00:00', 'edited_timestamp': None, 'tts': False,
+            'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [],
+            'pinned': False, 'type': 0
+        }
+        if guild_id is not None:
+            data['guild_id'] = str(guild_id)
+            data['member'] = {k: v for k, v in self.member(guild_id, int(author['id'])).items() if k != 'user'}
+
+        return data
+
+    def _add_guild(self, members: int, configured: bool):
+        guild_id = self.snowflake()
+        text, logs, voice, afk, menu_message = (self.snowflake() for _ in range(5))
+        admin = self.snowflake()
+        menu_roles = [self.snowflake() for _ in MENU_EMOJIS]
+        user_ids = [self.snowflake() for _ in range(members)]
+
+        def role(role_id, name, position, permissions=0):
+            return {'id': str(role_id), 'name': name, 'permissions': str(permissions), 'position': position,
+                    'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}
+
+        def channel(channel_id, name, type_, position):
+            return {'id': str(channel_id), 'name': name, 'type': type_, 'position': position,
+                    'permission_overwrites': [], 'guild_id': str(guild_id), 'bitrate': 64000, 'user_limit': 0}
+
+        self.state[guild_id] = {
+            'text': text, 'voice': voice, 'afk': afk, 'menu_message': menu_message, 'menu_roles': menu_roles,
+            'users': user_ids, 'member_roles': {BOT_ID: [admin]}, 'nicks': {}, 'voice_channels': {},
+            'prefix': '>', 'messages': deque(maxlen=100)
+        }
+
+        self.guilds[guild_id] = {
+            'id': str(guild_id), 'name': f'guild{len(self.guilds)}', 'owner_id': str(user_ids[0]),
+            'member_count': members + 1, 'large': False, 'unavailable': False, 'region': 'us-east',
+            'features': [], 'emojis': [], 'voice_states': [],
+            'roles': [role(guild_id, '@everyone', 0), role(admin, 'admin', 1, 8),
+                      *(role(r, f'menu{i}', 2 + i) for i, r in enumerate(menu_roles))],
+            'channels': [channel(text, 'general', 0, 0), channel(logs, 'logs', 0, 1),
+                         channel(voice, 'voice', 2, 2), channel(afk, 'afk', 2, 3)],
+            'members': [self.member(guild_id, BOT_ID)] + [self.member(guild_id, u) for u in user_ids]
+        }
+
+        if configured:  # Logs, afk channel and a role menu set up
+            self.rows.append(guild_row(
+                guild_id, logs=logs, afk_channel=afk,
+                rolemenu={str(text): {str(menu_message): {e: r for e, r in zip(MENU_EMOJIS, menu_roles)}}}
+            ))
+
+    def event(self, kind: str) -> dict:
+        """Generate a gateway dispatch of a type from EVENT_TYPES"""
+        rng = self.rng
+        guild_id = rng.choice(list(self.guilds))
+        state = self.state[guild_id]
+        user_id = rng.choice(state['users'])
+
+        if kind == 'message':
+            roll = rng.random()
+            if roll < 0.9:
+                content = 'the mighty zote is here'
+            elif roll < 0.98:
+                content = f'{state["prefix"]}precept'
+            else:
+                content = f'<@{BOT_ID}> hello'
+
+            data = self.message(state['text'], self.user(user_id), content, guild_id)
+            state['messages'].append(int(data['id']))  # Recent messages, edited and deleted by later events
+            return {'t': 'MESSAGE_CREATE', 'd': data}
+
+        if kind in ('message_edit', 'message_delete'):
+            messages = state['messages']
+            message_id = rng.choice(messages) if messages else self.snowflake()
+            data = {'id': str(message_id), 'channel_id': str(state['text']), 'guild_id': str(guild_id)}
+
+            if kind == 'message_delete':
+                if message_id in messages:
+                    messages.remove(message_id)
+                return {'t': 'MESSAGE_DELETE', 'd': data}
+
+            return {'t': 'MESSAGE_UPDATE', 'd': {**data, 'content': f'edited {rng.randint(0, 999)}',
+                                                 'edited_timestamp': '2021-01-01T00:00:01+00:00'}}
+
+        if kind == 'voice':
+            current = state['voice_channels'].get(user_id)
+            if current is None:  # Join
+                channel = rng.choice((state['voice'], state['voice'], state['afk']))
+            elif rng.random() < 0.8:  # Leave
+                channel = None
+            else:  # Move
+                channel = state['afk'] if current == state['voice'] else state['voice']
+
+            state['voice_channels'][user_id] = channel
+            return {'t': 'VOICE_STATE_UPDATE', 'd': {
+                'guild_id': str(guild_id), 'channel_id': str(channel) if channel else None,
+                'user_id': str(user_id), 'session_id': 'benchmark', 'deaf': False, 'mute': False,
+                'self_deaf': False, 'self_mute': False, 'self_video': False, 'suppress': False,
+                'member': self.member(guild_id, user_id)
+            }}
+
+        if kind == 'reaction':
+            on_menu = rng.random() < 0.5
+            return {'t': 'MESSAGE_REACTION_ADD', 'd': {
+                'user_id': str(user_id), 'channel_id': str(state['text']), 'guild_id': str(guild_id),
+                'message_id': str(state['menu_message'] if on_menu else self.snowflake()),
+                'emoji': {'id': None, 'name': rng.choice(MENU_EMOJIS)},
+                'member': self.member(guild_id, user_id)
+            }}
+
+        if kind == 'member_update':
+            if rng.random() < 0.5:  # Nickname change
+                state['nicks'][user_id] = f'nick{rng.randint(0, 999)}'
+            else:  # Role toggled
+                roles = state['member_roles'].setdefault(user_id, [])
+                role = rng.choice(state['menu_roles'])
+                roles.remove(role) if role in roles else roles.append(role)
+
+            return {'t': 'GUILD_MEMBER_UPDATE', 'd': {'guild_id': str(guild_id), **self.member(guild_id, user_id)}}
+
+        raise ValueError(f'Unknown event type {kind}')
+
+    def events(self, count: int, mix: typing.Dict[str, float]) -> typing.Iterator[dict]:
+        kinds, weights = zip(*mix.items())
+        for kind in self.rng.choices(kinds, weights, k=count):
+            yield self.event(kind)
+
+
+# Running
+
+
+def build_bot(loop, world: World, backend: BaseDBConnection, rest_latency_ms: float, profile: str) -> ZoteBot:
+    """Create the bot with the profile cogs, the fake http and the given backend, and the world's guilds cached"""
+    bot = create_bot(get_profile(profile), loop=loop)  # Same cogs and caches as a normal start
+    bot.logger.setLevel(logging.WARNING)
+    bot.db.logger.setLevel(logging.WARNING)
+
+    bot.db.backend = backend
+
+    bot.fake_http = FakeHTTP(world, rest_latency_ms)
+    bot.http.request = bot.fake_http.request
+
+    state = bot._connection
+    state.user = discord.ClientUser(state=state, data=world.bot_user)
+
+    for data in world.guilds.values():
+        state._add_guild_from_data(data)
+
+    return bot
+
+
+def track(bot: ZoteBot):
+    """Count listener tasks and lane handlers started by an event against it"""
+    schedule_event = bot._schedule_event
+    submit = bot.events.submit
+
+    def _schedule_event(coro, event_name, *args, **kwargs):
+        task = schedule_event(coro, event_name, *args, **kwargs)
+        if (record := _current.get()) is not None:
+            record.pending += 1
+            task.add_done_callback(record.finish)
+
+        return task
+
+    async def _submit(key, name, handler, *args, policy=None):
+        if (record := _current.get()) is None:
+            return await submit(key, name, handler, *args, policy=policy)
+
+        async def run(*a):
+            token = _current.set(record)  # Lane workers are shared, attribute this handler's calls to the event
+            try:
+                await handler(*a)
+            finally:
+                _current.reset(token)
+                record.finish()
+
+        record.pending += 1
+        if not (queued := await submit(key, name, run, *args, policy=policy)):  # Dropped
+            record.finish()
+
+        return queued
+
+    bot._schedule_event = _schedule_event
+    bot.events.submit = _submit
+
+
+def load_stream(path: str) -> typing.List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def replay(bot: ZoteBot, events: typing.List[dict], rate: float, report: Report,
+                 timeout: float) -> float:
+    """Feed events to the gateway parsers, returns seconds until every event was handled"""
+    state = bot._connection
+    start = perf_counter()
+
+    for i, event in enumerate(events):
+        if rate:  # Keep to the requested rate
+            if (delay := start + i / rate - perf_counter()) > 0:
+                await asyncio.sleep(delay)
+
+        record = EventRecord(EVENT_TYPES.get(event['t'], event['t'].lower()), report)
+        report.started()
+        token = _current.set(record)
+        try:
+            state.parsers[event['t']](event['d'])
+        finally:
+            _current.reset(token)
+            record.finish()
+
+        await asyncio.sleep(0)  # One dispatch per loop iteration, like reading frames off the gateway
+
+    try:
+        await asyncio.wait_for(report.idle.wait(), timeout)
+    except asyncio.TimeoutError:
+        print(f'{report.outstanding} events were still being handled after {timeout}s')
+
+    return perf_counter() - start
+
+
+async def run(bot: ZoteBot, world: World, events: typing.List[dict], args) -> dict:
+    rows = list(world.rows)
+    for event in [e for e in events if e['t'] in ('GUILD_CREATE', 'ZOTE_GUILD_ROW')]:  # Setup lines
+        if event['t'] == 'GUILD_CREATE':
+            bot._connection._add_guild_from_data(event['d'])
+        else:
+            rows.append(event['d'])
+    events = [e for e in events if e['t'] not in ('GUILD_CREATE', 'ZOTE_GUILD_ROW')]
+
+    backend = bot.db.backend
+    await backend.connect()
+    for row in rows:  # Through the backend, so this works with any of them
+        await backend.new_guild(int(row['id']))
+        await backend.update('guilds', int(row['id']), {k: v for k, v in row.items() if k != 'id'})
+
+    queries = count_queries(backend)
+    await bot.startup()  # Loads guild rows like a normal start
+    bot.dispatch('ready')
+    bot._ready.set()
+    await asyncio.sleep(0.1)  # Let on_ready listeners run
+    queries.clear()
+    bot.fake_http.calls.clear()
+
+    track(bot)
+    report = Report()
+    elapsed = await replay(bot, events, args.rate, report, args.timeout)
+
+    # Wait for work done after the handlers return, role edits and log lines are sent later
+    log_events = bot.get_cog('LogEvents')
+    while log_events is not None and log_events.role_queue.tasks:
+        await asyncio.sleep(0.1)
+    await bot.close()
+
+    for extension in list(bot.extensions):  # Stops cog loops
+        bot.unload_extension(extension)
+
+    total_queries = sum(queries.values())
+    rest = sum(bot.fake_http.calls.values())
+    handled = sum(len(v) for v in report.latency.values())
+    all_latency = [ms for v in report.latency.values() for ms in v]
+
+    return {
+        'events': len(events),
+        'handled': handled,
+        'seconds': elapsed,
+        'events_per_second': handled / elapsed if elapsed else 0,
+        'latency_ms': {'p50': percentile(all_latency, 0.5), 'p99': percentile(all_latency, 0.99),
+                       'max': max(all_latency, default=0)},
+        'by_event': {
+            kind: {
+                'count': len(v),
+                'p50_ms': percentile(v, 0.5),
+                'p99_ms': percentile(v, 0.99),
+                'queries_per_event': report.queries[kind] / len(v),
+                'rest_per_event': report.rest[kind] / len(v)
+            } for kind, v in sorted(report.latency.items())
+        },
+        'queries_per_event': total_queries / handled if handled else 0,
+        'rest_per_event': rest / handled if handled else 0,
+        'queries': dict(queries.most_common()),
+        'rest': dict(bot.fake_http.calls.most_common()),
+        'dropped': sum(bot.metrics.counters.get('zote_event_dropped_total', {}).values())
+    }
+
+
+def print_report(res: dict):
+    print(f'{res["handled"]}/{res["events"]} events in {res["seconds"]:.2f}s, {res["events_per_second"]:.0f} events/s')
+    lat = res['latency_ms']
+    print(f'latency ms: p50 {lat["p50"]:.2f} p99 {lat["p99"]:.2f} max {lat["max"]:.2f}')
+    print(f'db queries per event: {res["queries_per_event"]:.3f}, rest calls per event: {res["rest_per_event"]:.3f}'
+          f', dropped: {res["dropped"]:.0f}')
+
+    print(f'\n{"event":<15}{"count":>8}{"p50 ms":>10}{"p99 ms":>10}{"queries":>10}{"rest":>10}')
+    for kind, e in res['by_event'].items():
+        print(f'{kind:<15}{e["count"]:>8}{e["p50_ms"]:>10.2f}{e["p99_ms"]:>10.2f}'
+              f'{e["queries_per_event"]:>10.3f}{e["rest_per_event"]:>10.3f}')
+    print('(queries and rest per event type only count calls made while handling it,'
+          ' batched log lines and role edits are sent later)')
+
+    for title, counts in (('db queries', res['queries']), ('rest calls', res['rest'])):
+        print(f'\n{title}:')
+        for name, n in counts.items():
+            print(f'  {n:>8} {name}')
+
+
+def parse_mix(text: str) -> typing.Dict[str, float]:
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in EVENT_TYPES.values():
+            raise argparse.ArgumentTypeError(f'Unknown event type {kind}')
+        mix[kind] = float(weight or 1)
+
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay gateway events through the bot and report throughput.')
+    parser.add_argument('--events', type=int, default=10000, help='synthetic events to generate')
+    parser.add_argument('--rate', type=float, default=0, help='events per second, 0 for as fast as possible')
+    parser.add_argument('--mix', type=parse_mix, default='message=60,voice=15,reaction=10,member_update=15',
+                        help='weights of the synthetic event types')
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--members', type=int, default=200, help='members per guild')
+    parser.add_argument('--configured', type=float, default=0.5,
+                        help='share of guilds with a database row, logs channel and role menu')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', choices=('memory', 'sqlite'), default='memory',
+                        help='database backend, sqlite uses an in-memory sqlite database')
+    parser.add_argument('--profile', choices=tuple(PROFILES), default='full', help='cogs and caches of the bot')
+    parser.add_argument('--db-latency-ms', type=float, default=0, help='added to every memory database query')
+    parser.add_argument('--rest-latency-ms', type=float, default=0, help='added to every rest call')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for handlers after the replay')
+    parser.add_argument('--replay', metavar='FILE', help='replay a json lines stream instead of synthetic events')
+    parser.add_argument('--save', metavar='FILE', help='write the synthetic stream, with its guilds, to a file')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as json')
+    args = parser.parse_args()
+
+    world = World(args.guilds, args.members, args.configured, args.seed)
+    if args.replay:
+        events = load_stream(args.replay)
+    else:
+        events = list(world.events(args.events, args.mix))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            for data in world.guilds.values():
+                f.write(json.dumps({'t': 'GUILD_CREATE', 'd': data}) + '\n')
+            for row in world.rows:
+                f.write(json.dumps({'t': 'ZOTE_GUILD_ROW', 'd': row}) + '\n')
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)  # Cog task loops are created on the current loop
+
+    backend = SQLiteConnection(':memory:', COLUMNS) if args.db == 'sqlite' else MemoryConnection(args.db_latency_ms)
+    bot = build_bot(loop, world, backend, args.rest_latency_ms, args.profile)
+    res = loop.run_until_complete(run(bot, world, events, args))
+    loop.close()
+
+    print_report(res)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(res, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,14 @@
+import asyncio
 import discord
 import logging
 import os
+import typing
 
 from discord.ext import commands
-from utils import aloc, DBConnection, PermissionDenied, access_level_check, AccessLevel
+from time import perf_counter, time_ns
+from utils import aloc, DBConnection, PermissionDenied, access_level_check, AccessLevel, VoiceTracker, \
+    LogDispatcher, Metrics, MetricsServer, EventLanes, Profile, cog_requires, get_profile, estimate_cache_memory, \
+    StartupTimer, load_order, MessageStore
 
 # Constants
 
@@ -24,19 +29,51 @@ async def get_prefix(_bot, message):
     if not message.guild:  # if the message is a DM
         return DEFAULT_PREFIX
 
+    if _bot.prefixes is not None:  # prefix table is loaded
+        return _bot.prefixes.get(message.guild.id, DEFAULT_PREFIX)
+
     guild = await _bot.db.get_guild(message.guild.id)
 
     if not guild:  # no guild data
         return DEFAULT_PREFIX
 
-    return guild.get('prefix', DEFAULT_PREFIX)  # return the guild prefix or default
+    return guild.get('prefix') or DEFAULT_PREFIX  # return the guild prefix or default
 
 
 class ZoteBot(commands.AutoShardedBot):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, profile: typing.Optional[Profile] = None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.startup_timer = StartupTimer()  # Phases up to the first command, logged on ready
+        self.profile = profile or get_profile()  # Cogs and caches, see create_bot
         self.db = DBConnection()
-        self._watcher_mode = os.environ.get('WATCHER_MODE', '0') == '1'
+        self.voice = VoiceTracker(self.db)
+        self.logs = LogDispatcher(
+            window=float(os.environ.get('ZOTE_LOG_WINDOW', '1.0')),
+            max_queue=int(os.environ.get('ZOTE_LOG_QUEUE', '500'))
+        )
+        self.messages = MessageStore(  # Recent messages, for delete and edit logs
+            max_bytes=int(float(os.environ.get('ZOTE_MESSAGE_STORE_MB', '32')) * 1024 * 1024),
+            per_channel=int(os.environ.get('ZOTE_MESSAGE_STORE_PER_CHANNEL', '1000'))
+        )
+        self.metrics = Metrics()
+        self.metrics_server = MetricsServer(
+            self.metrics,
+            port=int(port) if (port := os.environ.get('ZOTE_METRICS_PORT')) else None,
+            snapshot_path=os.environ.get('ZOTE_METRICS_FILE'),
+            snapshot_interval=float(os.environ.get('ZOTE_METRICS_SNAPSHOT_INTERVAL', '60'))
+        )
+        self.events = EventLanes(  # Log event handlers, one lane per guild
+            self.metrics,
+            lanes=int(os.environ.get('ZOTE_EVENT_LANES', '8')),
+            max_depth=int(os.environ.get('ZOTE_EVENT_QUEUE_DEPTH', '1000')),
+            policy=os.environ.get('ZOTE_EVENT_QUEUE_POLICY', EventLanes.DROP)
+        )
+        self._setup_metrics()
+        self.prefixes: typing.Optional[typing.Dict[int, str]] = None  # guild id -> prefix, loaded in startup
+        self._started = False  # startup has run
+        self._startup_task: typing.Optional[asyncio.Task] = None  # startup running while logging in
+        self._cache_missing_guilds = False  # cache guilds without a row in the first on_ready
+        self._info_embeds = {}  # guild id -> (prefix, color, embed) sent when the bot is mentioned
 
         logger = logging.getLogger(  # create logger
             'zote' if os.environ.get('DEBUG', "0") == "0"
@@ -51,37 +88,231 @@ class ZoteBot(commands.AutoShardedBot):
         logger.addHandler(handler)
         self.logger = logger
 
+    def _setup_metrics(self):
+        m = self.metrics
+        m.describe('zote_command_invocations_total', 'Commands invoked')
+        m.describe('zote_command_errors_total', 'Commands that raised an error')
+        m.describe('zote_command_duration_ms', 'Command invoke time, checks included')
+        m.describe('zote_event_duration_ms', 'Gateway event listener run time')
+        m.describe('zote_event_errors_total', 'Gateway event listeners that raised')
+        m.describe('zote_event_queue_depth', 'Events waiting in each event lane')
+        m.describe('zote_event_queue_wait_ms', 'Time events waited in their lane before being handled')
+        m.describe('zote_event_dropped_total', 'Events dropped because their lane was full')
+        m.describe('zote_shard_latency_seconds', 'Gateway heartbeat latency per shard')
+        m.describe('zote_db_call_duration_ms', 'Database method call time')
+        m.describe('zote_db_acquire_wait_ms', 'Time waited for a database connection')
+        m.describe('zote_log_lines_total', 'Log lines queued or dropped by the log dispatcher', counter=True)
+        m.describe('zote_startup_phase_seconds', 'Time each startup phase took')
+        m.describe('zote_message_store_bytes', 'Estimated bytes used by stored messages')
+        m.describe('zote_message_store_messages', 'Messages kept for delete and edit logs')
+        m.describe('zote_role_queue_total', 'Role menu changes requested, coalesced or skipped, and requests sent'
+                                            ' or failed', counter=True)
+        m.describe('zote_role_queue_pending', 'Members with role menu changes waiting to be applied')
+
+        def collect():
+            for shard_id, latency in self.latencies:
+                yield 'zote_shard_latency_seconds', {'shard': shard_id}, latency
+
+            for name, hist in list(self.db.latency.items()):
+                yield 'zote_db_call_duration_ms', {'method': name}, hist
+
+            for lane, depth in enumerate(self.events.depths()):
+                yield 'zote_event_queue_depth', {'lane': lane}, depth
+
+            yield 'zote_db_acquire_wait_ms', {}, self.db.backend.acquire_wait
+            yield 'zote_log_lines_total', {'state': 'queued'}, self.logs.queued
+            yield 'zote_log_lines_total', {'state': 'dropped'}, self.logs.dropped
+
+            yield 'zote_message_store_bytes', {}, self.messages.bytes
+            yield 'zote_message_store_messages', {}, len(self.messages)
+
+            if (log_events := self.get_cog('LogEvents')) is not None:
+                stats = log_events.role_queue.stats()
+                yield 'zote_role_queue_pending', {}, stats.pop('pending')
+                for state, value in stats.items():
+                    yield 'zote_role_queue_total', {'state': state}, value
+
+            for name, started, ended in self.startup_timer.phases:
+                yield 'zote_startup_phase_seconds', {'phase': name}, ended - started
+
+        m.add_collector(collect)
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        if self.startup_timer.mark('first command'):
+            self.logger.debug(f'First command {self.startup_timer.now():.2f}s after start')
+
+        start = perf_counter()
+        try:
+            await super().invoke(ctx)
+        finally:
+            name = ctx.command.qualified_name  # the subcommand once a group has invoked it
+            self.metrics.inc('zote_command_invocations_total', command=name)
+            self.metrics.observe('zote_command_duration_ms', (perf_counter() - start) * 1000, command=name)
+
     async def close(self):
+        if self._startup_task is not None:
+            self._startup_task.cancel()
+
+        await self.metrics_server.close()
+        await self.events.close()  # Handle queued events, they can open and close voice sessions
+
+        try:
+            await self.voice.flush(time_ns() / 1e6)  # Save voice time, including sessions still open
+        except Exception as e:
+            self.logger.exception('Failed to save voice time on close', exc_info=e)
+
+        await self.logs.close()  # Send any queued log lines
+
         if self.db.is_connected:
             await self.db.close()
 
         await super().close()
 
+    def set_prefix(self, guild_id: int, prefix: str):
+        """Update the prefix table after a prefix change"""
+        if self.prefixes is not None:
+            self.prefixes[guild_id] = prefix
+
+    def _on_guild_change(self, guild_id: int, row: typing.Optional[dict]):
+        """Update the prefix table after another process changed a guild"""
+        if self.prefixes is None:
+            return
+
+        if row and row.get('prefix'):
+            self.prefixes[guild_id] = row['prefix']
+        else:
+            self.prefixes.pop(guild_id, None)
+
+    def get_info_embed(self, message, prefix: str) -> discord.Embed:
+        """Get the bot info embed for a guild, only rebuilt when the prefix or color changed"""
+        guild_id = message.guild.id if message.guild else 0
+        color = message.guild.me.color if message.guild else discord.Color.default()
+
+        cached = self._info_embeds.get(guild_id)
+        if cached is not None and cached[0] == prefix and cached[1] == color:
+            return cached[2]
+
+        # build bot info embed
+        emb = discord.Embed(title='Zote', description=BOT_DESCRIPTION, color=color)
+        emb.set_thumbnail(url=self.user.avatar_url)
+        emb.set_footer(text=f'{self.user.name}#{self.user.discriminator} (v{BOT_VERSION})',
+                       icon_url=self.user.avatar_url)
+        emb.add_field(name='Prefix', value=prefix)
+
+        self._info_embeds[guild_id] = (prefix, color, emb)
+        return emb
+
     async def on_message(self, message):
-        if not self._watcher_mode:  # Normal bot functionality
+        if self.profile.commands:  # Normal bot functionality, off in watcher mode
             if message.author.bot:
                 return
 
-            prefix = await get_prefix(self, message)
-            if self.user.mention in message.content \
-                    and not message.content.startswith(prefix):  # any ping, except when a command is used
-                # build bot info embed
-                emb = discord.Embed(title='Zote', description=BOT_DESCRIPTION, color=message.guild.me.color)
-                emb.set_thumbnail(url=self.user.avatar_url)
-                emb.set_footer(text=f'{self.user.name}#{self.user.discriminator} (v{BOT_VERSION})',
-                               icon_url=self.user.avatar_url)
-                emb.add_field(name='Prefix', value=prefix)
-                await message.channel.send(embed=emb)
+            # Resolve the prefix without awaiting when the prefix table is loaded
+            if not message.guild:
+                prefix = DEFAULT_PREFIX
+            elif self.prefixes is not None:
+                prefix = self.prefixes.get(message.guild.id, DEFAULT_PREFIX)
+            else:
+                prefix = await get_prefix(self, message)
+
+            content = message.content
+            is_command = content.startswith(prefix)
+            if not is_command and self.user.mention not in content:  # plain chat, nothing to do
+                return
+
+            if not is_command:  # any ping, except when a command is used
+                await message.channel.send(embed=self.get_info_embed(message, prefix))
                 return
 
             await self.process_commands(message)
 
+    async def on_guild_remove(self, guild):
+        self.db.evict_guild(guild.id)  # No more events for this guild, free its cache entry
+
+    async def startup(self):
+        """Connect to the database and load guild configuration, runs once, while logging in to discord"""
+        if self._started:
+            return
+
+        self._started = True
+        timer = self.startup_timer
+
+        with timer.phase('metrics server'):
+            await self.metrics_server.start()
+
+        with timer.phase('database connect'):
+            await self.db.connect()
+
+        self.db.on_guild_change = self._on_guild_change
+        self.db.listen()  # Listen before loading so no change made by other processes is missed
+
+        with timer.phase('load guilds'):
+            guilds = await self.db.load_guilds(self.shard_ids, self.shard_count)
+
+        # load once, kept up to date by set_prefix
+        self.prefixes = {g['id']: g['prefix'] for g in guilds if g.get('prefix')}
+        self._cache_missing_guilds = len(guilds) < self.db.guild_cache.max_size  # no rows were evicted
+
+        self.logger.debug(f'Loaded {len(guilds)} guilds')
+
+    def _startup_done(self, task: asyncio.Task):
+        if not task.cancelled() and (e := task.exception()) is not None:
+            # Events and commands still work, guilds are fetched as they are used
+            self.logger.exception('Startup failed', exc_info=e)
+
+    async def start(self, *args, **kwargs):
+        # Events received before startup is done look guilds up one by one, batched per tick
+        self._startup_task = self.loop.create_task(self.startup())
+        self._startup_task.add_done_callback(self._startup_done)
+        await super().start(*args, **kwargs)
+
+    async def login(self, *args, **kwargs):
+        with self.startup_timer.phase('login'):
+            await super().login(*args, **kwargs)
+
+    async def on_connect(self):
+        self.startup_timer.mark('gateway connected')
+
     async def on_ready(self):
-        await self.db.connect()
-        self.logger.debug(f'Logged in as {bot.user} ({bot.user.id})')
-        self.logger.debug(f'All lines of code: {aloc()}')
+        if self._startup_task is not None:
+            await asyncio.wait({self._startup_task})  # Guilds have to be loaded before the rest are cached as missing
+
+        if self._cache_missing_guilds:
+            # Every guild with a row was loaded in startup, so the rest can be cached as having none
+            for guild in self.guilds:
+                if guild.id not in self.db.guild_cache:
+                    self.db.guild_cache.set(guild.id, None)
+
+            self._cache_missing_guilds = False
+
+        self.logger.debug(f'Logged in as {self.user} ({self.user.id})')
+
+        if self.startup_timer.mark('ready'):
+            self.logger.debug('Startup:\n  ' + '\n  '.join(self.startup_timer.report()))
+            self.log_cache_memory()
+            # Reads every source file, kept off the event loop
+            self.logger.debug(f'All lines of code: {await self.loop.run_in_executor(None, aloc)}')
+
+    def log_cache_memory(self):
+        """Log the estimated memory used by discord.py's caches"""
+        estimate = estimate_cache_memory(self)
+        total = sum(count * size for _, count, size in estimate)
+
+        self.logger.debug(f'Estimated cache memory ({self.profile.name} profile): {total / 1024 / 1024:.1f}MB')
+        for name, count, size in estimate:
+            self.logger.debug(f'  {name}: {count} cached, ~{size:.0f}B each, {count * size / 1024 / 1024:.1f}MB')
+
+        stats = self.messages.stats()
+        self.logger.debug(f'Message store: {stats["messages"]} messages, {stats["bytes"] / 1024 / 1024:.1f}MB'
+                          f' of {stats["max_bytes"] / 1024 / 1024:.1f}MB')
 
     async def on_command_error(self, ctx, exception):
+        if ctx.command is not None:
+            self.metrics.inc('zote_command_errors_total', command=ctx.command.qualified_name)
+
         if isinstance(exception, PermissionDenied):
             await ctx.send(exception)
             return
@@ -101,20 +332,42 @@ class ZoteBot(commands.AutoShardedBot):
         self.logger.exception(f'Exception in command {ctx.command.qualified_name}:', exc_info=exception)
 
 
-if __name__ == '__main__':
-    bot = ZoteBot(command_prefix=get_prefix, intents=discord.Intents.all(), owner_id=OWNER_ID)
-
-    # moderation.py needs to be loaded after log_events.py, (Moderation cog accesses LogEvents cog)
-    # this is not and issue due to alphabetical order but may arise later with other cogs
-    for filename in os.listdir('cogs'):
-        if filename.endswith('.py'):
-            try:
-                bot.load_extension(f'cogs.{filename[:-3]}')  # load all cogs
-            except commands.ExtensionError as e:
-                bot.logger.error(e)
-
-    bot.run(
-        # get token from environment, run purple if debug mode is enabled
-        os.environ.get('ZOTE_DISCORD_TOKEN', 'abcdefg1234567') if os.environ.get('DEBUG', '0') == '0'
-        else os.environ.get('PURPLE_DISCORD_TOKEN', 'abcdefg1234567'),
+def get_token() -> str:
+    """Get the bot token from the environment, the purple token if debug mode is enabled"""
+    return os.environ.get('ZOTE_DISCORD_TOKEN', 'abcdefg1234567') if os.environ.get('DEBUG', '0') == '0' \
+        else os.environ.get('PURPLE_DISCORD_TOKEN', 'abcdefg1234567')
+
+
+def create_bot(profile: typing.Optional[Profile] = None, **kwargs) -> ZoteBot:
+    """
+    Create the bot with the cogs of a profile loaded, ZOTE_PROFILE by default, each after the cogs it requires.
+    Intents and caches follow what the loaded cogs need, kwargs are passed to ZoteBot (eg. shard_ids and shard_count).
+    """
+    profile = profile or get_profile()
+    cogs, skipped = load_order(profile.select_cogs(sorted(f[:-3] for f in os.listdir('cogs') if f.endswith('.py'))),
+                               cog_requires)
+    options = {**profile.client_options(cogs), **kwargs}
+
+    bot = ZoteBot(command_prefix=get_prefix, owner_id=OWNER_ID, profile=profile, **options)
+    bot.logger.debug(
+        f'Profile {profile.name} ({profile.description}): intents {options["intents"].value},'
+        f' member cache {options["member_cache_flags"]!r}, chunk {options["chunk_guilds_at_startup"]},'
+        f' max messages {options["max_messages"]}'
     )
+
+    for cog, missing in skipped.items():
+        bot.logger.error(f'Cog {cog} not loaded, it requires {", ".join(missing)}')
+
+    with bot.startup_timer.phase('load cogs'):
+        for cog in cogs:
+            with bot.startup_timer.phase(f'load cog {cog}'):
+                try:
+                    bot.load_extension(f'cogs.{cog}')  # load the profile cogs
+                except commands.ExtensionError as e:
+                    bot.logger.error(e)
+
+    return bot
+
+
+if __name__ == '__main__':
+    create_bot().run(get_token())
@@ -0,0 +1,349 @@
+"""
+Runs the bot as several worker processes, each connecting a contiguous range of the shards.
+Workers are restarted when they exit or stop reporting, and their health is summarised in the log
+and optionally written to a json file.
+
+    python cluster.py --clusters 4              # shard count recommended by discord
+    python cluster.py --clusters 4 --shards 16
+
+Every worker has its own database pool, --pool-max splits a total number of connections between them.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import typing
+
+from time import monotonic, sleep, time
+
+HEALTH_INTERVAL = float(os.environ.get('ZOTE_CLUSTER_HEALTH_INTERVAL', '10'))  # Seconds between worker reports
+HEALTH_TIMEOUT = float(os.environ.get('ZOTE_CLUSTER_HEALTH_TIMEOUT', '120'))  # Silent workers are restarted
+STARTUP_TIMEOUT = float(os.environ.get('ZOTE_CLUSTER_STARTUP_TIMEOUT', '300'))  # Seconds to wait for ready
+RESTART_BACKOFF_MAX = 60.0  # Seconds, the backoff doubles on every restart of a worker that did not stay up
+STABLE_AFTER = 300.0  # Seconds a worker has to stay up for its backoff to reset
+STOP_TIMEOUT = 30.0  # Seconds a worker has to exit after SIGTERM before it is killed
+
+
+def split_shards(shard_count: int, clusters: int) -> typing.List[typing.List[int]]:
+    """Split shard ids into contiguous ranges, as even as possible"""
+    clusters = max(1, min(clusters, shard_count))
+    size, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+
+    for i in range(clusters):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+
+    return ranges
+
+
+def recommended_shards(token: str) -> int:
+    """Ask discord how many shards the bot should use"""
+    import asyncio
+    import aiohttp
+
+    async def fetch():
+        async with aiohttp.ClientSession() as session:
+            async with session.get('https://discord.com/api/v8/gateway/bot',
+                                   headers={'Authorization': f'Bot {token}'}) as r:
+                r.raise_for_status()
+                return (await r.json())['shards']
+
+    return asyncio.run(fetch())
+
+
+def current_rss_mb() -> typing.Optional[float]:
+    """Get the resident memory of this process now, None where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError):
+        return None
+
+
+def _suffixed(path: str, cluster_id: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f'{root}.{cluster_id}{ext}'
+
+
+def run_worker(cluster_id: int, shard_ids: typing.List[int], shard_count: int, health: multiprocessing.Queue,
+               pool_size: typing.Optional[typing.Tuple[int, int]]):
+    """Process entry point, runs the bot for a range of shards"""
+    # Settings are read on import, so they are set before the bot is imported
+    if pool_size is not None:
+        os.environ['ZOTE_DB_POOL_MIN'], os.environ['ZOTE_DB_POOL_MAX'] = map(str, pool_size)
+    if port := os.environ.get('ZOTE_METRICS_PORT'):  # One port per worker
+        os.environ['ZOTE_METRICS_PORT'] = str(int(port) + cluster_id)
+    if path := os.environ.get('ZOTE_METRICS_FILE'):
+        os.environ['ZOTE_METRICS_FILE'] = _suffixed(path, cluster_id)
+
+    import asyncio
+    import resource
+
+    from bot import create_bot, get_token
+
+    bot = create_bot(shard_ids=shard_ids, shard_count=shard_count)
+    bot.logger.info(f'Cluster {cluster_id} running shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}')
+
+    async def report():
+        while True:
+            health.put({
+                'cluster': cluster_id,
+                'pid': os.getpid(),
+                'time': time(),
+                'ready': bot.is_ready(),
+                'guilds': len(bot.guilds),
+                'latencies': {shard_id: latency for shard_id, latency in bot.latencies},
+                'events_queued': sum(bot.events.depths()),
+                'db_connected': bot.db.is_connected,
+                'rss_mb': current_rss_mb(),
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on linux
+            })
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    bot.loop.create_task(report())
+    bot.run(get_token())
+
+
+class Worker:
+    def __init__(self, cluster_id: int, shard_ids: typing.List[int]):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process: typing.Optional[multiprocessing.Process] = None
+        self.started = 0.0  # monotonic time of the last start
+        self.last_seen = 0.0  # monotonic time of the last health report
+        self.health: dict = {}  # Last health report
+        self.restarts = 0
+        self.backoff = 1.0
+        self.restart_at: typing.Optional[float] = None  # Scheduled restart after a crash
+        self.kill_at: typing.Optional[float] = None  # Asked to stop, killed if still running by then
+
+    @property
+    def name(self) -> str:
+        return f'cluster {self.cluster_id} (shards {self.shard_ids[0]}-{self.shard_ids[-1]})'
+
+    @property
+    def ready(self) -> bool:
+        return self.health.get('ready', False)
+
+
+class Cluster:
+    """
+    Starts, supervises and restarts the worker processes, and collects their health reports.
+    """
+    def __init__(self, shard_count: int, clusters: int, pool_max: typing.Optional[int] = None,
+                 health_file: typing.Optional[str] = None, summary_interval: float = 60):
+        self.shard_count = shard_count
+        self.workers = [Worker(i, shard_ids) for i, shard_ids in enumerate(split_shards(shard_count, clusters))]
+        self.health_file = health_file
+        self.summary_interval = summary_interval
+
+        # Each worker gets an even part of the connections, at least 1
+        self.pool_size = None
+        if pool_max is not None:
+            per_worker = max(1, pool_max // len(self.workers))
+            self.pool_size = (min(2, per_worker), per_worker)
+
+        self.ctx = multiprocessing.get_context('spawn')  # Workers do not inherit the launcher's state
+        self.health = self.ctx.Queue()
+        self.running = True
+
+        self.logger = logging.getLogger('zote.cluster')
+        self.logger.setLevel(logging.INFO)
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s',
+                                               datefmt='%Y-%m-%d %H:%M:%S'))
+        self.logger.addHandler(handler)
+
+    def start_worker(self, worker: Worker):
+        worker.process = self.ctx.Process(
+            target=run_worker, name=f'zote-cluster-{worker.cluster_id}',
+            args=(worker.cluster_id, worker.shard_ids, self.shard_count, self.health, self.pool_size)
+        )
+        worker.process.start()
+        worker.started = worker.last_seen = monotonic()
+        worker.health = {}
+        worker.restart_at = None
+        worker.kill_at = None
+        self.logger.info(f'Started {worker.name} as pid {worker.process.pid}')
+
+    def stop_worker(self, worker: Worker, timeout: float = STOP_TIMEOUT):
+        """Ask a worker to close without waiting for it, it is killed by _reap if it does not exit in time"""
+        if worker.process is None or not worker.process.is_alive() or worker.kill_at is not None:
+            return
+
+        worker.process.terminate()  # SIGTERM, the bot closes its connections
+        worker.kill_at = monotonic() + timeout
+        worker.health = {}  # No longer ready
+
+    def _reap(self, worker: Worker) -> bool:
+        """Kill a stopping worker that ran out of time, returns True once it has exited"""
+        if worker.kill_at is None or not worker.process.is_alive():
+            worker.kill_at = None
+            return True
+
+        if monotonic() >= worker.kill_at:
+            self.logger.warning(f'Killing {worker.name}, it did not exit after SIGTERM')
+            worker.process.kill()
+
+        return False
+
+    def stop_all(self, timeout: float = STOP_TIMEOUT):
+        """Stop every worker at once and wait for them to exit"""
+        for worker in self.workers:
+            self.stop_worker(worker, timeout)
+
+        while not all([self._reap(w) for w in self.workers if w.process is not None]):  # Each one checked
+            sleep(0.2)
+
+    def _read_health(self, timeout: float):
+        """Store health reports until timeout passes without one"""
+        try:
+            while True:
+                report = self.health.get(timeout=timeout)
+                worker = self.workers[report['cluster']]
+                if worker.process is not None and report['pid'] == worker.process.pid:  # Not from a replaced worker
+                    worker.health = report
+                    worker.last_seen = monotonic()
+                timeout = 0
+        except queue.Empty:
+            pass
+
+    def _supervise(self):
+        now = monotonic()
+
+        for worker in self.workers:
+            if worker.process is None:  # Not started yet
+                continue
+
+            if not self._reap(worker):  # Still stopping, restarted once it has exited
+                continue
+
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self.start_worker(worker)
+                continue
+
+            if not worker.process.is_alive():
+                reason = f'exited with code {worker.process.exitcode}'
+            elif now - worker.last_seen > (HEALTH_TIMEOUT if worker.ready else STARTUP_TIMEOUT):
+                reason = f'sent no health report for {now - worker.last_seen:.0f}s'
+                self.stop_worker(worker)
+            else:
+                continue
+
+            if now - worker.started >= STABLE_AFTER:  # Ran fine for a while, restart right away
+                worker.backoff = 1.0
+
+            worker.restarts += 1
+            worker.restart_at = now + worker.backoff
+            self.logger.error(f'{worker.name} {reason}, restarting in {worker.backoff:.0f}s')
+            worker.backoff = min(worker.backoff * 2, RESTART_BACKOFF_MAX)
+
+    def summary(self) -> dict:
+        """Get the health of every worker and totals for the cluster"""
+        now = monotonic()
+        workers = []
+
+        for worker in self.workers:
+            health = worker.health
+            latencies = list(health.get('latencies', {}).values())
+            workers.append({
+                'cluster': worker.cluster_id,
+                'shards': [worker.shard_ids[0], worker.shard_ids[-1]],
+                'pid': worker.process.pid if worker.process is not None else None,
+                'alive': worker.process is not None and worker.process.is_alive(),
+                'ready': worker.ready,
+                'guilds': health.get('guilds', 0),
+                'latency_ms': max(latencies) * 1000 if latencies else None,  # Slowest shard
+                'events_queued': health.get('events_queued', 0),
+                'db_connected': health.get('db_connected', False),
+                'rss_mb': health.get('rss_mb'),
+                'peak_rss_mb': health.get('peak_rss_mb'),
+                'restarts': worker.restarts,
+                'last_seen_s': now - worker.last_seen if worker.process is not None else None
+            })
+
+        return {
+            'time': time(),
+            'shard_count': self.shard_count,
+            'workers': workers,
+            'ready': sum(w['ready'] for w in workers),
+            'guilds': sum(w['guilds'] for w in workers),
+            'restarts': sum(w['restarts'] for w in workers)
+        }
+
+    def log_summary(self):
+        summary = self.summary()
+        self.logger.info(f'{summary["ready"]}/{len(self.workers)} workers ready, {summary["guilds"]} guilds,'
+                         f' {summary["restarts"]} restarts')
+
+        for w in summary['workers']:
+            latency = f'{w["latency_ms"]:.0f}ms' if w['latency_ms'] is not None else '-'
+            rss = f'{w["rss_mb"]:.0f}MB' if w['rss_mb'] is not None else '-'
+            peak = f'{w["peak_rss_mb"]:.0f}MB' if w['peak_rss_mb'] is not None else '-'
+            self.logger.info(
+                f'  cluster {w["cluster"]} shards {w["shards"][0]}-{w["shards"][1]} pid {w["pid"]}:'
+                f' {"ready" if w["ready"] else "alive" if w["alive"] else "down"}, {w["guilds"]} guilds,'
+                f' latency {latency}, {w["events_queued"]} events queued, rss {rss} (peak {peak}),'
+                f' {w["restarts"]} restarts'
+            )
+
+        if self.health_file is not None:
+            tmp = f'{self.health_file}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(summary, f, indent=2)
+            os.replace(tmp, self.health_file)  # Readers never see a partial file
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, 'running', False))
+
+        try:
+            # Started one at a time, so shards of different workers do not identify at once
+            for worker in self.workers:
+                self.start_worker(worker)
+                while self.running and worker.process.is_alive() and not worker.ready \
+                        and monotonic() - worker.started < STARTUP_TIMEOUT:
+                    self._read_health(1)
+
+            next_summary = monotonic()
+            while self.running:
+                self._read_health(1)
+                self._supervise()
+
+                if monotonic() >= next_summary:
+                    self.log_summary()
+                    next_summary = monotonic() + self.summary_interval
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.logger.info('Stopping workers')
+            self.stop_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the bot as several processes, each with a range of shards.')
+    parser.add_argument('--clusters', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--shards', type=int, default=int(os.environ.get('ZOTE_SHARD_COUNT', '0')),
+                        help='total shards, 0 to use the count recommended by discord')
+    parser.add_argument('--pool-max', type=int, default=None,
+                        help='database connections for the whole cluster, split between workers')
+    parser.add_argument('--health-file', default=os.environ.get('ZOTE_CLUSTER_HEALTH_FILE'),
+                        help='write the health summary to this json file')
+    parser.add_argument('--summary-interval', type=float, default=60, help='seconds between health summaries')
+    args = parser.parse_args()
+
+    shard_count = args.shards
+    if not shard_count:
+        from bot import get_token
+        shard_count = recommended_shards(get_token())
+
+    Cluster(shard_count, args.clusters, args.pool_max, args.health_file, args.summary_interval).run()
+
+
+if __name__ == '__main__':
+    main()
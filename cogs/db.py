@@ -28,13 +28,57 @@ class Database(BasicCog):
         if guild_id is None:
             guild_id = ctx.guild.id
 
-        cache = self.bot.db.guild_cache.get(guild_id)
-        if cache is None:
+        if guild_id not in self.bot.db.guild_cache:
             await ctx.send('No cache found.')
             return
 
+        cache = self.bot.db.guild_cache.get(guild_id)
+        if cache is None:  # Cached as having no database entry
+            await ctx.send(f'Cache for {guild_id}: no entry.')
+            return
+
         await ctx.send(f'Cache for {guild_id}: ```json\n{cache}```')
 
+    @cache.command(name='stats')
+    async def cache_stats(self, ctx):
+        """Shows cache sizes and hit, miss and eviction counts."""
+        ret = ''
+        for name, cache in (('Guilds', self.bot.db.guild_cache), ('Users', self.bot.db.user_cache)):
+            stats = cache.stats()
+            lookups = stats['hits'] + stats['misses']
+            ratio = stats['hits'] / lookups * 100 if lookups else 0
+
+            ret += f'{name}: {stats["size"]}/{stats["max_size"]} entries, {stats["hits"]} hits,' \
+                   f' {stats["misses"]} misses ({ratio:.1f}% hit rate), {stats["evictions"]} evictions\n'
+
+        for name, loader in (('Guild loads', self.bot.db.guild_loader), ('User loads', self.bot.db.user_loader),
+                             ('User creates', self.bot.db.user_creator)):
+            stats = loader.stats()
+            ret += f'{name}: {stats["requests"]} requests, {stats["deduplicated"]} deduplicated,' \
+                   f' {stats["batches"]} queries ({stats["avg_batch"]:.1f} ids per query)\n'
+
+        stats = self.bot.messages.stats()
+        ret += f'Messages: {stats["messages"]} in {stats["channels"]} channels,' \
+               f' {stats["bytes"] / 1024 / 1024:.1f}/{stats["max_bytes"] / 1024 / 1024:.1f}MB,' \
+               f' {stats["hits"]} hits, {stats["misses"]} misses, {stats["evicted"]} evictions\n'
+
+        if (log_events := self.bot.get_cog('LogEvents')) is not None:
+            stats = log_events.role_queue.stats()
+            ret += f'Role menu changes: {stats["requested"]} requested, {stats["coalesced"]} coalesced,' \
+                   f' {stats["skipped"]} skipped, {stats["pending"]} members pending,' \
+                   f' {stats["applied"]} requests sent, {stats["failed"]} failed\n'
+
+        db = self.bot.db
+        if not db.backend.can_listen:
+            listener = 'not supported'
+        else:
+            listener = 'connected' if db.backend.listener_connected else 'not connected'
+
+        ret += f'Changes by other processes: {db.invalidations["guilds"]} guilds, {db.invalidations["users"]} users,' \
+               f' {db.invalidations["refreshes"]} full refreshes (listener {listener})\n'
+
+        await ctx.send(ret)
+
     @commands.group()
     @access_level(AccessLevel.TRUSTED)
     async def db(self, ctx):
@@ -67,6 +111,71 @@ class Database(BasicCog):
 
         await ctx.send(f'Entry for {user.id}: ```json\n{dict(entry)}```')
 
+    @db.command(name='stats')
+    async def db_stats(self, ctx):
+        """Shows connection pool usage and latency per database method."""
+        db = self.bot.db
+        ret = ''
+
+        if (pool := db.backend.pool_stats()) is not None:
+            ret += f'Pool: {pool["size"]} connections ({pool["idle"]} idle), min {pool["min"]}, max {pool["max"]}\n'
+
+        wait = db.backend.acquire_wait
+        ret += f'Acquire wait: {wait.count} acquires, p50 {wait.percentile(0.5):.1f}ms,' \
+               f' p99 {wait.percentile(0.99):.1f}ms, max {wait.max:.1f}ms\n'
+        ret += f'In flight: {sum(db.in_flight.values())}\n\n'
+
+        for name, hist in sorted(db.latency.items(), key=lambda x: x[1].sum, reverse=True):
+            ret += f'{name}: {hist.count} calls, {db.in_flight.get(name, 0)} in flight,' \
+                   f' p50 {hist.percentile(0.5):.1f}ms, p99 {hist.percentile(0.99):.1f}ms, max {hist.max:.1f}ms\n'
+
+        if db.slow_queries:
+            ret += '\nRecent slow calls:\n'
+            for when, name, ms in reversed(db.slow_queries):
+                ret += f'<t:{int(when)}:T> {name} {ms:.1f}ms\n'
+
+        await ctx.send(ret[:2000])
+
+    @db.command(name='buffer')
+    async def db_buffer(self, ctx):
+        """Shows write-behind buffer batch sizes and flush latency."""
+        if (buffer := self.bot.db.write_buffer) is None:
+            await ctx.send('Write-behind buffering is disabled.')
+            return
+
+        stats = buffer.stats()
+        await ctx.send(
+            f'{stats["pending"]} rows pending, {stats["updates"]} updates buffered\n'
+            f'{stats["flushes"]} flushes wrote {stats["rows_written"]} rows'
+            f' (last {stats["last_batch"]}, avg {stats["avg_batch"]:.1f}, max {stats["max_batch"]} per flush)\n'
+            f'Flush latency: last {stats["last_latency_ms"]:.1f}ms, avg {stats["avg_latency_ms"]:.1f}ms\n'
+            f'{stats["failures"]} failed flushes in a row, {stats["rows_dropped"]} rows dropped after failing'
+        )
+
+    @db.command(name='statements')
+    async def db_statements(self, ctx):
+        """Shows execution counts and timings per statement."""
+        stats = sorted(self.bot.db.backend.stats.items(), key=lambda x: x[1].total_ms, reverse=True)
+        if not stats:
+            await ctx.send('No statements have been run.')
+            return
+
+        ret = '\n'.join(
+            f'{name}: {st.count} runs, {st.errors} errors, avg {st.avg_ms:.2f}ms, max {st.max_ms:.2f}ms'
+            for name, st in stats
+        )
+
+        await ctx.send(f'```\n{ret[:1980]}```')
+
+    @db.command(name='migrate')
+    @access_level(AccessLevel.ADMIN)
+    async def db_migrate(self, ctx):
+        """Moves voice data from the users table into the voice_times table."""
+        async with ctx.typing():
+            count = await self.bot.db.migrate_voice_times()
+
+        await ctx.send(f'Migrated {count} voice time entries.')
+
 
 def setup(bot):
     bot.add_cog(Database(bot))
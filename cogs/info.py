@@ -3,6 +3,7 @@ import typing
 
 from bot import BasicCog
 from discord.ext import commands
+from time import time_ns
 
 
 def convert_time(ms):
@@ -29,16 +30,11 @@ class Information(BasicCog):
         if user is None:
             user = ctx.author
 
-        data = await self.bot.db.get_user(user.id)
-        if data is None:  # User does not have a record in db
-            await ctx.send(f'{user} has no voice time recorded.')
-            return
-
-        if (voice := data['voice'].get(str(ctx.guild.id))) is None:  # No voice data for this user
-            await ctx.send(f'{user} has no voice time recorded.')
-            return
+        voice = await self.bot.db.get_voice_time(ctx.guild.id, user.id)
+        vt = voice.get('voice_time_spent_ms', 0) if voice is not None else 0
+        vt += self.bot.voice.unsaved_time(ctx.guild.id, user.id, time_ns() / 1e6)  # Time not saved yet
 
-        if (vt := voice.get('voice_time_spent_ms', 0)) == 0:  # No voice data for this guild
+        if vt == 0:  # No voice time spent in this guild
             await ctx.send(f'{user} has no voice time recorded.')
             return
 
@@ -58,6 +54,7 @@ class Information(BasicCog):
 
     @voice.command(name='top', description='Displays the top 10 voice time rankings in this guild.')
     async def voice_top(self, ctx):
+        await self.bot.voice.flush()  # Save closed sessions so the rankings are current
         data = await self.bot.db.get_top_voice_times(ctx.guild.id)
         if not data:  # No voice data in this guild for any user
             await ctx.send('No voice time has been recorded in this guild.')
@@ -1,26 +1,102 @@
+import asyncio
+import discord
+import os
+import typing
+
 from bot import BasicCog
-from discord.ext import commands
+from discord.ext import commands, tasks
 from time import time_ns
-from utils import escape_user
+from utils import escape_user, EventLanes, LRUCache, RoleMutationQueue, StoredMessage, timed_event
+
+VOICE_FLUSH_INTERVAL = float(os.environ.get('ZOTE_VOICE_FLUSH_INTERVAL', '60'))  # Seconds between voice time saves
+ROLE_DEBOUNCE = float(os.environ.get('ZOTE_ROLE_DEBOUNCE', '1.0'))  # Seconds to collect role menu changes
+ROLE_CONCURRENCY = int(os.environ.get('ZOTE_ROLE_CONCURRENCY', '4'))  # Role menu member edits running at once
+BAN_WAIT = 2.0  # Seconds after a leave to wait for its ban event, which can arrive after the member remove event
+BAN_TTL = 30.0  # Seconds a ban is remembered to tell a ban from a leave
 
 
 class LogEvents(BasicCog):
     def __init__(self, bot):
         self.bot = bot
+        self.recent_bans = LRUCache(10000, BAN_TTL)  # (guild id, user id) -> True for recent bans
+        self.ban_waiters: typing.Dict[typing.Tuple[int, int], asyncio.Event] = {}  # Leaves waiting for a ban
+        self.role_queue = RoleMutationQueue(bot.http, ROLE_DEBOUNCE, ROLE_CONCURRENCY)  # Role menu changes
+        self.flush_voice.change_interval(seconds=VOICE_FLUSH_INTERVAL)
+        self.flush_voice.start()
+
+    def cog_unload(self):
+        self.flush_voice.cancel()
+        self.role_queue.close()  # Its edits would run against the unloaded cog
+
+    @tasks.loop(seconds=60)
+    async def flush_voice(self):
+        try:
+            await self.bot.voice.flush()  # Save voice time from closed sessions
+        except Exception as e:
+            self.bot.logger.exception('Failed to save voice time', exc_info=e)
+
+    @flush_voice.before_loop
+    async def before_flush_voice(self):
+        await self.bot.wait_until_ready()
 
     async def send_log(self, guild, message):
         if guild is None:  # User dm
             return
 
-        time = await self.bot.db.get_time(guild.id)  # Get the current time for guild timezone
-
         if _guild := await self.bot.db.get_guild(guild.id):  # Get the guild data
             if (l := _guild.get('logs', 0)) != 0:
-                channel = guild.get_channel(l)
-                await channel.send(f'{time} {message}')
+                if (channel := guild.get_channel(l)) is None:  # Logs channel was deleted
+                    return
+
+                time = await self.bot.db.get_time(guild.id)  # Get the current time for guild timezone
+                self.bot.logs.put(channel, f'{time} {message}')  # Queued and sent with other lines
+
+    def mark_banned(self, guild_id: int, user_id: int):
+        """Remember a ban so the member leaving is not logged as a leave"""
+        self.recent_bans.set((guild_id, user_id), True)
+        if (waiter := self.ban_waiters.get((guild_id, user_id))) is not None:  # Wake the leave waiting for it
+            waiter.set()
+
+    async def wait_for_ban(self, guild_id: int, user_id: int, timeout: float) -> bool:
+        """Wait up to timeout seconds for a ban of a member, returns True if they were banned"""
+        key = (guild_id, user_id)
+        if key in self.recent_bans or timeout <= 0:
+            return key in self.recent_bans
+
+        waiter = self.ban_waiters.setdefault(key, asyncio.Event())
+        try:
+            await asyncio.wait_for(waiter.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.ban_waiters.pop(key, None)
+
+        return key in self.recent_bans
+
+    async def _audit_log_banned(self, member) -> bool:
+        """Check the audit log for a ban of member, only used when ban events are not received"""
+        if not member.guild.me.guild_permissions.view_audit_log:
+            return False
+
+        try:
+            async for entry in member.guild.audit_logs(limit=5, action=discord.AuditLogAction.ban):
+                if entry.target.id == member.id:
+                    return True
+        except discord.HTTPException:
+            pass
+
+        return False
+
+    async def submit(self, guild_id: int, name: str, handler, *args, policy: typing.Optional[str] = None):
+        """Queue a handler on the event lane of a guild, so events of a guild are handled in order"""
+        await self.bot.events.submit(guild_id, name, handler, *args, policy=policy)
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild, user):
+        self.mark_banned(guild.id, user.id)  # Right away, a queued leave checks for it
+        await self.submit(guild.id, 'on_member_ban', self._on_member_ban, guild, user)
+
+    async def _on_member_ban(self, guild, user):
         if user.bot:
             return
 
@@ -31,6 +107,9 @@ class LogEvents(BasicCog):
 
     @commands.Cog.listener()
     async def on_member_unban(self, guild, user):
+        await self.submit(guild.id, 'on_member_unban', self._on_member_unban, guild, user)
+
+    async def _on_member_unban(self, guild, user):
         if user.bot:
             return
 
@@ -39,109 +118,87 @@ class LogEvents(BasicCog):
 
         await self.send_log(guild, f'🚨 {escape_user(str(user))} (`{user.id}`) was unbanned')
 
-    @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload):
-        if payload.guild_id is None:
-            return
+    async def is_menu_reaction(self, payload) -> bool:
+        """Check a reaction against the in-memory role menus, other reactions never reach the event lanes"""
+        rolemenus = self.bot.db.rolemenus
+        if payload.guild_id not in rolemenus:  # Guild reaction roles not loaded yet
+            await self.bot.db.get_guild(payload.guild_id)
 
-        if payload.member is None is None or payload.member.bot:
-            return
+        return rolemenus.get_role(payload.guild_id, payload.channel_id, payload.message_id,
+                                  payload.emoji) is not None
 
-        guild_data = await self.bot.db.get_guild(payload.guild_id)
-        if r := guild_data.get('rolemenu', {}):
-            try:
-                guild = self.bot.get_guild(payload.guild_id)
+    async def get_menu_role(self, payload) -> typing.Optional[discord.Role]:
+        """Get the role given by a reaction, None if the reaction is not on a role menu"""
+        if not await self.is_menu_reaction(payload):
+            return None
 
-                channel = guild.get_channel(payload.channel_id)
-                if channel is None:
-                    return
+        if (guild := self.bot.get_guild(payload.guild_id)) is None:
+            return None
 
-                message = await channel.fetch_message(payload.message_id)
-                if message is None:
-                    return
+        return guild.get_role(self.bot.db.rolemenus.get_role(payload.guild_id, payload.channel_id,
+                                                             payload.message_id, payload.emoji))
 
-                if payload.emoji.id is None:
-                    role_id = r[str(channel.id)][str(message.id)][str(payload.emoji.name)]
-                else:
-                    role_id = r[str(channel.id)][str(message.id)][str(payload.emoji.id)]
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        if payload.guild_id is None or (payload.member is not None and payload.member.bot):
+            return
 
-                guild_roles = await guild.fetch_roles()
-                roles = list(filter(lambda _r: int(_r.id) == int(role_id), guild_roles))
+        if not await self.is_menu_reaction(payload):  # Reactions on other messages are not queued
+            return
 
-                if len(roles) < 1:
-                    return
+        # Role menu changes wait for room in a full lane
+        await self.submit(payload.guild_id, 'on_raw_reaction_add', self._on_raw_reaction_add, payload,
+                          policy=EventLanes.WAIT)
 
-                role = roles[0]
+    async def _on_raw_reaction_add(self, payload):
+        if payload.member is None or payload.member.bot:
+            return
 
-                if role.id in [r.id for r in payload.member.roles]:
-                    return
+        if (role := await self.get_menu_role(payload)) is None:  # No rolemenu data for this event
+            return
 
-                try:
-                    await payload.member.add_roles(role)
-                finally:
-                    return
-            except KeyError as e:  # No rolemenu data for this event
-                return
+        self.role_queue.add(payload.member, role)  # Applied with the member's other changes
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload):
         if payload.guild_id is None:
             return
 
-        guild = self.bot.get_guild(payload.guild_id)
-        if guild is None:
+        if not await self.is_menu_reaction(payload):  # Reactions on other messages are not queued
             return
 
-        member = await guild.fetch_member(payload.user_id)
+        await self.submit(payload.guild_id, 'on_raw_reaction_remove', self._on_raw_reaction_remove, payload,
+                          policy=EventLanes.WAIT)
 
-        if member is None or member.bot:
+    async def _on_raw_reaction_remove(self, payload):
+        if (role := await self.get_menu_role(payload)) is None:  # No rolemenu data for this event
             return
 
-        guild_data = await self.bot.db.get_guild(payload.guild_id)
-        if r := guild_data.get('rolemenu', {}):
-            try:
-                channel = guild.get_channel(payload.channel_id)
-                if channel is None:
-                    return
-
-                message = await channel.fetch_message(payload.message_id)
-                if message is None:
-                    return
-
-                if payload.emoji.id is None:
-                    role_id = r[str(channel.id)][str(message.id)][str(payload.emoji.name)]
-                else:
-                    role_id = r[str(channel.id)][str(message.id)][str(payload.emoji.id)]
-
-                guild_roles = await guild.fetch_roles()
-                roles = list(filter(lambda _r: int(_r.id) == int(role_id), guild_roles))
-
-                if len(roles) < 1:
-                    return
-
-                role = roles[0]
-
-                if role.id not in [r.id for r in member.roles]:
-                    return
+        # Members that are not cached are not fetched, their role is removed by id
+        member = role.guild.get_member(payload.user_id) or discord.Object(id=payload.user_id)
+        if getattr(member, 'bot', False):
+            return
 
-                try:
-                    await member.remove_roles(role)
-                finally:
-                    return
-            except KeyError as e:  # No rolemenu data for this event
-                return
+        self.role_queue.remove(member, role)  # Applied with the member's other changes
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
+        await self.submit(member.guild.id, 'on_member_join', self._on_member_join, member)
+
+    async def _on_member_join(self, member):
         await self.send_log(member.guild, f'📥 {escape_user(str(member))} (`{member.id}`) joined the server.')
 
     @commands.Cog.listener()
     async def on_member_remove(self, member):
-        bans = await member.guild.bans()
-        # check if user left because of being banned
-        filtered = list(filter(lambda entry: entry.user.id == member.id, bans))
+        # check if user left because of being banned, the ban event can arrive after the leave.
+        # It is waited for here, outside the guild's lane, so only this leave's log line is delayed
+        if self.bot.intents.bans and await self.wait_for_ban(member.guild.id, member.id, BAN_WAIT):
+            return
+
+        await self.submit(member.guild.id, 'on_member_remove', self._on_member_remove, member)
 
-        if filtered:  # list is not empty, this user has been banned
+    async def _on_member_remove(self, member):
+        if not self.bot.intents.bans and await self._audit_log_banned(member):  # No ban events to go by
             return
 
         await self.send_log(member.guild, f'📤 {escape_user(str(member))} (`{member.id}`) left the server.')
@@ -151,6 +208,9 @@ class LogEvents(BasicCog):
         if before.guild is None:
             return
 
+        await self.submit(before.guild.id, 'on_member_update', self._on_member_update, before, after)
+
+    async def _on_member_update(self, before, after):
         if before.bot:
             return
 
@@ -186,86 +246,112 @@ class LogEvents(BasicCog):
                                   f' has been removed from the role(s):\n{roles}')
 
     @commands.Cog.listener()
-    async def on_message_delete(self, message):
-        if message.guild is None:
+    @timed_event
+    async def on_message(self, message):
+        if message.guild is None or message.author.bot:
             return
 
-        if message.author.bot:
+        # Kept for delete and edit logs, discord.py's message cache is not used
+        self.bot.messages.add(StoredMessage(message.id, message.channel.id, message.author.id, str(message.author),
+                                            message.content, tuple(a.url for a in message.attachments)))
+
+    def channel_name(self, guild_id: int, channel_id: int) -> str:
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(channel_id) if guild is not None else None
+        return channel.name if channel is not None else str(channel_id)
+
+    @commands.Cog.listener()
+    @timed_event
+    async def on_raw_message_delete(self, payload):
+        if payload.guild_id is None:
+            return
+
+        # Messages sent before the bot started, by bots or evicted from the store are not logged
+        if (message := self.bot.messages.pop(payload.channel_id, payload.message_id)) is None:
             return
 
-        attch = [
-            m.url for m in message.attachments
-        ]
-        s = f'🗑️ {escape_user(str(message.author))} (`{message.author.id}`)' \
-            f' message deleted in **#{message.channel.name}**:\n' \
+        await self.submit(payload.guild_id, 'on_message_delete', self._on_message_delete, payload.guild_id, message)
+
+    async def _on_message_delete(self, guild_id: int, message: StoredMessage):
+        attch = message.attachments
+        s = f'🗑️ {escape_user(message.author)} (`{message.author_id}`)' \
+            f' message deleted in **#{self.channel_name(guild_id, message.channel_id)}**:\n' \
             f'{message.content}\n' \
             'Attachments:\n' + ('\n'.join(attch) if attch else 'None')
 
-        await self.send_log(message.guild, s)
+        await self.send_log(self.bot.get_guild(guild_id), s)
 
     @commands.Cog.listener()
-    async def on_message_edit(self, before, after):
-        if before.guild is None:
+    @timed_event
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:  # Not logged, only forgotten
+            self.bot.messages.pop(payload.channel_id, message_id)
+
+    @commands.Cog.listener()
+    @timed_event
+    async def on_guild_channel_delete(self, channel):
+        self.bot.messages.remove_channel(channel.id)
+
+    @commands.Cog.listener()
+    @timed_event
+    async def on_raw_message_edit(self, payload):
+        # Updates without content are embeds loading or pins
+        if payload.guild_id is None or 'content' not in payload.data:
             return
 
-        if before.pinned != after.pinned:
+        if (message := self.bot.messages.get(payload.channel_id, payload.message_id)) is None:
             return
 
-        if before.author.bot:
+        before, after = message.content, payload.data['content']
+        if before == after:
             return
 
-        if before.content != after.content:
-            await self.send_log(
-                before.guild, f'✏️ {escape_user(str(before.author))} (`{before.author.id}`)'
-                              f' message edited in'
-                              f' **#{before.channel.name}**:\n**B:** {before.content}\n**A:** {after.content}'
-            )
+        attachments = tuple(a['url'] for a in payload.data['attachments']) if 'attachments' in payload.data else None
+        self.bot.messages.edit(message, after, attachments)  # Updated now so the next edit compares against it
+
+        await self.submit(payload.guild_id, 'on_message_edit', self._on_message_edit,
+                          payload.guild_id, message.channel_id, message.author_id, message.author, before, after)
+
+    async def _on_message_edit(self, guild_id: int, channel_id: int, author_id: int, author: str,
+                               before: str, after: str):
+        await self.send_log(
+            self.bot.get_guild(guild_id), f'✏️ {escape_user(author)} (`{author_id}`)'
+                                          f' message edited in'
+                                          f' **#{self.channel_name(guild_id, channel_id)}**:\n'
+                                          f'**B:** {before}\n**A:** {after}'
+        )
 
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
-        time_ms = time_ns() / 1e6
+        time_ms = time_ns() / 1e6  # Taken now so time spent queued is not counted
 
         if member.bot:
             return
 
-        user = await self.bot.db.get_user(member.id)
-        if user is None:
-            await self.bot.db.new_user(member.id)
-            user = await self.bot.db.get_user(member.id)
+        # Voice sessions wait for room in a full lane
+        await self.submit(member.guild.id, 'on_voice_state_update', self._on_voice_state_update,
+                          member, before, after, time_ms, policy=EventLanes.WAIT)
 
+    async def _on_voice_state_update(self, member, before, after, time_ms: float):
         guild = await self.bot.db.get_guild(member.guild.id)
+        afk_channel = guild.get('afk_channel', 0) if guild is not None else 0
+        voice = self.bot.voice
 
         if not before.channel and after.channel:  # Joined a channel
             await self.send_log(member.guild, f'☎️  {escape_user(str(member))} (`{member.id}`)'
                                               f' joined **#{after.channel.name}**')
-            if guild is not None and guild.get('afk_channel', 0) == after.channel.id:
+            if afk_channel == after.channel.id:
                 return
 
-            voice = user['voice']
-
-            if voice.get(str(member.guild.id)) is None:
-                voice[str(member.guild.id)] = {}
-
-            voice[str(member.guild.id)]['voice_last_joined_ms'] = time_ms
-
-            await self.bot.db.update_user(member.id, {'voice': voice})
+            voice.join(member.guild.id, member.id, time_ms)
         elif before.channel and not after.channel:  # Left a channel
             await self.send_log(member.guild, f'☎️ {escape_user(str(member))} (`{member.id}`)'
                                               f' left **#{before.channel.name}**')
 
-            if guild is not None and guild.get('afk_channel', 0) == before.channel.id:
+            if afk_channel == before.channel.id:
                 return
 
-            if user['voice'].get(str(member.guild.id)) is not None:
-                voice = user['voice']
-                if voice[str(member.guild.id)].get('voice_last_joined_ms', 0) != 0:
-                    if voice[str(member.guild.id)].get('voice_time_spent_ms') is None:
-                        voice[str(member.guild.id)]['voice_time_spent_ms'] = 0
-
-                    voice[str(member.guild.id)]['voice_time_spent_ms'] += \
-                        time_ms - voice[str(member.guild.id)]['voice_last_joined_ms']
-                    voice[str(member.guild.id)]['voice_last_joined_ms'] = 0
-                    await self.bot.db.update_user(member.id, {'voice': voice})
+            voice.leave(member.guild.id, member.id, time_ms)
         elif before.channel and after.channel:  # Moved to another channel
             if before.channel == after.channel:
                 return
@@ -273,30 +359,28 @@ class LogEvents(BasicCog):
             await self.send_log(member.guild, f'☎️ {escape_user(str(member))} (`{member.id}`)'
                                 f' moved from **#{before.channel.name}** to **#{after.channel.name}**')
 
-            if guild is not None and guild['afk_channel'] == before.channel.id:  # Moving out of afk channel
-                voice = user['voice']
-
-                if voice.get(str(member.guild.id)) is None:
-                    voice[str(member.guild.id)] = {}
+            if afk_channel == before.channel.id:  # Moving out of afk channel
+                voice.join(member.guild.id, member.id, time_ms)
+            elif afk_channel == after.channel.id:  # Moving to afk channel
+                voice.leave(member.guild.id, member.id, time_ms)
 
-                voice[str(member.guild.id)]['voice_last_joined_ms'] = time_ms
-
-                return await self.bot.db.update_user(member.id, {'voice': voice})
+    @commands.Cog.listener()
+    @timed_event
+    async def on_ready(self):
+        time_ms = time_ns() / 1e6
 
-            if guild is not None and guild['afk_channel'] == after.channel.id:  # Moving to afk channel
-                if not user:
-                    return
+        # Open sessions for members that were already in voice when the bot started
+        for guild in self.bot.guilds:
+            guild_data = await self.bot.db.get_guild(guild.id)
+            afk_channel = guild_data.get('afk_channel', 0) if guild_data is not None else 0
 
-                if user['voice'].get(str(member.guild.id)) is not None:
-                    voice = user['voice']
-                    if voice[str(member.guild.id)].get('voice_last_joined_ms', 0) != 0:
-                        if voice[str(member.guild.id)].get('voice_time_spent_ms') is None:
-                            voice[str(member.guild.id)]['voice_time_spent_ms'] = 0
+            for channel in guild.voice_channels:
+                if channel.id == afk_channel:
+                    continue
 
-                        voice[str(member.guild.id)]['voice_time_spent_ms'] += \
-                            time_ms - voice[str(member.guild.id)]['voice_last_joined_ms']
-                        voice[str(member.guild.id)]['voice_last_joined_ms'] = 0
-                        await self.bot.db.update_user(member.id, {'voice': voice})
+                for member in channel.members:
+                    if not member.bot:
+                        self.bot.voice.join(guild.id, member.id, time_ms)
 
 
 def setup(bot):
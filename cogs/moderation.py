@@ -8,7 +8,8 @@ from discord.ext import commands
 class Moderation(BasicCog):
     def __init__(self, bot):
         self.bot = bot
-        self.send_log = self.bot.get_cog('LogEvents').send_log  # Get the send_log function from LogEvents cog
+        self.log_events = self.bot.get_cog('LogEvents')
+        self.send_log = self.log_events.send_log  # Get the send_log function from LogEvents cog
 
     @commands.command(description='Kick a given member from the current guild. reason argument is optional.',
                       usage='<user> [reason]',
@@ -69,14 +70,18 @@ class Moderation(BasicCog):
             await ctx.send('I cannot ban this user.')
             return
 
+        self.log_events.mark_banned(ctx.guild.id, member.id)  # Don't log the member leaving
         try:
             await ctx.guild.ban(member, reason=reason)  # ctx.guild.ban incase the user is not in the guild
-            await self.send_log(
-                ctx.guild, f'🚨 {member} (`{member.id}`) was banned by {ctx.author} (`{ctx.author.id}`) for {reason}'
-            )
-            await ctx.send(f'{member} was banned.')
-        except discord.Forbidden:
+        except discord.HTTPException:
+            self.log_events.recent_bans.pop((ctx.guild.id, member.id), None)  # Ban failed, leaves are logged again
             await ctx.send('Something went wrong.')
+            return
+
+        await self.send_log(
+            ctx.guild, f'🚨 {member} (`{member.id}`) was banned by {ctx.author} (`{ctx.author.id}`) for {reason}'
+        )
+        await ctx.send(f'{member} was banned.')
 
     @commands.command(description='Unban a given user from the current guild. reason argument is optional.',
                       usage='<user-id> [reason]',
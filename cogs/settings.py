@@ -51,7 +51,7 @@ class Settings(BasicCog):
             await ctx.send(f'Timezone is set to {guild.get("timezone", "UTC")}')
             return
 
-        if timezone not in pytz.all_timezones:
+        if timezone not in pytz.all_timezones_set:
             await ctx.send('Invalid timezone. See <https://en.wikipedia.org/wiki/List_of_tz_database_time_zones#List>'
                            ' for a list of valid timezones. Timezone must be from the `TZ database name` column.')
             return
@@ -91,7 +91,7 @@ class Settings(BasicCog):
             guild = await ctx.bot.db.get_guild(ctx.guild.id)
 
         if prefix is None:
-            await ctx.send(f'Prefix is set to `{guild.get("prefix", DEFAULT_PREFIX)}`')
+            await ctx.send(f'Prefix is set to `{guild.get("prefix") or DEFAULT_PREFIX}`')
             return
 
         if len(prefix) > 3:
@@ -103,6 +103,7 @@ class Settings(BasicCog):
             return
 
         await ctx.bot.db.update_guild(ctx.guild.id, {'prefix': prefix})
+        ctx.bot.set_prefix(ctx.guild.id, prefix)
         await ctx.send(f'Prefix set to `{prefix}`')
 
 
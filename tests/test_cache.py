@@ -0,0 +1,105 @@
+import asyncio
+
+import utils.cache
+
+from utils.cache import LRUCache
+from utils.database import COLUMNS, DBConnection
+from utils.sqlite import SQLiteConnection
+
+_MISSING = object()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1  # b is now the least recently used
+    cache.set('c', 3)
+
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    assert len(cache) == 2 and cache.evictions == 1
+
+
+def test_replacing_a_value_marks_it_used():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('a', 10)
+    cache.set('c', 3)
+
+    assert cache.get('a') == 10 and 'b' not in cache
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(utils.cache, 'monotonic', clock)
+    cache = LRUCache(ttl=10)
+    cache.set('a', 1)
+
+    clock.now += 9
+    assert cache.get('a') == 1
+    assert cache.items() == [('a', 1)]
+
+    clock.now += 2
+    assert cache.get('a', _MISSING) is _MISSING
+    assert cache.items() == [] and len(cache) == 0
+
+
+def test_entries_without_ttl_never_expire(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(utils.cache, 'monotonic', clock)
+    cache = LRUCache()
+    cache.set('a', 1)
+
+    clock.now += 10 ** 9
+    assert cache.get('a') == 1
+
+
+def test_pop_and_clear():
+    cache = LRUCache()
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    assert cache.pop('a') == 1 and cache.pop('a', _MISSING) is _MISSING
+    cache.clear()
+    assert len(cache) == 0 and 'b' not in cache
+
+
+def test_none_is_cached_as_a_value():
+    cache = LRUCache()
+    cache.set('missing row', None)
+
+    assert 'missing row' in cache
+    assert cache.get('missing row', _MISSING) is None
+    assert cache.get('unknown', _MISSING) is _MISSING
+    assert cache.stats() == {'size': 1, 'max_size': 1024, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_guilds_and_users_without_a_row_are_cached():
+    async def run():
+        db = DBConnection(SQLiteConnection(':memory:', COLUMNS))
+        await db.connect()
+
+        for _ in range(3):
+            assert await db.get_guild(1) is None
+            assert await db.get_user(2) is None
+
+        stats = db.backend.stats
+        res = stats['get_guilds'].count, stats['get_users'].count
+
+        await db.get_or_create_user(2)  # A cached miss is still created
+        created = await db.get_user(2)
+        await db.close()
+        return res, created
+
+    (guild_queries, user_queries), created = asyncio.run(run())
+    assert guild_queries == 1 and user_queries == 1
+    assert created is not None and created['id'] == 2
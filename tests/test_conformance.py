@@ -0,0 +1,210 @@
+"""
+Checks that every storage backend behaves the same, each check runs on each backend.
+The benchmark's in-memory backend is held to the same behaviour.
+Postgres is only checked when ZOTE_TEST_DB_HOST points at a scratch database, it uses the other ZOTE_DB_* settings.
+Rows are written with random ids, so checks can run again against the same database.
+"""
+import asyncio
+import os
+import random
+
+import pytest
+
+from utils.database import COLUMNS, DB_NAME, DB_USER, DBException
+
+POSTGRES_HOST = os.environ.get('ZOTE_TEST_DB_HOST')
+
+
+def create(name: str):
+    if name == 'memory':
+        from benchmark import MemoryConnection
+        return MemoryConnection()
+
+    if name == 'sqlite':
+        from utils.sqlite import SQLiteConnection
+        return SQLiteConnection(':memory:', COLUMNS)  # Fresh database for every check
+
+    from utils.postgres import PostgresConnection
+    return PostgresConnection(POSTGRES_HOST, DB_NAME, DB_USER, COLUMNS)
+
+
+@pytest.fixture(params=['sqlite', 'memory', pytest.param(
+    'postgres', marks=pytest.mark.skipif(not POSTGRES_HOST, reason='ZOTE_TEST_DB_HOST is not set')
+)])
+def backend(request) -> str:
+    return request.param
+
+
+def run(backend: str, check):
+    """Run check(db, base) on a connected backend, base is a random id to build row ids from"""
+    async def main():
+        db = create(backend)
+        await db.connect()
+
+        try:
+            await check(db, random.randrange(1 << 40, 1 << 50))
+        finally:
+            await db.close()
+
+    asyncio.run(main())
+
+
+def test_connect_is_idempotent(backend):
+    async def check(db, base):
+        await db.connect()
+        assert db.is_connected
+
+    run(backend, check)
+
+
+def test_new_guild_has_defaults(backend):
+    async def check(db, base):
+        row = await db.new_guild(base)
+        assert row['id'] == base
+        assert not row['logs'] and not row['afk_channel']
+        assert row['prefix'] is None and row['timezone'] is None
+        assert not row['rolemenu']
+
+        with pytest.raises(Exception):  # Inserting a guild twice
+            await db.new_guild(base)
+
+    run(backend, check)
+
+
+def test_get_guilds_returns_existing_rows(backend):
+    async def check(db, base):
+        await db.new_guild(base)
+        await db.new_guild(base + 1)
+
+        rows = await db.get_guilds([base, base + 1, base + 2])
+        assert sorted(r['id'] for r in rows) == [base, base + 1]
+        assert await db.get_guilds([base + 3]) == []
+
+    run(backend, check)
+
+
+def test_update_returns_row(backend):
+    async def check(db, base):
+        await db.new_guild(base)
+        rolemenu = {'1': {'2': {'🍎': 3, '123456789012345678': 4}}}
+
+        row = await db.update('guilds', base, {'prefix': '!', 'rolemenu': rolemenu, 'logs': 5}, returning=True)
+        assert row['prefix'] == '!' and row['logs'] == 5
+        assert row['rolemenu'] == rolemenu  # Json columns round trip
+
+        row = (await db.get_guilds([base]))[0]
+        assert row['prefix'] == '!' and row['rolemenu'] == rolemenu
+
+        assert await db.update('guilds', base, {'timezone': 'UTC'}) is None  # Nothing returned without returning
+        assert await db.update('guilds', base + 1, {'prefix': '!'}, returning=True) is None  # Missing row
+
+    run(backend, check)
+
+
+def test_update_rejects_unknown_columns(backend):
+    async def check(db, base):
+        await db.new_guild(base)
+
+        with pytest.raises(DBException):
+            await db.update('guilds', base, {'id': 1})
+        with pytest.raises(DBException):
+            await db.update('nope', base, {'prefix': '!'})
+        with pytest.raises(DBException):
+            await db.update_many([('guilds', base, {'prefix': '?'}), ('users', base, {'x': 1})])
+
+        row = (await db.get_guilds([base]))[0]
+        assert row['prefix'] is None  # Nothing is written when an update in the batch is rejected
+
+    run(backend, check)
+
+
+def test_update_many_applies_every_update(backend):
+    async def check(db, base):
+        await db.new_guild(base)
+        await db.new_user(base)
+
+        await db.update_many([
+            ('guilds', base, {'prefix': '$'}),
+            ('guilds', base, {'timezone': 'Asia/Kolkata'}),
+            ('users', base, {'access_level': 2, 'voice': {'1': {}}}),
+            ('users', base + 1, {'access_level': 1})  # Missing rows are skipped
+        ])
+
+        guild = (await db.get_guilds([base]))[0]
+        user = (await db.get_users([base]))[0]
+        assert guild['prefix'] == '$' and guild['timezone'] == 'Asia/Kolkata'
+        assert user['access_level'] == 2 and user['voice'] == {'1': {}}
+        assert await db.get_users([base + 1]) == []  # Updates do not insert rows
+
+    run(backend, check)
+
+
+def test_get_or_create_users_returns_each_user_once(backend):
+    async def check(db, base):
+        await db.new_user(base)
+        await db.update('users', base, {'access_level': 2})
+
+        rows = await db.get_or_create_users([base, base + 1, base + 2])
+        assert sorted(r['id'] for r in rows) == [base, base + 1, base + 2]
+
+        by_id = {r['id']: r for r in rows}
+        assert by_id[base]['access_level'] == 2  # Existing users are kept
+        assert by_id[base + 1]['access_level'] == 0
+
+        rows = await db.get_users([base + 1, base + 3])
+        assert [r['id'] for r in rows] == [base + 1]  # Created users are stored, get_users does not create
+
+        with pytest.raises(Exception):  # Inserting a user twice
+            await db.new_user(base)
+
+    run(backend, check)
+
+
+def test_voice_times_accumulate(backend):
+    async def check(db, base):
+        assert await db.get_voice_time(base, base) is None
+
+        await db.add_voice_times([(base, base, 1000.0), (base, base + 1, 500.0), (base + 1, base, 9000.0)])
+        await db.add_voice_times([(base, base, 250.0), (base, base + 2, 0.0)])
+
+        row = await db.get_voice_time(base, base)
+        assert row['voice_time_spent_ms'] == 1250.0
+
+        top = await db.get_top_voice_times(base, 10)
+        assert [r['user_id'] for r in top] == [base, base + 1]  # Ordered, per guild and skips no time
+        assert top[0]['voice_time_spent_ms'] == 1250.0
+        assert len(await db.get_top_voice_times(base, 1)) == 1
+
+    run(backend, check)
+
+
+def test_load_guilds_by_shard(backend):
+    async def check(db, base):
+        ids = [base + (i << 22) for i in range(4)]  # Shards 0-3 of 4, offset by the base's own shard
+        for guild_id in ids:
+            await db.new_guild(guild_id)
+
+        assert set(ids) <= {r['id'] for r in await db.load_guilds()}
+
+        shard = (ids[0] >> 22) % 4
+        rows = {r['id'] for r in await db.load_guilds([shard], 4)}
+        assert ids[0] in rows and not set(ids[1:]) & rows
+
+    run(backend, check)
+
+
+def test_migrate_voice_times_copies_user_voice(backend):
+    async def check(db, base):
+        await db.new_user(base)
+        await db.update('users', base, {'voice': {
+            str(base): {'voice_time_spent_ms': 700, 'voice_last_joined_ms': 5},
+            str(base + 1): 'not an object'
+        }})
+
+        assert await db.migrate_voice_times() >= 1
+        row = await db.get_voice_time(base, base)
+        assert row is not None and row['voice_time_spent_ms'] == 700
+        assert await db.get_voice_time(base + 1, base) is None  # Entries that are not objects are skipped
+        assert await db.migrate_voice_times() == 0  # Running the migration again inserts nothing
+
+    run(backend, check)
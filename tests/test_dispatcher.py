@@ -0,0 +1,168 @@
+import asyncio
+import discord
+
+from utils.dispatcher import LogDispatcher, MAX_MESSAGE_LENGTH
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int = 1, delay: float = 0, fail: bool = False):
+        self.id = channel_id
+        self.delay = delay
+        self.fail = fail
+        self.sent = []
+
+    async def send(self, content: str):
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise discord.HTTPException(FakeResponse(), 'failed')
+
+        self.sent.append(content)
+
+
+class FakeResponse:
+    status = 500
+    reason = 'error'
+
+
+def test_lines_are_packed_into_one_message():
+    async def run():
+        d = LogDispatcher(window=0.05)
+        channel = FakeChannel()
+        for i in range(10):
+            assert d.put(channel, f'line {i}')
+
+        await asyncio.sleep(0.1)
+        return d, channel
+
+    d, channel = asyncio.run(run())
+    assert channel.sent == ['\n'.join(f'line {i}' for i in range(10))]
+    assert d.queued == 10 and d.sent == 1 and not d.workers
+
+
+def test_full_message_is_sent_before_the_window():
+    async def run():
+        d = LogDispatcher(window=60)
+        channel = FakeChannel()
+        for _ in range(3):
+            d.put(channel, 'x' * 999)
+
+        await asyncio.sleep(0.05)
+        return channel
+
+    channel = asyncio.run(run())
+    assert channel.sent == ['x' * 999 + '\n' + 'x' * 999, 'x' * 999]  # Two lines fill a message
+
+
+def test_long_lines_are_split():
+    async def run():
+        d = LogDispatcher(window=0.01)
+        channel = FakeChannel()
+        d.put(channel, 'a' * (MAX_MESSAGE_LENGTH * 2 + 10))
+        await d.close()
+        return channel
+
+    channel = asyncio.run(run())
+    assert [len(m) for m in channel.sent] == [MAX_MESSAGE_LENGTH, MAX_MESSAGE_LENGTH, 10]
+
+
+def test_queue_limit_counts_split_parts():
+    async def run():
+        d = LogDispatcher(window=60, max_queue=3)
+        channel = FakeChannel()
+        assert d.put(channel, 'short')
+        assert not d.put(channel, 'a' * (MAX_MESSAGE_LENGTH * 2 + 1))  # 3 parts, the queue would hold 4
+        assert d.put(channel, 'a' * (MAX_MESSAGE_LENGTH + 1))
+        assert len(d.queues[channel.id]) == 3
+        await d.close()
+        return d
+
+    d = asyncio.run(run())
+    assert d.dropped == 1
+
+
+def test_close_sends_queued_and_in_flight_lines():
+    async def run():
+        d = LogDispatcher(window=0.01)
+        channel = FakeChannel(delay=0.05)
+        d.put(channel, 'first')
+        await asyncio.sleep(0.02)  # The first batch is being sent
+        d.put(channel, 'second')
+        await d.close()
+        return d, channel
+
+    d, channel = asyncio.run(run())
+    assert channel.sent == ['first', 'second']
+    assert not d.workers
+
+
+def test_close_rejects_new_lines():
+    async def run():
+        d = LogDispatcher()
+        channel = FakeChannel()
+        await d.close()
+        return d, d.put(channel, 'late')
+
+    d, accepted = asyncio.run(run())
+    assert not accepted and d.dropped == 1 and not d.workers
+
+
+def test_close_gives_up_after_timeout():
+    async def run():
+        d = LogDispatcher(window=0.01)
+        channel = FakeChannel(delay=10)
+        d.put(channel, 'slow')
+        await asyncio.sleep(0.02)
+        await d.close(timeout=0.05)
+        return d, channel
+
+    d, channel = asyncio.run(run())
+    assert channel.sent == [] and not d.workers
+
+
+def test_failed_sends_are_logged_and_skipped():
+    async def run():
+        d = LogDispatcher(window=0.01)
+        channel = FakeChannel(fail=True)
+        d.put(channel, 'lost')
+        await d.close()
+        return d
+
+    d = asyncio.run(run())
+    assert d.sent == 0 and not d.queues
+
+
+def test_channels_are_forgotten_once_drained():
+    async def run():
+        d = LogDispatcher(window=0.01)
+        channel = FakeChannel()
+        d.put(channel, 'line')
+        await asyncio.sleep(0.05)
+        drained = (dict(d.queues), dict(d.channels), dict(d._sizes))
+
+        d.put(channel, 'again')  # Sending starts over
+        await d.close()
+        return drained, channel
+
+    drained, channel = asyncio.run(run())
+    assert drained == ({}, {}, {}) and channel.sent == ['line', 'again']
+
+
+class DeletedChannel(FakeChannel):
+    async def send(self, content: str):
+        self.sent.append(content)
+        raise discord.NotFound(FakeResponse(), 'Unknown Channel')
+
+
+def test_deleted_channels_drop_their_queue():
+    async def run():
+        d = LogDispatcher(window=0.01)
+        channel = DeletedChannel()
+        for _ in range(3):
+            d.put(channel, 'x' * 1500)  # One message each
+
+        await asyncio.sleep(0.05)
+        return d, channel
+
+    d, channel = asyncio.run(run())
+    assert len(channel.sent) == 1 and d.dropped == 2
+    assert not d.queues and not d.channels and not d.workers
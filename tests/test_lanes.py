@@ -0,0 +1,238 @@
+import asyncio
+
+from utils.lanes import EventLanes
+from utils.metrics import Metrics
+
+
+def counter(metrics: Metrics, name: str, event: str) -> float:
+    return metrics.counters.get(name, {}).get((('event', event),), 0)
+
+
+def test_events_of_a_key_run_in_order():
+    async def run():
+        lanes = EventLanes(Metrics(), lanes=2)
+        done = []
+
+        async def handler(i):
+            await asyncio.sleep(0.001 * (5 - i % 5))  # Later events would finish first if run concurrently
+            done.append(i)
+
+        for i in range(10):
+            await lanes.submit(3, 'test', handler, i)
+
+        await lanes.close()
+        return done
+
+    assert asyncio.run(run()) == list(range(10))
+
+
+def test_keys_share_lanes_by_modulo():
+    async def run():
+        lanes = EventLanes(Metrics(), lanes=4, max_depth=10)
+        gate = asyncio.Event()
+
+        async def handler():
+            await gate.wait()
+
+        for key in (1, 5, 9, 2):
+            await lanes.submit(key, 'test', handler)
+
+        await asyncio.sleep(0)
+        depths = lanes.depths()
+        gate.set()
+        await lanes.close()
+        return depths
+
+    assert asyncio.run(run()) == [0, 2, 0, 0]  # One event of each lane is running
+
+
+def test_full_lane_drops_events():
+    async def run():
+        metrics = Metrics()
+        lanes = EventLanes(metrics, lanes=1, max_depth=2)
+        gate = asyncio.Event()
+        done = []
+
+        async def handler(i):
+            await gate.wait()
+            done.append(i)
+
+        res = [await lanes.submit(1, 'test', handler, i) for i in range(2)]
+        await asyncio.sleep(0)  # First event taken off the queue
+        res += [await lanes.submit(1, 'test', handler, i) for i in range(2, 5)]
+
+        gate.set()
+        await lanes.close()
+        return res, done, counter(metrics, 'zote_event_dropped_total', 'test')
+
+    res, done, dropped = asyncio.run(run())
+    assert res == [True, True, True, False, False]
+    assert done == [0, 1, 2] and dropped == 2
+
+
+def test_full_lane_waits_for_room():
+    async def run():
+        metrics = Metrics()
+        lanes = EventLanes(metrics, lanes=1, max_depth=1, policy=EventLanes.WAIT)
+        gate = asyncio.Event()
+        done = []
+
+        async def handler(i):
+            await gate.wait()
+            done.append(i)
+
+        await lanes.submit(1, 'test', handler, 0)
+        await asyncio.sleep(0)
+        await lanes.submit(1, 'test', handler, 1)  # Fills the lane
+        waiting = asyncio.ensure_future(lanes.submit(1, 'test', handler, 2))
+        await asyncio.sleep(0.01)
+        blocked = not waiting.done()
+
+        gate.set()
+        await waiting
+        await lanes.close()
+        return blocked, done, counter(metrics, 'zote_event_dropped_total', 'test')
+
+    blocked, done, dropped = asyncio.run(run())
+    assert blocked and done == [0, 1, 2] and dropped == 0
+
+
+def test_event_policy_overrides_the_default():
+    async def run():
+        lanes = EventLanes(Metrics(), lanes=1, max_depth=1, policy=EventLanes.WAIT)
+        gate = asyncio.Event()
+
+        async def handler():
+            await gate.wait()
+
+        await lanes.submit(1, 'test', handler)
+        await asyncio.sleep(0)
+        await lanes.submit(1, 'test', handler)
+        res = await lanes.submit(1, 'test', handler, policy=EventLanes.DROP)
+
+        gate.set()
+        await lanes.close()
+        return res
+
+    assert asyncio.run(run()) is False
+
+
+def test_errors_are_counted_and_the_lane_continues():
+    async def run():
+        metrics = Metrics()
+        lanes = EventLanes(metrics, lanes=1)
+        done = []
+
+        async def fail():
+            raise RuntimeError('handler failed')
+
+        async def ok():
+            done.append(True)
+
+        await lanes.submit(1, 'fail', fail)
+        await lanes.submit(1, 'ok', ok)
+        await lanes.close()
+        return done, counter(metrics, 'zote_event_errors_total', 'fail')
+
+    done, errors = asyncio.run(run())
+    assert done == [True] and errors == 1
+
+
+def test_close_gives_up_after_timeout():
+    async def run():
+        lanes = EventLanes(Metrics(), lanes=1)
+        done = []
+
+        async def slow():
+            await asyncio.sleep(10)
+            done.append(True)
+
+        await lanes.submit(1, 'slow', slow)
+        await lanes.close(timeout=0.05)
+        return lanes, done
+
+    lanes, done = asyncio.run(run())
+    assert not done and not lanes.workers and not lanes.queues
+
+
+def test_waiting_events_keep_their_order_under_contention():
+    async def run():
+        lanes = EventLanes(Metrics(), lanes=1, max_depth=1, policy=EventLanes.DROP, max_waiting=2)
+        gate, second = asyncio.Event(), asyncio.Event()
+        done = []
+
+        async def handler(name):
+            await (gate if name == 'block' else second).wait()
+            done.append(name)
+
+        await lanes.submit(1, 'test', handler, 'block')
+        await asyncio.sleep(0)  # Running
+        await lanes.submit(1, 'test', handler, 'fill')
+        join = asyncio.ensure_future(lanes.submit(1, 'test', handler, 'voice_join', policy=EventLanes.WAIT))
+        await asyncio.sleep(0)
+        leave = asyncio.ensure_future(lanes.submit(1, 'test', handler, 'voice_leave', policy=EventLanes.WAIT))
+        await asyncio.sleep(0)
+
+        gate.set()
+        await asyncio.sleep(0)  # A slot frees up, the DROP event must not take it from the waiting events
+        update = await lanes.submit(1, 'test', handler, 'member_update')
+
+        second.set()
+        await asyncio.gather(join, leave)
+        await lanes.close()
+        return done, update
+
+    done, update = asyncio.run(run())
+    assert done == ['block', 'fill', 'voice_join', 'voice_leave'] and update is False
+
+
+def test_waiting_events_are_bounded():
+    async def run():
+        metrics = Metrics()
+        lanes = EventLanes(metrics, lanes=1, max_depth=1, policy=EventLanes.WAIT, max_waiting=1)
+        gate = asyncio.Event()
+
+        async def handler():
+            await gate.wait()
+
+        await lanes.submit(1, 'test', handler)
+        await asyncio.sleep(0)
+        await lanes.submit(1, 'test', handler)
+        waiting = asyncio.ensure_future(lanes.submit(1, 'test', handler))
+        await asyncio.sleep(0)
+        res = await lanes.submit(1, 'test', handler)  # One event is already waiting
+        depth = lanes.depths()
+
+        gate.set()
+        res = res, await waiting
+        await lanes.close()
+        return res, depth, counter(metrics, 'zote_event_dropped_total', 'test')
+
+    res, depth, dropped = asyncio.run(run())
+    assert res == (False, True) and depth == [2] and dropped == 1
+
+
+def test_cancelled_waiters_give_up_their_place():
+    async def run():
+        lanes = EventLanes(Metrics(), lanes=1, max_depth=1, policy=EventLanes.WAIT, max_waiting=2)
+        gate = asyncio.Event()
+        done = []
+
+        async def handler(i):
+            await gate.wait()
+            done.append(i)
+
+        await lanes.submit(1, 'test', handler, 0)
+        await asyncio.sleep(0)
+        await lanes.submit(1, 'test', handler, 1)
+        cancelled = asyncio.ensure_future(lanes.submit(1, 'test', handler, 2))
+        waiting = asyncio.ensure_future(lanes.submit(1, 'test', handler, 3))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+
+        gate.set()
+        await waiting
+        await lanes.close()
+        return done
+
+    assert asyncio.run(run()) == [0, 1, 3]
@@ -0,0 +1,115 @@
+import asyncio
+import pytest
+
+from utils.loader import BatchLoader
+
+
+class FakeSource:
+    def __init__(self, delay: float = 0.0, fail: bool = False):
+        self.calls = []
+        self.delay = delay
+        self.fail = fail
+
+    async def load(self, keys):
+        self.calls.append(list(keys))
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError('load failed')
+
+        return {k: k * 10 for k in keys if k != 0}  # 0 has no row
+
+
+def test_keys_requested_together_share_one_load():
+    async def run():
+        source = FakeSource()
+        loader = BatchLoader(source.load)
+        res = await asyncio.gather(*(loader.load(k) for k in (1, 2, 3, 2, 0)))
+        return source, loader, res
+
+    source, loader, res = asyncio.run(run())
+    assert res == [10, 20, 30, 20, None]
+    assert source.calls == [[1, 2, 3, 0]]
+    assert loader.stats()['requests'] == 5 and loader.stats()['deduplicated'] == 1
+
+
+def test_requests_while_loading_are_deduplicated():
+    async def run():
+        source = FakeSource(delay=0.02)
+        loader = BatchLoader(source.load)
+        first = asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0.01)  # Load running
+        second = await loader.load(1)
+        return source, await first, second
+
+    source, first, second = asyncio.run(run())
+    assert first == second == 10 and source.calls == [[1]]
+
+
+def test_batches_are_limited():
+    async def run():
+        source = FakeSource()
+        loader = BatchLoader(source.load, max_batch=2)
+        await asyncio.gather(*(loader.load(k) for k in range(1, 6)))
+        return source
+
+    assert asyncio.run(run()).calls == [[1, 2], [3, 4], [5]]
+
+
+def test_errors_reach_every_caller():
+    async def run():
+        loader = BatchLoader(FakeSource(fail=True).load)
+        res = await asyncio.gather(loader.load(1), loader.load(1), return_exceptions=True)
+        with pytest.raises(RuntimeError):
+            await loader.load(1)  # Not cached, loaded again
+
+        return res
+
+    assert all(isinstance(r, RuntimeError) for r in asyncio.run(run()))
+
+
+def test_cancelling_one_caller_does_not_cancel_the_others():
+    async def run():
+        source = FakeSource(delay=0.02)
+        loader = BatchLoader(source.load)
+        cancelled = asyncio.ensure_future(loader.load(1))
+        waiting = asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0.005)
+        cancelled.cancel()
+        return await waiting, cancelled.cancelled(), source
+
+    res, cancelled, source = asyncio.run(run())
+    assert res == 10 and cancelled and source.calls == [[1]]
+
+
+def test_cancelled_callers_leave_no_pending_keys():
+    async def run():
+        loader = BatchLoader(FakeSource(delay=0.01, fail=True).load)
+        request = asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0)
+        request.cancel()
+        await asyncio.sleep(0.03)  # Failed with nobody waiting
+        return loader
+
+    assert not asyncio.run(run())._futures
+
+
+def test_cancelled_batches_finish_their_futures():
+    async def run():
+        source = FakeSource(delay=10)
+        loader = BatchLoader(source.load)
+        request = asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0.01)  # Batch running
+
+        batch = [t for t in asyncio.all_tasks() if t not in (request, asyncio.current_task())]
+        for task in batch:  # As on shutdown
+            task.cancel()
+        await asyncio.sleep(0)
+
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(request, 1)
+
+        source.delay = 0
+        return loader._futures.copy(), await asyncio.wait_for(loader.load(1), 1)
+
+    futures, res = asyncio.run(run())
+    assert not futures and res == 10
@@ -0,0 +1,108 @@
+from utils.messages import MessageStore, StoredMessage
+
+
+def message(message_id: int, channel_id: int = 1, content: str = 'hello', attachments=()) -> StoredMessage:
+    return StoredMessage(message_id, channel_id, 100, 'user#0001', content, tuple(attachments))
+
+
+def check_bytes(store: MessageStore):
+    assert store.bytes == sum(m.size for ring in store.channels.values() for m in ring.values())
+    assert len(store) == sum(len(ring) for ring in store.channels.values())
+
+
+def test_messages_are_kept_per_channel():
+    store = MessageStore()
+    store.add(message(1, channel_id=1))
+    store.add(message(2, channel_id=2))
+
+    assert store.get(1, 1).id == 1
+    assert store.get(2, 1) is None  # Wrong channel
+    assert store.stats()['channels'] == 2 and len(store) == 2
+    check_bytes(store)
+
+
+def test_each_channel_keeps_its_newest_messages():
+    store = MessageStore(per_channel=3)
+    for i in range(5):
+        store.add(message(i, channel_id=1))
+    store.add(message(10, channel_id=2))
+
+    assert list(store.channels[1]) == [2, 3, 4]
+    assert store.get(2, 10) is not None and store.evicted == 2
+    check_bytes(store)
+
+
+def test_byte_budget_evicts_oldest_messages_of_any_channel():
+    size = message(0).size
+    store = MessageStore(max_bytes=size * 3)
+    for i in range(5):
+        store.add(message(i, channel_id=i % 2))
+
+    assert sorted(store._order) == [2, 3, 4]
+    assert store.bytes <= store.max_bytes and store.evicted == 2
+    check_bytes(store)
+
+
+def test_channels_are_dropped_once_empty():
+    size = message(0).size
+    store = MessageStore(max_bytes=size * 2)
+    store.add(message(1, channel_id=1))
+    store.add(message(2, channel_id=2))
+    store.add(message(3, channel_id=2))
+
+    assert 1 not in store.channels
+    check_bytes(store)
+
+
+def test_adding_a_message_again_replaces_it():
+    store = MessageStore()
+    store.add(message(1, content='first'))
+    store.add(message(1, content='second'))
+
+    assert len(store) == 1 and store.get(1, 1).content == 'second'
+    check_bytes(store)
+
+
+def test_edits_update_content_and_size():
+    store = MessageStore()
+    stored = message(1, content='short')
+    store.add(stored)
+    store.edit(stored, 'a much longer message ' * 20, ('https://cdn/a.png',))
+
+    assert store.get(1, 1).content.startswith('a much longer')
+    assert store.get(1, 1).attachments == ('https://cdn/a.png',)
+    check_bytes(store)
+
+
+def test_edits_past_the_budget_evict_old_messages():
+    size = message(0).size
+    store = MessageStore(max_bytes=size * 2 + 10)
+    store.add(message(1))
+    stored = message(2)
+    store.add(stored)
+    store.edit(stored, 'x' * 100)
+
+    assert store.get(1, 1) is None and store.get(1, 2) is not None
+    check_bytes(store)
+
+
+def test_pop_removes_a_message():
+    store = MessageStore()
+    store.add(message(1))
+
+    assert store.pop(1, 1).id == 1
+    assert store.pop(1, 1) is None
+    assert len(store) == 0 and store.bytes == 0 and not store.channels
+    assert store.stats()['hits'] == 1 and store.stats()['misses'] == 1
+
+
+def test_remove_channel():
+    store = MessageStore()
+    for i in range(3):
+        store.add(message(i, channel_id=1))
+    store.add(message(10, channel_id=2))
+    store.remove_channel(1)
+    store.remove_channel(3)  # Unknown channel
+
+    assert len(store) == 1 and list(store.channels) == [2]
+    check_bytes(store)
@@ -0,0 +1,47 @@
+import discord
+
+from utils.rolemenu import RoleMenuIndex
+
+MENU = {'10': {'100': {'👍': '1000', '555': '1001'}}}  # channel -> message -> emoji -> role
+
+
+def emoji(name: str, emoji_id: int = None):
+    return discord.PartialEmoji(name=name, id=emoji_id)
+
+
+def test_roles_are_found_by_message_and_emoji():
+    index = RoleMenuIndex()
+    index.set_guild(1, MENU)
+
+    assert index.get_role(1, 10, 100, emoji('👍')) == 1000
+    assert index.get_role(1, 10, 100, emoji('custom', 555)) == 1001
+    assert index.get_role(1, 10, 100, emoji('👎')) is None
+    assert 1 in index and 2 not in index
+
+
+def test_reactions_only_match_their_own_guild_and_channel():
+    index = RoleMenuIndex()
+    index.set_guild(1, MENU)
+
+    assert index.get_role(2, 10, 100, emoji('👍')) is None
+    assert index.get_role(1, 11, 100, emoji('👍')) is None
+
+
+def test_removing_a_guild_keeps_other_guilds_entries():
+    index = RoleMenuIndex()
+    index.set_guild(1, MENU)
+    index.set_guild(2, {'20': {'100': {'👍': '2000'}}})  # Same message id and emoji
+    index.remove_guild(1)
+
+    assert index.get_role(1, 10, 100, emoji('👍')) is None
+    assert index.get_role(2, 20, 100, emoji('👍')) == 2000
+
+
+def test_set_guild_replaces_its_entries():
+    index = RoleMenuIndex()
+    index.set_guild(1, MENU)
+    index.set_guild(1, {'10': {'101': {'👍': '1002'}}})
+
+    assert index.get_role(1, 10, 100, emoji('👍')) is None
+    assert index.get_role(1, 10, 101, emoji('👍')) == 1002
+    assert len(index.entries) == 1
@@ -0,0 +1,172 @@
+import asyncio
+import discord
+
+from utils.roles import RoleMutationQueue
+
+
+class FakeRole:
+    def __init__(self, role_id: int, guild):
+        self.id = role_id
+        self.guild = guild
+
+    def is_default(self) -> bool:
+        return self.id == self.guild.id
+
+
+class FakeMember:
+    def __init__(self, member_id: int, guild, role_ids=()):
+        self.id = member_id
+        self.guild = guild
+        self.roles = [guild.roles[guild.id]] + [guild.roles[r] for r in role_ids]
+        self.edits = []
+        self.fail = False
+
+    async def edit(self, roles):
+        if self.fail:
+            raise discord.HTTPException(FakeResponse(), 'failed')
+
+        self.edits.append(sorted(r.id for r in roles))
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int = 1):
+        self.id = guild_id
+        self.roles = {r: FakeRole(r, self) for r in (guild_id, 10, 11, 12, 13)}
+        self.members = {}
+
+    def get_member(self, member_id: int):
+        return self.members.get(member_id)
+
+
+class FakeHTTP:
+    def __init__(self):
+        self.calls = []
+
+    async def add_role(self, guild_id, user_id, role_id):
+        self.calls.append(('add', guild_id, user_id, role_id))
+
+    async def remove_role(self, guild_id, user_id, role_id):
+        self.calls.append(('remove', guild_id, user_id, role_id))
+
+
+class FakeResponse:
+    status = 500
+    reason = 'error'
+
+
+def setup(role_ids=(), cached=True):
+    guild = FakeGuild()
+    member = FakeMember(100, guild, role_ids)
+    if cached:
+        guild.members[member.id] = member
+
+    return RoleMutationQueue(FakeHTTP(), debounce=0.01), guild, member
+
+
+def test_changes_are_merged_into_one_edit():
+    async def run():
+        queue, guild, member = setup(role_ids=(10,))
+        queue.add(member, guild.roles[11])
+        queue.add(member, guild.roles[12])
+        queue.remove(member, guild.roles[10])
+        await asyncio.sleep(0.05)
+        return queue, member
+
+    queue, member = asyncio.run(run())
+    assert member.edits == [[11, 12]] and not queue.http.calls
+    assert queue.stats() == {'pending': 0, 'requested': 3, 'coalesced': 2, 'skipped': 0, 'applied': 1, 'failed': 0}
+
+
+def test_toggles_that_cancel_out_are_skipped():
+    async def run():
+        queue, guild, member = setup()
+        queue.add(member, guild.roles[11])
+        queue.remove(member, guild.roles[11])
+        await asyncio.sleep(0.05)
+        return queue, member
+
+    queue, member = asyncio.run(run())
+    assert not member.edits and not queue.http.calls and queue.skipped == 1
+
+
+def test_roles_changed_during_the_debounce_are_kept():
+    async def run():
+        queue, guild, member = setup(role_ids=(10,))
+        queue.add(member, guild.roles[11])
+        queue.add(member, guild.roles[12])
+        member.roles.append(guild.roles[13])  # Given by a moderator before the edit is sent
+        await asyncio.sleep(0.05)
+        return member
+
+    assert asyncio.run(run()).edits == [[10, 11, 12, 13]]
+
+
+def test_single_change_uses_a_role_request():
+    async def run():
+        queue, guild, member = setup(role_ids=(10, 11))
+        queue.add(member, guild.roles[12])
+        queue.add(member, guild.roles[10])  # Already has it
+        await asyncio.sleep(0.05)
+        return queue, member
+
+    queue, member = asyncio.run(run())
+    assert not member.edits and queue.http.calls == [('add', 1, 100, 12)]
+
+
+def test_members_not_cached_get_one_request_per_role():
+    async def run():
+        queue, guild, member = setup(cached=False)
+        queue.add(discord.Object(id=member.id), guild.roles[11])
+        queue.remove(discord.Object(id=member.id), guild.roles[12])
+        await asyncio.sleep(0.05)
+        return queue
+
+    queue = asyncio.run(run())
+    assert queue.http.calls == [('add', 1, 100, 11), ('remove', 1, 100, 12)] and queue.applied == 2
+
+
+def test_changes_queued_while_editing_are_applied_after():
+    async def run():
+        queue, guild, member = setup()
+        queue.add(member, guild.roles[11])
+        queue.add(member, guild.roles[12])
+        await asyncio.sleep(0.015)  # First edit sent
+        member.roles += [guild.roles[11], guild.roles[12]]
+        queue.remove(member, guild.roles[11])
+        queue.remove(member, guild.roles[12])
+        await asyncio.sleep(0.05)
+        return queue, member
+
+    queue, member = asyncio.run(run())
+    assert member.edits == [[11, 12], []] and not queue.tasks
+
+
+def test_failed_edits_are_counted():
+    async def run():
+        queue, guild, member = setup()
+        member.fail = True
+        queue.add(member, guild.roles[11])
+        queue.add(member, guild.roles[12])
+        await asyncio.sleep(0.05)
+        return queue
+
+    queue = asyncio.run(run())
+    assert queue.failed == 1 and queue.applied == 0 and not queue.tasks
+
+
+def test_close_cancels_waiting_edits():
+    async def run():
+        queue, guild, member = setup()
+        queue.add(member, guild.roles[11])
+        queue.add(member, guild.roles[12])
+        tasks = list(queue.tasks.values())
+        await asyncio.sleep(0)
+        queue.close()
+
+        queue.add(member, guild.roles[13])  # Queued again after closing, not touched by the cancelled task
+        await asyncio.sleep(0.05)
+        return queue, member, tasks
+
+    queue, member, tasks = asyncio.run(run())
+    assert all(t.cancelled() for t in tasks)
+    assert not member.edits and queue.http.calls == [('add', 1, 100, 13)] and not queue.tasks
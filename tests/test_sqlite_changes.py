@@ -0,0 +1,90 @@
+import asyncio
+import sqlite3
+
+import utils.sqlite
+
+from utils.database import COLUMNS
+from utils.sqlite import SQLiteConnection
+
+
+def listen(path, action):
+    """Run action(writer) while a second connection to the same file listens, returns the changes it saw"""
+    async def run():
+        reader, writer = SQLiteConnection(path, COLUMNS), SQLiteConnection(path, COLUMNS)
+        await reader.connect()
+        await writer.connect()
+        await writer.get_or_create_users([1, 2])
+        await writer.new_guild(10)
+
+        changes = []
+        listening = asyncio.Event()
+        task = asyncio.ensure_future(reader._listen_once(lambda *c: changes.append(c), listening.set))
+        await listening.wait()
+
+        await action(writer)
+        await asyncio.sleep(0.05)  # A few polls
+
+        task.cancel()
+        await reader.close()
+        await writer.close()
+        return changes
+
+    return asyncio.run(run())
+
+
+def test_changed_rows_are_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.sqlite, 'POLL_INTERVAL', 0.01)
+
+    async def action(writer):
+        await writer.update('users', 1, {'access_level': 2})
+        await writer.update_many([('guilds', 10, {'prefix': '?'}), ('users', 2, {'access_level': 1})])
+        await writer.get_or_create_users([2, 3])  # Only 3 is new
+
+    changes = listen(str(tmp_path / 'zote.db'), action)
+    assert sorted(changes) == [('guilds', 10), ('users', 1), ('users', 2), ('users', 3)]
+
+
+def test_voice_time_writes_do_not_invalidate_caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.sqlite, 'POLL_INTERVAL', 0.01)
+
+    async def action(writer):
+        await writer.add_voice_times([(10, 1, 1000.0)])
+
+    changes = listen(str(tmp_path / 'zote.db'), action)
+    assert set(changes) <= {('voice_times', None)}
+
+
+def test_own_changes_are_not_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.sqlite, 'POLL_INTERVAL', 0.01)
+    path = str(tmp_path / 'zote.db')
+
+    async def run():
+        conn = SQLiteConnection(path, COLUMNS)
+        await conn.connect()
+        await conn.new_guild(10)
+
+        changes = []
+        listening = asyncio.Event()
+        task = asyncio.ensure_future(conn._listen_once(lambda *c: changes.append(c), listening.set))
+        await listening.wait()
+        await conn.update('guilds', 10, {'prefix': '?'})
+        await asyncio.sleep(0.05)
+
+        task.cancel()
+        await conn.close()
+        return changes
+
+    assert asyncio.run(run()) == []
+
+
+def test_changes_by_hand_refresh_everything(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.sqlite, 'POLL_INTERVAL', 0.01)
+    path = str(tmp_path / 'zote.db')
+
+    async def action(_writer):
+        conn = sqlite3.connect(path)
+        conn.execute("UPDATE guilds SET prefix = '!' WHERE id = 10")
+        conn.commit()
+        conn.close()
+
+    assert (None, None) in listen(path, action)
@@ -0,0 +1,51 @@
+import pytz
+
+from datetime import datetime
+from utils.timefmt import TimeFormatter, get_formatter
+
+
+def unix(year, month, day, hour, minute=0, second=0) -> float:
+    return pytz.utc.localize(datetime(year, month, day, hour, minute, second)).timestamp()
+
+
+def expected(timezone: str, now: float) -> str:
+    return datetime.fromtimestamp(now, pytz.timezone(timezone)).strftime('%H:%M:%S')
+
+
+def test_utc():
+    assert TimeFormatter().format(unix(2021, 6, 1, 12, 34, 56)) == '`[12:34:56 UTC+0]`'
+
+
+def test_half_hour_offsets():
+    now = unix(2021, 6, 1, 20, 0, 5)
+    assert TimeFormatter('Asia/Kolkata').format(now) == '`[01:30:05 UTC+5:30]`'
+    assert TimeFormatter('Asia/Kathmandu').format(now) == '`[01:45:05 UTC+5:45]`'
+    assert TimeFormatter('America/St_Johns').format(unix(2021, 1, 1, 12)) == '`[08:30:00 UTC-3:30]`'
+
+
+def test_negative_offsets_wrap_around_midnight():
+    assert TimeFormatter('America/Los_Angeles').format(unix(2021, 1, 1, 3)) == '`[19:00:00 UTC-8]`'
+
+
+def test_offset_follows_daylight_saving_transitions():
+    f = TimeFormatter('Europe/Berlin')
+    before = unix(2021, 3, 28, 0, 59, 59)  # Clocks go forward at 01:00 utc
+    after = unix(2021, 3, 28, 1, 0, 0)
+
+    assert f.format(before) == '`[01:59:59 UTC+1]`'
+    assert f.format(after) == '`[03:00:00 UTC+2]`'
+    assert f.format(unix(2021, 10, 31, 1, 0, 0)) == '`[02:00:00 UTC+1]`'
+
+
+def test_matches_pytz_over_a_year():
+    for timezone in ('Asia/Kolkata', 'America/New_York', 'Australia/Lord_Howe', 'Pacific/Chatham'):
+        f = TimeFormatter(timezone)
+        now = unix(2021, 1, 1, 0)
+        for _ in range(365 * 4):  # Every 6 hours, in order as logs are written
+            assert f.format(now)[2:10] == expected(timezone, now), (timezone, now)
+            now += 6 * 3600 + 17
+
+
+def test_formatters_are_shared_per_timezone():
+    assert get_formatter('Asia/Kolkata') is get_formatter('Asia/Kolkata')
+    assert get_formatter('Asia/Kolkata') is not get_formatter('UTC')
@@ -0,0 +1,230 @@
+import asyncio
+import pytest
+
+from utils.writebehind import WriteBuffer
+
+
+class FakeBackend:
+    def __init__(self):
+        self.rows = {}  # (table, id) -> row
+        self.batches = []
+        self.fail = 0  # Number of writes that fail
+        self.delay = 0.0
+        self.writing = asyncio.Event()
+
+    def check_update(self, table: str, data: dict):
+        if table not in ('users', 'guilds'):
+            raise ValueError(table)
+
+    async def update_many(self, updates):
+        self.writing.set()
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError('write failed')
+
+        self.batches.append(updates)
+        for table, row_id, data in updates:
+            self.rows.setdefault((table, row_id), {}).update(data)
+
+
+class FakeDB:
+    def __init__(self):
+        self.backend = FakeBackend()
+
+
+def test_updates_are_merged_per_row():
+    async def run():
+        db = FakeDB()
+        buffer = WriteBuffer(db, interval=0.01)
+        buffer.put('users', 1, {'a': 1})
+        buffer.put('users', 1, {'b': 2})
+        buffer.put('users', 2, {'a': 3})
+        buffer.put('guilds', 1, {'a': 4})
+        await asyncio.sleep(0.05)
+        return db, buffer
+
+    db, buffer = asyncio.run(run())
+    assert len(db.backend.batches) == 1
+    assert db.backend.rows == {('users', 1): {'a': 1, 'b': 2}, ('users', 2): {'a': 3}, ('guilds', 1): {'a': 4}}
+    assert buffer.stats()['rows_written'] == 3 and buffer.stats()['updates'] == 4 and not buffer.pending
+
+
+def test_unknown_tables_are_rejected_before_buffering():
+    async def run():
+        buffer = WriteBuffer(FakeDB())
+        with pytest.raises(ValueError):
+            buffer.put('nope', 1, {'a': 1})
+
+        return buffer
+
+    assert not asyncio.run(run()).pending
+
+
+def test_max_rows_flushes_before_the_interval():
+    async def run():
+        db = FakeDB()
+        buffer = WriteBuffer(db, interval=60, max_rows=2)
+        buffer.put('users', 1, {'a': 1})
+        buffer.put('users', 2, {'a': 1})
+        await asyncio.sleep(0.02)
+        return db
+
+    assert len(asyncio.run(run()).backend.batches) == 1
+
+
+def test_reads_see_buffered_updates():
+    async def run():
+        buffer = WriteBuffer(FakeDB(), interval=60)
+        buffer.put('users', 1, {'a': 2})
+        row = buffer.overlay('users', 1, {'id': 1, 'a': 1, 'b': 1})
+        other = buffer.overlay('users', 2, {'id': 2, 'a': 1})
+        await buffer.close()
+        return row, other
+
+    row, other = asyncio.run(run())
+    assert row == {'id': 1, 'a': 2, 'b': 1}
+    assert other == {'id': 2, 'a': 1}
+
+
+def test_reads_see_updates_being_written():
+    async def run():
+        db = FakeDB()
+        db.backend.delay = 0.05
+        buffer = WriteBuffer(db, interval=60)
+        buffer.put('users', 1, {'a': 2, 'b': 2})
+
+        flush = asyncio.create_task(buffer.flush())
+        await db.backend.writing.wait()  # Not committed yet
+        buffer.put('users', 1, {'b': 3})
+        during = buffer.overlay('users', 1, {'id': 1, 'a': 1, 'b': 1})
+
+        await flush
+        after = buffer.get('users', 1)
+        await buffer.close()
+        return during, after
+
+    during, after = asyncio.run(run())
+    assert during == {'id': 1, 'a': 2, 'b': 3}  # Written batch, newer buffered update on top
+    assert after == {'b': 3}
+
+
+def test_reads_started_before_a_commit_see_it():
+    async def run():
+        db = FakeDB()
+        buffer = WriteBuffer(db, interval=60)
+        buffer.put('users', 1, {'a': 2})
+
+        with buffer.reading() as since:
+            old_row = {'id': 1, 'a': 1}  # Read before the flush committed, returned after it
+            await buffer.flush()
+            assert not buffer.pending and not buffer.flushing
+            row = buffer.overlay('users', 1, old_row, since)
+
+        with buffer.reading() as since:  # Started after the commit
+            other_process = buffer.overlay('users', 1, {'id': 1, 'a': 5}, since)
+
+        await buffer.close()
+        return row, other_process, buffer
+
+    row, other_process, buffer = asyncio.run(run())
+    assert row == {'id': 1, 'a': 2}
+    assert other_process == {'id': 1, 'a': 5}  # Changed by someone else after the commit, kept
+    assert not buffer.committed and not buffer.readers
+
+
+def test_committed_batches_are_not_kept_without_reads():
+    async def run():
+        buffer = WriteBuffer(FakeDB(), interval=60)
+        buffer.put('users', 1, {'a': 2})
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(run())
+    assert buffer.generation == 1 and not buffer.committed
+
+
+def test_failed_flush_is_retried():
+    async def run():
+        db = FakeDB()
+        db.backend.fail = 1
+        buffer = WriteBuffer(db, interval=0.01)
+        buffer.put('users', 1, {'a': 1})
+        await asyncio.sleep(0.02)
+        failed = dict(buffer.pending)
+
+        await asyncio.sleep(0.05)  # Retried without another put
+        return db, buffer, failed
+
+    db, buffer, failed = asyncio.run(run())
+    assert failed == {('users', 1): {'a': 1}}
+    assert db.backend.rows == {('users', 1): {'a': 1}} and not buffer.pending
+
+
+def test_failing_batches_back_off_and_are_dropped():
+    async def run():
+        db = FakeDB()
+        db.backend.fail = 10 ** 6
+        buffer = WriteBuffer(db, interval=0.001, max_retries=3, max_retry_delay=0.004)
+        buffer.put('users', 1, {'a': 1})
+        await asyncio.sleep(0.1)
+
+        tries = 10 ** 6 - db.backend.fail
+        pending = dict(buffer.pending)
+        buffer.put('users', 2, {'a': 1})  # Newer updates are written once the database is back
+        db.backend.fail = 0
+        await buffer.close()
+        return db, buffer, tries, pending
+
+    db, buffer, tries, pending = asyncio.run(run())
+    assert tries == 4 and not pending  # First write and 3 retries, then nothing is left to retry
+    assert buffer.stats()['rows_dropped'] == 1 and buffer.stats()['failures'] == 0
+    assert db.backend.rows == {('users', 2): {'a': 1}}
+
+
+def test_close_cuts_a_retry_short():
+    async def run():
+        db = FakeDB()
+        db.backend.fail = 1
+        buffer = WriteBuffer(db, interval=60, max_rows=1)  # Flushed right away, retried after 60s
+        buffer.put('users', 1, {'a': 1})
+        await asyncio.sleep(0.02)  # Failed, retrying later
+
+        await asyncio.wait_for(buffer.close(), 1)
+        return db
+
+    assert asyncio.run(run()).backend.rows == {('users', 1): {'a': 1}}
+
+
+def test_failed_flush_keeps_newer_updates():
+    async def run():
+        db = FakeDB()
+        db.backend.fail = 1
+        db.backend.delay = 0.02
+        buffer = WriteBuffer(db, interval=60)
+        buffer.put('users', 1, {'a': 1, 'b': 1})
+
+        flush = asyncio.create_task(buffer.flush())
+        await db.backend.writing.wait()
+        buffer.put('users', 1, {'b': 2})
+        await flush
+
+        pending = dict(buffer.pending)
+        await buffer.close()
+        return db, pending
+
+    db, pending = asyncio.run(run())
+    assert pending == {('users', 1): {'a': 1, 'b': 2}}
+    assert db.backend.rows == {('users', 1): {'a': 1, 'b': 2}}
+
+
+def test_close_writes_everything():
+    async def run():
+        db = FakeDB()
+        buffer = WriteBuffer(db, interval=60)
+        buffer.put('guilds', 5, {'a': 1})
+        await buffer.close()
+        return db, buffer
+
+    db, buffer = asyncio.run(run())
+    assert db.backend.rows == {('guilds', 5): {'a': 1}} and buffer._task is None
@@ -1,3 +1,16 @@
 from .utils import aloc, escape_user
-from .database import DBConnection
-from .checks import access_level, PermissionDenied, access_level_check, AccessLevel
+from .cache import LRUCache
+from .database import BaseDBConnection, DBConnection, create_backend
+from .checks import access_level, PermissionDenied, access_level_check, get_author_data, AccessLevel
+from .voice import VoiceTracker
+from .dispatcher import LogDispatcher
+from .timefmt import TimeFormatter, get_formatter
+from .rolemenu import RoleMenuIndex, emoji_key
+from .roles import RoleMutationQueue
+from .writebehind import WriteBuffer
+from .loader import BatchLoader
+from .metrics import Histogram, Metrics, MetricsServer, timed_event
+from .lanes import EventLanes
+from .profiles import Profile, cog_requires, get_profile, estimate_cache_memory
+from .startup import StartupTimer, load_order
+from .messages import MessageStore, StoredMessage
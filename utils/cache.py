@@ -0,0 +1,81 @@
+import typing
+
+from collections import OrderedDict
+from time import monotonic
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache with an optional per-entry time to live.
+    """
+    def __init__(self, max_size: int = 1024, ttl: typing.Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl  # Seconds before an entry expires, None to never expire
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key) -> bool:
+        return self._lookup(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _lookup(self, key) -> typing.Optional[tuple]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+
+        if entry[0] is not None and entry[0] < monotonic():  # Entry has expired
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)  # Mark as most recently used
+        return entry
+
+    def get(self, key, default=None):
+        """Get a value from the cache, default if missing or expired"""
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        """Add or replace a value in the cache"""
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:  # Evict the least recently used entries
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove a value from the cache"""
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def items(self) -> typing.List[tuple]:
+        """Get every (key, value) pair that has not expired"""
+        now = monotonic()
+        return [(k, v) for k, (e, v) in self._data.items() if e is None or e >= now]
+
+    def stats(self) -> dict:
+        """Get the cache size and hit, miss and eviction counts"""
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def clear(self):
+        """Remove every value from the cache"""
+        self._data.clear()
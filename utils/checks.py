@@ -19,11 +19,20 @@ def access_level(min_level: int):  # decorator
     return commands.check(check)
 
 
+async def get_author_data(ctx):
+    """Get the database entry for the invoking user, resolved once per invocation"""
+    try:
+        return ctx.author_data  # Already resolved by an earlier check on this context
+    except AttributeError:
+        pass
+
+    user = await ctx.bot.db.get_or_create_user(ctx.author.id)  # New users are added to the database
+    ctx.author_data = user
+    return user
+
+
 async def access_level_check(ctx, min_level: int):  # can be called anywhere
-    user = await ctx.bot.db.get_user(ctx.author.id)
-    if not user:  # User not in database
-        await ctx.bot.db.new_user(ctx.author.id)
-        return AccessLevel.USER >= min_level
+    user = await get_author_data(ctx)
 
     if user['access_level'] == AccessLevel.BLACKLISTED:
         raise PermissionDenied(
@@ -1,23 +1,312 @@
-import asyncpg
+import asyncio
+import contextlib
+import functools
 import json
 import logging
 import os
 import typing
-import pytz
 
-from datetime import datetime
+from .cache import LRUCache
+from .loader import BatchLoader
+from .metrics import Histogram
+from .rolemenu import RoleMenuIndex
+from .timefmt import get_formatter
+from .writebehind import WriteBuffer
+from collections import deque
+from time import perf_counter, time
+
+try:
+    import orjson
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    json_loads = orjson.loads
+except ImportError:  # orjson is optional, fall back to the standard library
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+# Backend, see create_backend
+DB_BACKEND = os.environ.get('ZOTE_DB_BACKEND', 'postgres')  # postgres or sqlite
+DB_HOST = os.environ.get('ZOTE_DB_HOST', '192.168.0.129')
+DB_NAME = os.environ.get('ZOTE_DB_NAME', 'wynndb')
+DB_USER = os.environ.get('ZOTE_DB_USER', 'zote')
+SQLITE_PATH = os.environ.get('ZOTE_SQLITE_PATH', 'zote.db')  # ':memory:' for a database that is not kept
+SLOW_QUERY_MS = float(os.environ.get('ZOTE_DB_SLOW_QUERY_MS', '250'))  # Calls taking longer are logged
+
+GUILD_CACHE_SIZE = int(os.environ.get('ZOTE_GUILD_CACHE_SIZE', '10000'))  # Max guilds kept in memory
+USER_CACHE_SIZE = int(os.environ.get('ZOTE_USER_CACHE_SIZE', '1024'))  # Max users kept in memory
+USER_CACHE_TTL = float(os.environ.get('ZOTE_USER_CACHE_TTL', '300'))  # Seconds before a cached user is refetched
+WRITE_BEHIND = os.environ.get('ZOTE_WRITE_BEHIND', '0') == '1'  # Buffer update_user and update_guild writes
+WRITE_BEHIND_INTERVAL = float(os.environ.get('ZOTE_WRITE_BEHIND_INTERVAL_MS', '500')) / 1000
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get('ZOTE_WRITE_BEHIND_MAX_ROWS', '100'))  # Buffered rows that force a flush
+WRITE_BEHIND_MAX_RETRIES = int(os.environ.get('ZOTE_WRITE_BEHIND_MAX_RETRIES', '10'))  # Failed flushes, then dropped
+LISTEN = os.environ.get('ZOTE_DB_LISTEN', '1') == '1'  # Follow changes made by other processes, see start_listener
+LISTEN_RETRY_MAX = float(os.environ.get('ZOTE_DB_LISTEN_RETRY_MAX', '60'))  # Max seconds between reconnect attempts
+
+COLUMNS = {  # Columns update_guild and update_user may set
+    'guilds': ('prefix', 'logs', 'timezone', 'afk_channel', 'rolemenu'),
+    'users': ('access_level', 'voice')
+}
+
+_MISSING = object()  # Sentinel for cache misses, None is a valid cached value
+
+
+def timed(func):
+    """Record latency and in-flight count of a database method, and log it if slow"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        self.in_flight[name] = self.in_flight.get(name, 0) + 1
+        start = perf_counter()
+
+        try:
+            return await func(self, *args, **kwargs)
+        finally:
+            ms = (perf_counter() - start) * 1000
+            self.in_flight[name] -= 1
+            (self.latency.get(name) or self.latency.setdefault(name, Histogram())).observe(ms)
+
+            if ms >= SLOW_QUERY_MS:
+                self.slow_queries.append((time(), name, ms))
+                self.logger.warning(f'Slow database call {name} took {ms:.1f}ms')
+
+    return wrapper
 
 
 class DBException(Exception):
     pass
 
 
+class StatementStats:
+    __slots__ = ('count', 'errors', 'total_ms', 'max_ms')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+
 class BaseDBConnection:
-    def __init__(self, host, db_name, user):
-        self.pool: typing.Optional[asyncpg.pool.Pool] = None
-        self.host = host
-        self.db_name = db_name
-        self.user = user
+    """
+    Storage backend used by DBConnection. Rows are returned as dicts with json columns decoded.
+    Implementations must behave the same, see tests/test_conformance.py.
+    """
+    def __init__(self, columns: typing.Dict[str, typing.Iterable[str]]):
+        self.columns = {table: frozenset(c) for table, c in columns.items()}  # Columns that can be updated
+        self.stats: typing.Dict[str, StatementStats] = {}  # statement -> execution counts and timings
+        self.acquire_wait = Histogram()  # ms waited for a connection
+        self.logger = logging.getLogger('utils.database')
+        self.listener_connected = False  # The change listener is connected, see start_listener
+        self._listener: typing.Optional[asyncio.Task] = None
+
+    def check_update(self, table: str, data: typing.Iterable[str]) -> typing.Tuple[str, ...]:
+        """Get the sorted columns of an update, raises DBException for unknown tables and columns"""
+        if (allowed := self.columns.get(table)) is None:
+            raise DBException(f'Unknown table {table}')
+
+        columns = tuple(sorted(data))
+        if unknown := set(columns) - allowed:
+            raise DBException(f'Unknown columns for {table}: {", ".join(sorted(unknown))}')
+
+        return columns
+
+    async def connect(self):
+        """Connect and create missing tables, does nothing if already connected"""
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    @property
+    def is_connected(self) -> bool:
+        raise NotImplementedError
+
+    def pool_stats(self) -> typing.Optional[dict]:
+        """Get the connection pool size, idle, min and max, None if there is no pool"""
+        return None
+
+    # Change notifications
+
+    @property
+    def can_listen(self) -> bool:
+        """The backend can see rows changed by other processes"""
+        return False
+
+    async def _listen_once(self, callback: typing.Callable[[str, typing.Optional[int]], None],
+                           ready: typing.Callable[[], None]):
+        """
+        Open a listener calling callback(table, row_id) for rows changed by other processes, row_id is None when
+        every row of the table may have changed. Calls ready() once listening, returns or raises when it is lost.
+        """
+        raise NotImplementedError
+
+    def start_listener(self, callback: typing.Callable[[typing.Optional[str], typing.Optional[int]], None]) -> bool:
+        """
+        Follow changes made by other processes in the background, reconnecting when the listener is lost.
+        callback(None, None) is called when changes may have been missed, returns False if the backend cannot listen.
+        """
+        if not self.can_listen:
+            return False
+
+        if self._listener is None:
+            self._listener = asyncio.get_event_loop().create_task(self._listen(callback))
+
+        return True
+
+    async def stop_listener(self):
+        if self._listener is None:
+            return
+
+        self._listener.cancel()
+        try:
+            await self._listener
+        except asyncio.CancelledError:
+            pass
+
+        self._listener = None
+        self.listener_connected = False
+
+    async def _listen(self, callback: typing.Callable[[typing.Optional[str], typing.Optional[int]], None]):
+        delay = 1.0
+        missed = False  # Changes made while the listener was down were not seen
+
+        def ready():
+            nonlocal delay, missed
+            self.listener_connected = True
+            delay = 1.0
+
+            if missed:
+                self.logger.info('Change listener reconnected, refreshing cache')
+                callback(None, None)
+                missed = False
+
+        while True:
+            try:
+                await self._listen_once(callback, ready)
+                self.logger.warning('Change listener connection lost')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.warning(f'Change listener failed: {e!r}, retrying in {delay:.0f}s')
+
+            self.listener_connected = False
+            missed = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LISTEN_RETRY_MAX)
+
+    # Guilds
+
+    async def get_guilds(self, guild_ids: typing.List[int]) -> typing.List[dict]:
+        """Get the guild rows that exist for the ids"""
+        raise NotImplementedError
+
+    async def load_guilds(self, shard_ids: typing.Optional[typing.List[int]] = None,
+                          shard_count: typing.Optional[int] = None) -> typing.List[dict]:
+        """Get every guild row, or the ones on the given shards"""
+        raise NotImplementedError
+
+    async def new_guild(self, guild_id: int) -> dict:
+        """Insert a guild with default values and return it"""
+        raise NotImplementedError
+
+    # Users
+
+    async def get_users(self, user_ids: typing.List[int]) -> typing.List[dict]:
+        """Get the user rows that exist for the ids"""
+        raise NotImplementedError
+
+    async def get_or_create_users(self, user_ids: typing.List[int]) -> typing.List[dict]:
+        """Get a row for every id, inserting the missing ones with default values"""
+        raise NotImplementedError
+
+    async def new_user(self, user_id: int):
+        """Insert a user with default values"""
+        raise NotImplementedError
+
+    # Updates
+
+    async def update(self, table: str, row_id: int, data: dict, returning: bool = False) -> typing.Optional[dict]:
+        """Set columns of a row, returns the updated row if returning, None if it does not exist"""
+        raise NotImplementedError
+
+    async def update_many(self, updates: typing.Iterable[typing.Tuple[str, int, dict]]):
+        """Apply many (table, id, data) updates in one transaction"""
+        raise NotImplementedError
+
+    # Voice
+
+    async def get_voice_time(self, guild_id: int, user_id: int) -> typing.Optional[dict]:
+        """Get voice_time_spent_ms and voice_last_joined_ms of a user in a guild"""
+        raise NotImplementedError
+
+    async def add_voice_times(self, entries: typing.Iterable[typing.Tuple[int, int, float]]):
+        """Add time spent in voice for many (guild_id, user_id, ms) entries in one transaction"""
+        raise NotImplementedError
+
+    async def get_top_voice_times(self, guild_id: int, limit: int) -> typing.List[dict]:
+        """Get user_id and voice_time_spent_ms of the users with the most voice time in a guild, most first"""
+        raise NotImplementedError
+
+    async def migrate_voice_times(self) -> int:
+        """Copy voice data from the users voice json into voice times, returns rows inserted"""
+        raise NotImplementedError
+
+
+def create_backend(name: typing.Optional[str] = None) -> BaseDBConnection:
+    """Create the storage backend named by ZOTE_DB_BACKEND, or by name"""
+    name = name or DB_BACKEND
+
+    if name == 'postgres':
+        from .postgres import PostgresConnection  # asyncpg is only needed for postgres
+        return PostgresConnection(DB_HOST, DB_NAME, DB_USER, COLUMNS)
+
+    if name == 'sqlite':
+        from .sqlite import SQLiteConnection
+        return SQLiteConnection(SQLITE_PATH, COLUMNS)
+
+    raise DBException(f'Unknown database backend {name}')
+
+
+class DBConnection:
+    def __init__(self, backend: typing.Optional[BaseDBConnection] = None):
+        self.backend = backend or create_backend()
+        self.guild_cache = LRUCache(GUILD_CACHE_SIZE)
+        self.user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.time_formatters = {}  # guild id -> TimeFormatter for the guild timezone
+        self.rolemenus = RoleMenuIndex()  # Reaction roles of every guild that has been loaded
+        self.write_buffer: typing.Optional[WriteBuffer] = WriteBuffer(
+            self, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_ROWS, WRITE_BEHIND_MAX_RETRIES
+        ) if WRITE_BEHIND else None
+
+        # Lookups for different ids in the same tick share one query
+        self.guild_loader = BatchLoader(self._load_guilds)
+        self.user_loader = BatchLoader(self._load_users)
+        self.user_creator = BatchLoader(self.get_or_create_users)
+
+        # Changes made by other processes, see listen
+        self.on_guild_change: typing.Optional[typing.Callable[[int, typing.Optional[dict]], None]] = None
+        self.invalidations = {'guilds': 0, 'users': 0, 'refreshes': 0}
+        self._changed_guilds: typing.Set[int] = set()  # Guilds to refetch
+        self._refresh_all = False  # Changes were missed, refetch every guild
+        self._refresh_task: typing.Optional[asyncio.Task] = None
+        self._loaded_shards: typing.Optional[tuple] = None  # (shard_ids, shard_count) given to load_guilds
+
+        # Instrumentation
+        self.latency: typing.Dict[str, Histogram] = {}  # method -> call latency in ms
+        self.in_flight: typing.Dict[str, int] = {}  # method -> calls running now
+        self.slow_queries = deque(maxlen=20)  # (unix time, method, ms) of recent slow calls
 
         # Setup logger
         logger = logging.getLogger('utils.database')
@@ -29,197 +318,290 @@ class BaseDBConnection:
         self.logger = logger
 
     async def connect(self):
-        if self.is_connected:
-            return
-
-        self.pool = await asyncpg.create_pool(  # Create a connection pool
-            user=self.user,
-            password=os.environ.get('ZOTE_DB_PASSWORD'),
-            database=self.db_name,
-            host=self.host
-        )
+        await self.backend.connect()
 
     async def close(self):
-        if not self.pool:
-            self.logger.error(f'Connection pool for database {self.db_name} does not exist.')
-            return
+        await self.backend.stop_listener()
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+
+        if self.write_buffer is not None and self.is_connected:
+            await self.write_buffer.close()  # Write buffered updates before the backend goes away
 
-        await self.pool.close()
-        self.pool = None
+        await self.backend.close()
 
     @property
     def is_connected(self):
-        return self.pool is not None
+        return self.backend.is_connected
 
-
-class DBConnection(BaseDBConnection):
-    def __init__(self):
-        super().__init__('192.168.0.129', 'wynndb', 'zote')
-        self.guild_cache = {}
+    def _reading(self):
+        """Track a read of rows that are cached, yields the generation passed to _cache_guild and _cache_user"""
+        return self.write_buffer.reading() if self.write_buffer is not None else contextlib.nullcontext()
 
     # Guilds
 
+    def _cache_guild(self, guild_id: int, res: typing.Optional[dict],
+                     since: typing.Optional[int] = None) -> typing.Optional[dict]:
+        """Add a guild row to the cache, a missing row is cached as None"""
+        if res and self.write_buffer is not None:  # Include updates not written yet, or written during the read
+            self.write_buffer.overlay('guilds', guild_id, res, since)
+
+        self.guild_cache.set(guild_id, res)  # Add to cache
+        self.rolemenus.set_guild(guild_id, res['rolemenu'] if res else None)  # Rebuild the guild reaction roles
+        return res
+
+    @timed
     async def get_guild(self, guild_id: int) -> typing.Optional[dict]:
         """Get guild by id"""
         await self.connect()  # Connect to database
 
-        if e := self.guild_cache.get(guild_id):  # Check cache first
+        if (e := self.guild_cache.get(guild_id, _MISSING)) is not _MISSING:  # Check cache first
             return e
 
-        async with self.pool.acquire() as conn:
-            query = 'SELECT * FROM zotebot.guilds WHERE id = $1'
-            res = await conn.fetchrow(query, guild_id)  # Fetch a guild row
-
-        if res:  # if guild exists
-            res = dict(res)  # Convert to dict
-            res['rolemenu'] = json.loads(res['rolemenu'])  # Convert rolemenu to dict from json
+        return await self.guild_loader.load(guild_id)  # Fetched with other guilds requested this tick
 
-        self.guild_cache[guild_id] = res  # Add to cache
-        return res
+    @timed
+    async def _load_guilds(self, guild_ids: typing.List[int]) -> typing.Dict[int, typing.Optional[dict]]:
+        """Fetch guilds by id in one query and cache them"""
+        with self._reading() as since:
+            rows = {x['id']: x for x in await self.backend.get_guilds(guild_ids)}  # Fetch guild rows
+            return {guild_id: self._cache_guild(guild_id, rows.get(guild_id), since) for guild_id in guild_ids}
 
+    @timed
     async def update_guild(self, guild_id: int, data: dict):
         """Update guild"""
         await self.connect()  # Connect to database
 
-        qry = ''  # Set query to build
-        n = 2  # Starting argument number
-        values = []  # Values to pass to query
-
-        for key, value in data.items():  # Cycle through data to update
-            qry += f'{key} = ${n}, '  # Add to query
+        if self.write_buffer is not None:  # Written later, update the cached row now
+            self.write_buffer.put('guilds', guild_id, data)
+            self._update_cached_guild(guild_id, data)
+            return
 
-            if isinstance(value, dict):  # If value is dict, convert to json string
-                value = json.dumps(value)
+        res = await self.backend.update('guilds', guild_id, data, returning=True)  # Rejects unknown columns
+        self._cache_guild(guild_id, res)  # Write the updated row through to the cache
 
-            values.append(value)  # Add to values
-            n += 1  # Increment argument number
+        if 'timezone' in data:  # Timezone changed, resolve it again on next log
+            self.time_formatters.pop(guild_id, None)
 
-        async with self.pool.acquire() as conn:
-            query = '''
-            UPDATE zotebot.guilds
-                SET {}
-                WHERE id = $1
-            '''.format(qry[:-2])  # Create update query from qry and remove trailing comma
+    def _update_cached_guild(self, guild_id: int, data: dict):
+        """Apply an update to the cached guild row"""
+        if guild := self.guild_cache.get(guild_id):
+            guild.update(data)
 
-            await conn.execute(query, guild_id, *values)  # Update guild values
+            if 'rolemenu' in data:
+                self.rolemenus.set_guild(guild_id, guild['rolemenu'])
 
-        if self.guild_cache.get(guild_id):  # If guild is in cache update it
-            self.guild_cache[guild_id].update(data)
+        if 'timezone' in data:  # Timezone changed, resolve it again on next log
+            self.time_formatters.pop(guild_id, None)
 
+    @timed
     async def new_guild(self, guild_id: int):
         """New guild in database"""
         await self.connect()  # Connect to database
 
-        async with self.pool.acquire() as conn:
-            query = '''
-            INSERT INTO zotebot.guilds (id)
-                VALUES ($1)
-            '''
+        res = await self.backend.new_guild(guild_id)  # Insert new guild
+        self._cache_guild(guild_id, res)  # Replace the cached miss with the new row
 
-            await conn.execute(
-                query, guild_id)  # Insert new guild
+    @timed
+    async def load_guilds(self, shard_ids: typing.Optional[typing.List[int]] = None,
+                          shard_count: typing.Optional[int] = None) -> typing.List[dict]:
+        """Load every guild, or every guild on the given shards, into the cache in one query"""
+        await self.connect()  # Connect to database
+
+        with self._reading() as since:
+            res = await self.backend.load_guilds(shard_ids, shard_count)  # Fetch guild rows
+            self._loaded_shards = (shard_ids, shard_count)  # Loaded again when changes were missed
+            return [self._cache_guild(x['id'], x, since) for x in res]
+
+    def evict_guild(self, guild_id: int):
+        """Remove a guild from the cache"""
+        self.guild_cache.pop(guild_id)
+        self.time_formatters.pop(guild_id, None)
+        self.rolemenus.remove_guild(guild_id)
 
     def clear_cache(self):
         """Clear cache"""
-        self.guild_cache = {}
+        self.guild_cache.clear()
+        self.user_cache.clear()
+        self.time_formatters = {}
+        self.rolemenus.clear()
+
+    # Changes made by other processes
+
+    def listen(self) -> bool:
+        """Keep the cache in sync with rows changed by other processes, returns False if the backend cannot"""
+        return LISTEN and self.backend.start_listener(self._on_change)
+
+    def _on_change(self, table: typing.Optional[str], row_id: typing.Optional[int]):
+        """Evict changed users and queue changed guilds to be fetched again"""
+        if table is None or (table == 'guilds' and row_id is None):  # Changes were missed or the table was emptied
+            self._refresh_all = True
+        elif table == 'guilds':
+            self.invalidations['guilds'] += 1
+            self._changed_guilds.add(row_id)
+        elif table == 'users':
+            self.invalidations['users'] += 1
+            if row_id is None:
+                self.user_cache.clear()
+            else:
+                self.user_cache.pop(row_id)  # Refetched on next get_user
+            return
+        else:
+            return
+
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.get_event_loop().create_task(self._refresh_guilds())
+
+    async def _refresh_guilds(self):
+        """
+        Fetch changed guilds again. Guilds are fetched rather than evicted so their reaction roles keep working,
+        every changed guild is passed to on_guild_change, even ones that were not cached.
+        """
+        await asyncio.sleep(0)  # Changes notified in the same tick share one query
+
+        while self._refresh_all or self._changed_guilds:
+            refresh_all, self._refresh_all = self._refresh_all, False
+            guild_ids, self._changed_guilds = self._changed_guilds, set()
+
+            with self._reading() as since:  # Updates committed while fetching are applied to the rows
+                try:
+                    if refresh_all:
+                        self.invalidations['refreshes'] += 1
+                        self.user_cache.clear()
+                        guild_ids.update(k for k, _ in self.guild_cache.items())
+
+                        if self._loaded_shards is not None:  # Every guild loaded on startup, including new rows
+                            rows = {x['id']: x for x in await self.backend.load_guilds(*self._loaded_shards)}
+                            guild_ids.update(rows)
+                        else:
+                            rows = {x['id']: x for x in await self.backend.get_guilds(list(guild_ids))}
+                    else:
+                        rows = {x['id']: x for x in await self.backend.get_guilds(list(guild_ids))}
+                except Exception as e:
+                    self.logger.exception('Failed to refresh changed guilds, retrying', exc_info=e)
+                    self._refresh_all |= refresh_all
+                    self._changed_guilds |= guild_ids
+                    await asyncio.sleep(5)
+                    continue
+
+                for guild_id in guild_ids:
+                    row = rows.get(guild_id)
+                    if refresh_all or guild_id in self.guild_cache:
+                        self._cache_guild(guild_id, row, since)
+                    self.time_formatters.pop(guild_id, None)  # Timezone may have changed
+
+                    if self.on_guild_change is not None:
+                        self.on_guild_change(guild_id, row)
 
     # Users
 
+    @timed
     async def get_user(self, user_id: int) -> typing.Optional[dict]:
         """Get user by id"""
         await self.connect()  # Connect to database
 
-        async with self.pool.acquire() as conn:
-            query = 'SELECT * FROM zotebot.users WHERE id = $1'
+        if (e := self.user_cache.get(user_id, _MISSING)) is not _MISSING:  # Check cache first
+            return e
 
-            res = await conn.fetchrow(query, user_id)  # Fetch user row
+        return await self.user_loader.load(user_id)  # Fetched with other users requested this tick
 
-        if res:  # If user exists
-            res = dict(res)  # Convert to dict
-            res['voice'] = json.loads(res['voice'])  # Convert voice to dict from json
+    def _cache_user(self, user_id: int, res: typing.Optional[dict],
+                    since: typing.Optional[int] = None) -> typing.Optional[dict]:
+        """Add a user row to the cache, a missing row is cached as None"""
+        if res and self.write_buffer is not None:  # Include updates not written yet, or written during the read
+            self.write_buffer.overlay('users', user_id, res, since)
 
+        self.user_cache.set(user_id, res)  # Add to cache, including unknown users
         return res
 
-    async def update_user(self, user_id: int, data: dict):
-        """Update user value"""
-        await self.connect()
+    @timed
+    async def _load_users(self, user_ids: typing.List[int]) -> typing.Dict[int, typing.Optional[dict]]:
+        """Fetch users by id in one query and cache them"""
+        with self._reading() as since:
+            rows = {x['id']: x for x in await self.backend.get_users(user_ids)}  # Fetch user rows
+            return {user_id: self._cache_user(user_id, rows.get(user_id), since) for user_id in user_ids}
 
-        qry = ''  # Set query to build
-        n = 2  # Starting argument number
-        values = []  # Values to pass to query
+    @timed
+    async def get_or_create_user(self, user_id: int) -> dict:
+        """Get user by id, creating it if it does not exist"""
+        await self.connect()  # Connect to database
+
+        if e := self.user_cache.get(user_id):  # Check cache first, a cached miss still has to be created
+            return e
 
-        for key, value in data.items():  # Cycle through data to update
-            qry += f'{key} = ${n}, '  # Add to query
+        return await self.user_creator.load(user_id)  # Created with other users requested this tick
+
+    @timed
+    async def get_or_create_users(self, user_ids: typing.List[int]) -> typing.Dict[int, dict]:
+        """Get users by id, creating the ones that do not exist, in one query"""
+        await self.connect()  # Connect to database
 
-            if isinstance(value, dict):  # If value is dict, convert to json string
-                value = json.dumps(value)
+        with self._reading() as since:
+            res = await self.backend.get_or_create_users(user_ids)  # Insert missing, fetch all
+            return {x['id']: self._cache_user(x['id'], x, since) for x in res}
 
-            values.append(value)  # Add to values
-            n += 1  # Increment argument number
+    @timed
+    async def update_user(self, user_id: int, data: dict):
+        """Update user value"""
+        await self.connect()
 
-        async with self.pool.acquire() as conn:
-            query = '''
-            UPDATE zotebot.users
-                SET {}
-                WHERE id = $1
-            '''.format(qry[:-2])  # Create update query from qry and remove trailing comma
+        if self.write_buffer is not None:  # Written later, get_user applies it until then
+            self.write_buffer.put('users', user_id, data)
+            self.user_cache.pop(user_id)
+            return
 
-            await conn.execute(query, user_id, *values)  # Update user values
+        await self.backend.update('users', user_id, data)  # Rejects unknown columns
+        self.user_cache.pop(user_id)  # Invalidate cached user, refetched on next get_user
 
+    @timed
     async def new_user(self, user_id: int):
         """Set user in database"""
         await self.connect()  # Connect to database
 
-        async with self.pool.acquire() as conn:
-            query = '''
-            INSERT INTO zotebot.users
-                VALUES ($1)
-            '''
+        await self.backend.new_user(user_id)  # Insert new user
+        self.user_cache.pop(user_id)  # Drop the cached miss for this user
 
-            await conn.execute(
-                query, user_id)  # Insert new user
+    # Voice
 
-    async def get_top_voice_times(self, guild_id: int, limit: int = 10) -> typing.List[typing.Tuple[int, int]]:
-        """Get top voice times"""
+    @timed
+    async def get_voice_time(self, guild_id: int, user_id: int) -> typing.Optional[dict]:
+        """Get voice time of a user in a guild"""
         await self.connect()  # Connect to database
 
-        async with self.pool.acquire() as conn:
-            query = '''
-                SELECT id, voice FROM zotebot.users
-            '''
+        return await self.backend.get_voice_time(guild_id, user_id)
 
-            res = await conn.fetch(query)  # Fetch all users
+    @timed
+    async def add_voice_times(self, entries: typing.Iterable[typing.Tuple[int, int, float]]):
+        """Add time spent in voice for many (guild_id, user_id, ms) entries in one transaction"""
+        await self.connect()  # Connect to database
 
-        guild_users = []  # List of users in this guild
+        await self.backend.add_voice_times(entries)
 
-        for x in res:  # for each user in the db
-            v = json.loads(x['voice'])  # load void data
-            if v.get(str(guild_id)) \
-                    and v.get(str(guild_id)).get('voice_time_spent_ms', 0) != 0:
-                # If user has voice data in this guild and has spent voice time, add to list
-                guild_users.append((x['id'], v[str(guild_id)]))
+    @timed
+    async def get_top_voice_times(self, guild_id: int, limit: int = 10) -> typing.List[typing.Tuple[int, dict]]:
+        """Get top voice times"""
+        await self.connect()  # Connect to database
 
-        guild_users.sort(key=lambda u: u[1]['voice_time_spent_ms'], reverse=True)  # Sort by voice time
-        if len(guild_users) > limit:
-            guild_users = guild_users[:limit]  # Limit to given limit (default 10)
+        res = await self.backend.get_top_voice_times(guild_id, limit)  # Fetch top users
+        return [(x['user_id'], {'voice_time_spent_ms': x['voice_time_spent_ms']}) for x in res]
 
-        return guild_users
+    @timed
+    async def migrate_voice_times(self) -> int:
+        """Copy voice data from the users voice json into voice_times, returns rows inserted"""
+        await self.connect()  # Connect to database
+
+        return await self.backend.migrate_voice_times()  # Existing voice_times rows are kept
 
     # Utils
 
+    @timed
     async def get_time(self, guild_id: int) -> str:
         """Get timezone for guild"""
-        guild = await self.get_guild(guild_id)
-        tz: str
+        if (f := self.time_formatters.get(guild_id)) is None:  # Resolve the guild timezone once
+            guild = await self.get_guild(guild_id)
 
-        # Get timezone from guild, or default to UTC
-        if guild:
-            tz = guild.get('timezone', 'UTC')
-        else:
-            tz = 'UTC'
+            # Get timezone from guild, or default to UTC
+            f = get_formatter((guild.get('timezone') if guild else None) or 'UTC')
+            self.time_formatters[guild_id] = f
 
-        now = datetime.now(pytz.timezone(tz))  # Get current time in guild timezone
-        offset = now.strftime('%z')  # Get timezone offset
-        sign = offset[0]  # Get sign of offset
-        offset = int(offset[1:].strip('0') or '0')  # May not work correctly with +/-x:30 offsets
-        return now.strftime('`[%H:%M:%S UTC{}{:01}]`'.format(sign, offset))  # Return formatted time
+        return f.format()  # Return formatted time
@@ -0,0 +1,132 @@
+import asyncio
+import discord
+import logging
+import typing
+
+from collections import deque
+
+MAX_MESSAGE_LENGTH = 2000  # Discord message content limit
+
+
+class LogDispatcher:
+    """
+    Queues log lines per channel and sends them packed into as few messages as possible.
+    """
+    def __init__(self, window: float = 1.0, max_queue: int = 500):
+        self.window = window  # Seconds to collect lines before sending
+        self.max_queue = max_queue  # Lines queued per channel before new lines are dropped
+        self.queues: typing.Dict[int, deque] = {}  # channel id -> queued lines
+        self.channels: typing.Dict[int, discord.abc.Messageable] = {}  # channel id -> channel
+        self.workers: typing.Dict[int, asyncio.Task] = {}  # channel id -> sending task
+        self._full: typing.Dict[int, asyncio.Event] = {}  # channel id -> set when a message worth of lines is queued
+        self._sizes: typing.Dict[int, int] = {}  # channel id -> characters queued
+        self.closed = False  # Set by close, new lines are dropped
+
+        # Counters
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+
+        self.logger = logging.getLogger('utils.dispatcher')
+
+    def put(self, channel, line: str) -> bool:
+        """Queue a line for a channel, returns False if the queue is full and the line was dropped"""
+        if self.closed:
+            self.dropped += 1
+            return False
+
+        # Lines longer than a message are split over several messages
+        parts = [line[i:i + MAX_MESSAGE_LENGTH] for i in range(0, max(len(line), 1), MAX_MESSAGE_LENGTH)]
+
+        if len(self.queues.get(channel.id, ())) + len(parts) > self.max_queue:  # Channel is too far behind
+            self.dropped += 1
+            return False
+
+        q = self.queues.setdefault(channel.id, deque())
+
+        for part in parts:
+            q.append(part)
+            self._sizes[channel.id] = self._sizes.get(channel.id, 0) + len(part) + 1
+
+        self.queued += 1
+        self.channels[channel.id] = channel
+
+        if channel.id not in self.workers:  # Start sending for this channel
+            self._full[channel.id] = asyncio.Event()
+            self.workers[channel.id] = asyncio.create_task(self._worker(channel.id))
+
+        if self._sizes[channel.id] >= MAX_MESSAGE_LENGTH:  # A full message is ready, don't wait for the window
+            self._full[channel.id].set()
+
+        return True
+
+    def _pack(self, channel_id: int) -> str:
+        """Take as many queued lines as fit in one message"""
+        q = self.queues[channel_id]
+        lines = [q.popleft()]
+        size = len(lines[0])
+
+        while q and size + len(q[0]) + 1 <= MAX_MESSAGE_LENGTH:
+            line = q.popleft()
+            lines.append(line)
+            size += len(line) + 1
+
+        self._sizes[channel_id] -= size + 1
+        return '\n'.join(lines)
+
+    async def _send_queued(self, channel_id: int):
+        q = self.queues[channel_id]
+        channel = self.channels[channel_id]
+
+        while q:
+            content = self._pack(channel_id)
+            try:
+                await channel.send(content)  # Rate limits are waited out here, which lets the queue fill
+                self.sent += 1
+            except (discord.NotFound, discord.Forbidden) as e:  # Channel deleted or not allowed, drop the rest
+                self.logger.error(f'Failed to send logs to channel {channel_id}, dropping {len(q)} lines: {e}')
+                self.dropped += len(q)
+                q.clear()
+                self._sizes[channel_id] = 0
+            except discord.HTTPException as e:
+                self.logger.error(f'Failed to send logs to channel {channel_id}: {e}')
+
+    async def _worker(self, channel_id: int):
+        full = self._full[channel_id]
+
+        try:
+            while self.queues[channel_id]:
+                if not self.closed:
+                    try:
+                        await asyncio.wait_for(full.wait(), self.window)  # Wait for the window or a full message
+                    except asyncio.TimeoutError:
+                        pass
+
+                full.clear()
+                await self._send_queued(channel_id)
+        finally:
+            del self.workers[channel_id]
+            del self._full[channel_id]
+
+            if not self.queues[channel_id]:  # Forget the channel until it gets lines again
+                del self.queues[channel_id]
+                del self.channels[channel_id]
+                del self._sizes[channel_id]
+
+    async def close(self, timeout: float = 10.0):
+        """Stop accepting lines and send the queued ones now, lines not sent within timeout seconds are dropped"""
+        self.closed = True
+        for full in self._full.values():  # Don't wait for the window
+            full.set()
+
+        if not self.workers:
+            return
+
+        _, pending = await asyncio.wait(list(self.workers.values()), timeout=timeout)
+        if pending:
+            left = sum(len(self.queues[channel_id]) for channel_id in self.workers)
+            self.logger.warning(f'Dropping {left} log lines for {len(pending)} channels, not sent in {timeout}s')
+
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
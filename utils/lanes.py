@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import typing
+
+from collections import deque
+from time import perf_counter
+
+
+class _Lane:
+    """Events queued on a lane and WAIT events waiting for room, both kept in the order they were submitted"""
+    def __init__(self):
+        self.items: deque = deque()  # Queued events
+        self.waiters: deque = deque()  # (event, future) of WAIT events, moved to items as room frees up
+        self.unfinished = 0  # Queued or running events
+        self.wakeup = asyncio.Event()  # Set when events are queued
+        self.idle = asyncio.Event()  # Set when there are no unfinished events
+        self.idle.set()
+
+    def __len__(self):
+        return len(self.items) + len(self.waiters)
+
+    def put(self, item):
+        self.items.append(item)
+        self.unfinished += 1
+        self.idle.clear()
+        self.wakeup.set()
+
+    def admit(self):
+        """Move the first waiting event into the lane, in its place before anything submitted after it"""
+        while self.waiters:
+            item, future = self.waiters.popleft()
+            if not future.done():  # Not cancelled
+                self.put(item)
+                future.set_result(True)
+                return
+
+    def task_done(self):
+        self.unfinished -= 1
+        if self.unfinished == 0:
+            self.idle.set()
+
+
+class EventLanes:
+    """
+    Bounded event queues processed by a fixed number of sequential lanes.
+    Events with the same key (eg. a guild id) always go to the same lane, so they run in the order submitted.
+    WAIT events that find the lane full wait in line, nothing submitted after them is queued before them.
+    """
+    DROP = 'drop'  # Full lane: the event is dropped and counted
+    WAIT = 'wait'  # Full lane: the calling task waits for room, discord.py runs every listener in its own task
+
+    def __init__(self, metrics, lanes: int = 8, max_depth: int = 1000, policy: str = DROP,
+                 max_waiting: typing.Optional[int] = None):
+        self.metrics = metrics
+        self.lane_count = lanes
+        self.max_depth = max_depth  # Events queued per lane
+        self.max_waiting = max_depth if max_waiting is None else max_waiting  # WAIT events waiting per lane
+        self.policy = policy  # DROP or WAIT for events submitted without their own policy
+        self.queues: typing.List[_Lane] = []
+        self.workers: typing.List[asyncio.Task] = []
+
+        self.logger = logging.getLogger('utils.lanes')
+
+    def _start(self):
+        self.queues = [_Lane() for _ in range(self.lane_count)]
+        self.workers = [asyncio.create_task(self._worker(lane)) for lane in self.queues]
+
+    async def submit(self, key: int, name: str, handler: typing.Callable[..., typing.Awaitable], *args,
+                     policy: typing.Optional[str] = None) -> bool:
+        """Queue handler(*args) on the lane for key, returns False if it was dropped"""
+        if not self.workers:  # Started on first use, when the event loop is running
+            self._start()
+
+        lane = self.queues[key % self.lane_count]
+        item = (perf_counter(), name, handler, args)
+
+        if len(lane.items) < self.max_depth and not lane.waiters:  # Room, and no earlier event waiting for it
+            lane.put(item)
+            return True
+
+        # Waiting events are bounded too, past that even WAIT events are dropped
+        if (policy or self.policy) == self.WAIT and len(lane.waiters) < self.max_waiting:
+            future = asyncio.get_running_loop().create_future()
+            lane.waiters.append((item, future))
+            if await future:
+                return True
+        else:
+            self.metrics.inc('zote_event_dropped_total', event=name)
+
+        return False
+
+    async def _worker(self, lane: _Lane):
+        while True:
+            while not lane.items:
+                lane.wakeup.clear()
+                await lane.wakeup.wait()
+
+            queued, name, handler, args = lane.items.popleft()
+            lane.admit()
+            start = perf_counter()
+            self.metrics.observe('zote_event_queue_wait_ms', (start - queued) * 1000, event=name)
+
+            try:
+                await handler(*args)
+            except Exception as e:
+                self.metrics.inc('zote_event_errors_total', event=name)
+                self.logger.exception(f'Exception in {name}', exc_info=e)
+            finally:
+                self.metrics.observe('zote_event_duration_ms', (perf_counter() - start) * 1000, event=name)
+                lane.task_done()
+
+    def depths(self) -> typing.List[int]:
+        """Get the number of events queued or waiting on each lane"""
+        return [len(lane) for lane in self.queues]
+
+    async def close(self, timeout: float = 5.0):
+        """Process what is queued for up to timeout seconds, then stop the lanes"""
+        if self.queues:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(lane.idle.wait() for lane in self.queues)), timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning(f'Discarding {sum(self.depths())} queued events')
+
+        for task in self.workers:
+            task.cancel()
+
+        for lane in self.queues:  # Callers still waiting get False, their events are dropped
+            for _, future in lane.waiters:
+                if not future.done():
+                    future.set_result(False)
+
+        self.workers = []
+        self.queues = []
@@ -0,0 +1,87 @@
+import asyncio
+import typing
+
+
+def _retrieve(f: asyncio.Future):
+    """Mark an exception as retrieved, so it is not logged when nobody awaits the result"""
+    if not f.cancelled():
+        f.exception()
+
+
+class BatchLoader:
+    """
+    Collects keys requested in the same event loop tick and loads them with one call.
+    Concurrent requests for a key that is already being loaded share the same result,
+    cancelling one request does not cancel the others.
+    """
+    def __init__(self, load: typing.Callable[[typing.List[typing.Any]], typing.Awaitable[dict]],
+                 max_batch: int = 500):
+        self._load = load  # Takes a list of keys, returns {key: value}, missing keys are None
+        self.max_batch = max_batch
+        self._futures: typing.Dict[typing.Any, asyncio.Future] = {}  # key -> result, queued or loading
+        self._queue: typing.List[typing.Any] = []  # keys for the next batch
+        self._scheduled = False
+
+        # Stats
+        self.requests = 0
+        self.deduplicated = 0  # Requests served by a load that was already queued or running
+        self.batches = 0
+        self.keys_loaded = 0
+
+    def load(self, key) -> asyncio.Future:
+        """Get a future for the value of a key, each caller gets its own"""
+        self.requests += 1
+
+        if (f := self._futures.get(key)) is not None:
+            self.deduplicated += 1
+            return asyncio.shield(f)
+
+        loop = asyncio.get_event_loop()
+        f = self._futures[key] = loop.create_future()
+        f.add_done_callback(_retrieve)  # Every caller may have been cancelled
+        self._queue.append(key)
+
+        if not self._scheduled:  # Dispatch once everything ready in this tick has run
+            self._scheduled = True
+            loop.call_soon(self._dispatch)
+
+        return asyncio.shield(f)
+
+    def _dispatch(self):
+        self._scheduled = False
+        queue, self._queue = self._queue, []
+
+        for i in range(0, len(queue), self.max_batch):
+            asyncio.ensure_future(self._run(queue[i:i + self.max_batch]))
+
+    async def _run(self, keys: typing.List[typing.Any]):
+        self.batches += 1
+        self.keys_loaded += len(keys)
+        res, error, loaded = None, None, False
+
+        try:
+            res = await self._load(keys)
+            loaded = True
+        except Exception as e:
+            error = e
+        finally:  # Also when the batch is cancelled, later loads of its keys would wait on the futures forever
+            for key in keys:
+                if (f := self._futures.pop(key)).done():
+                    continue
+
+                if loaded:
+                    f.set_result(res.get(key))
+                elif error is not None:
+                    f.set_exception(error)
+                else:
+                    f.cancel()
+
+    def stats(self) -> dict:
+        """Get request, deduplication and batch counts"""
+        return {
+            'requests': self.requests,
+            'deduplicated': self.deduplicated,
+            'batches': self.batches,
+            'keys_loaded': self.keys_loaded,
+            'avg_batch': self.keys_loaded / self.batches if self.batches else 0
+        }
@@ -0,0 +1,143 @@
+import sys
+import typing
+
+from collections import OrderedDict
+
+ENTRY_OVERHEAD = 200  # Bytes per message for the dict entries that index it
+
+
+class StoredMessage:
+    """
+    What delete and edit logs need from a message.
+    """
+    __slots__ = ('id', 'channel_id', 'author_id', 'author', 'content', 'attachments', 'size')
+
+    def __init__(self, message_id: int, channel_id: int, author_id: int, author: str, content: str,
+                 attachments: typing.Tuple[str, ...] = ()):
+        self.id = message_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.author = author  # Name and discriminator when the message was sent
+        self.content = content
+        self.attachments = attachments  # Attachment urls
+        self.size = self._size()
+
+    def _size(self) -> int:
+        """Estimate the bytes used by the message and its index entries"""
+        return sys.getsizeof(self) + sys.getsizeof(self.author) + sys.getsizeof(self.content) + \
+            sys.getsizeof(self.attachments) + sum(sys.getsizeof(a) for a in self.attachments) + ENTRY_OVERHEAD
+
+    def edit(self, content: str, attachments: typing.Optional[typing.Tuple[str, ...]] = None) -> int:
+        """Replace the content, and the attachments if given, returns the change in size"""
+        self.content = content
+        if attachments is not None:
+            self.attachments = attachments
+
+        old, self.size = self.size, self._size()
+        return self.size - old
+
+
+class MessageStore:
+    """
+    Recent messages kept as compact records, in a ring buffer per channel with a byte budget for all channels.
+    When the budget is exceeded the oldest messages of any channel are evicted first.
+    """
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, per_channel: int = 1000):
+        self.max_bytes = max_bytes
+        self.per_channel = per_channel  # Messages kept per channel
+        self.channels: typing.Dict[int, typing.OrderedDict[int, StoredMessage]] = {}  # channel id -> ring buffer
+        self._order: typing.OrderedDict[int, int] = OrderedDict()  # message id -> channel id, oldest first
+        self.bytes = 0
+
+        # Counters
+        self.added = 0
+        self.evicted = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def add(self, message: StoredMessage):
+        """Keep a message, evicting old messages of its channel or of any channel to stay within limits"""
+        self._remove(message.channel_id, message.id)  # Replaces a message added before
+
+        ring = self.channels.get(message.channel_id)
+        if ring is None:
+            ring = self.channels[message.channel_id] = OrderedDict()
+
+        ring[message.id] = message
+        self._order[message.id] = message.channel_id
+        self.bytes += message.size
+        self.added += 1
+
+        if len(ring) > self.per_channel:  # Oldest message of the channel
+            self._remove(message.channel_id, next(iter(ring)))
+            self.evicted += 1
+
+        self._trim()
+
+    def _trim(self):
+        """Evict the oldest messages of any channel until the store is within its byte budget"""
+        while self.bytes > self.max_bytes and self._order:
+            message_id, channel_id = next(iter(self._order.items()))
+            self._remove(channel_id, message_id)
+            self.evicted += 1
+
+    def _remove(self, channel_id: int, message_id: int) -> typing.Optional[StoredMessage]:
+        ring = self.channels.get(channel_id)
+        if ring is None or (message := ring.pop(message_id, None)) is None:
+            return None
+
+        del self._order[message_id]
+        self.bytes -= message.size
+        if not ring:
+            del self.channels[channel_id]
+
+        return message
+
+    def get(self, channel_id: int, message_id: int) -> typing.Optional[StoredMessage]:
+        """Get a stored message, None if it was not seen or has been evicted"""
+        ring = self.channels.get(channel_id)
+        message = ring.get(message_id) if ring is not None else None
+
+        if message is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return message
+
+    def pop(self, channel_id: int, message_id: int) -> typing.Optional[StoredMessage]:
+        """Remove and return a stored message, eg. when it is deleted"""
+        message = self._remove(channel_id, message_id)
+
+        if message is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return message
+
+    def edit(self, message: StoredMessage, content: str, attachments: typing.Optional[typing.Tuple[str, ...]] = None):
+        """Update a stored message after an edit"""
+        self.bytes += message.edit(content, attachments)
+        self._trim()
+
+    def remove_channel(self, channel_id: int):
+        """Forget every message of a channel"""
+        for message_id in list(self.channels.get(channel_id, ())):
+            self._remove(channel_id, message_id)
+
+    def stats(self) -> dict:
+        """Get the stored messages, channels and bytes, and add, evict, hit and miss counts"""
+        return {
+            'messages': len(self._order),
+            'channels': len(self.channels),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'added': self.added,
+            'evicted': self.evicted,
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -0,0 +1,236 @@
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import typing
+
+from aiohttp import web
+from time import perf_counter
+
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # Upper bounds
+
+
+class Histogram:
+    """
+    Fixed bucket histogram of observed values, used for latencies in milliseconds.
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets: typing.Sequence[float] = LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last bucket is everything above the highest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """Add a value"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def avg(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> float:
+        """Estimate a percentile (0-1) as the upper bound of the bucket it falls in"""
+        if not self.count:
+            return 0.0
+
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+
+        return self.max
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: typing.Tuple[typing.Tuple[str, typing.Any], ...]) -> str:
+    """Format labels as {name="value",...}"""
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges rendered in the Prometheus text format.
+    """
+    def __init__(self):
+        self.help: typing.Dict[str, str] = {}  # name -> help text
+        self.collected_counters: typing.Set[str] = set()  # Collected metrics that are counters, not gauges
+        self.counters: typing.Dict[str, typing.Dict[tuple, float]] = {}  # name -> {labels: value}
+        self.histograms: typing.Dict[str, typing.Dict[tuple, Histogram]] = {}  # name -> {labels: histogram}
+        self.collectors: typing.List[typing.Callable[[], typing.Iterable[tuple]]] = []
+
+    def describe(self, name: str, help_: str, counter: bool = False):
+        """Set the help text of a metric, counter marks a collected metric as a counter"""
+        self.help[name] = help_
+        if counter:
+            self.collected_counters.add(name)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment a counter"""
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Add a value to a histogram"""
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if (hist := series.get(key)) is None:
+            hist = series[key] = Histogram()
+
+        hist.observe(value)
+
+    def add_collector(self, collector: typing.Callable[[], typing.Iterable[tuple]]):
+        """
+        Add a function called on every render, it yields (name, labels dict, value) for gauges, or for counters
+        described with counter=True, or (name, labels dict, Histogram) for histograms kept elsewhere.
+        """
+        self.collectors.append(collector)
+
+    def _render_histogram(self, name: str, labels: tuple, hist: Histogram) -> typing.List[str]:
+        lines = []
+        cumulative = 0
+        for bound, n in zip(hist.buckets, hist.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+
+        lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {hist.count}')
+        lines.append(f'{name}_sum{_labels(labels)} {hist.sum}')
+        lines.append(f'{name}_count{_labels(labels)} {hist.count}')
+        return lines
+
+    def render(self) -> str:
+        """Get every metric in the Prometheus text format"""
+        counters = {name: list(series.items()) for name, series in self.counters.items()}
+        gauges: typing.Dict[str, typing.List[tuple]] = {}
+        histograms = {name: list(series.items()) for name, series in self.histograms.items()}
+
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                key = tuple(sorted(labels.items()))
+                if isinstance(value, Histogram):
+                    histograms.setdefault(name, []).append((key, value))
+                elif name in self.collected_counters:
+                    counters.setdefault(name, []).append((key, value))
+                else:
+                    gauges.setdefault(name, []).append((key, value))
+
+        lines = []
+        for type_, metrics in (('counter', counters.items()), ('gauge', gauges.items()),
+                               ('histogram', histograms.items())):
+            for name, series in metrics:
+                if name in self.help:
+                    lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {type_}')
+
+                for labels, value in series:
+                    if type_ == 'histogram':
+                        lines.extend(self._render_histogram(name, labels, value))
+                    else:
+                        lines.append(f'{name}{_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def timed_event(func):
+    """Record how long a cog listener takes, and if it raised, in the bot metrics"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        start = perf_counter()
+
+        try:
+            return await func(self, *args, **kwargs)
+        except Exception:
+            self.bot.metrics.inc('zote_event_errors_total', event=name)
+            raise
+        finally:
+            self.bot.metrics.observe('zote_event_duration_ms', (perf_counter() - start) * 1000, event=name)
+
+    return wrapper
+
+
+class MetricsServer:
+    """
+    Serves metrics over http on a local port and optionally writes them to a file on an interval.
+    """
+    def __init__(self, metrics: Metrics, host: str = '127.0.0.1', port: typing.Optional[int] = None,
+                 snapshot_path: typing.Optional[str] = None, snapshot_interval: float = 60):
+        self.metrics = metrics
+        self.host = host
+        self.port = port  # None to not serve over http
+        self.snapshot_path = snapshot_path  # None to not write snapshots
+        self.snapshot_interval = snapshot_interval
+        self._runner: typing.Optional[web.AppRunner] = None
+        self._task: typing.Optional[asyncio.Task] = None
+
+        self.logger = logging.getLogger('utils.metrics')
+
+    async def start(self):
+        if self.port is not None:
+            app = web.Application()
+            app.router.add_get('/metrics', self._handle)
+
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+            self.logger.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+        if self.snapshot_path is not None:
+            self._task = asyncio.create_task(self._snapshot_loop())
+
+    async def _handle(self, _request):
+        return web.Response(
+            body=self.metrics.render().encode(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    def _write(self, text: str):
+        tmp = f'{self.snapshot_path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+
+        os.replace(tmp, self.snapshot_path)  # Readers never see a partial file
+
+    async def snapshot(self):
+        """Write the current metrics to the snapshot file"""
+        await asyncio.get_event_loop().run_in_executor(None, self._write, self.metrics.render())
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+
+            try:
+                await self.snapshot()
+            except OSError as e:
+                self.logger.error(f'Failed to write metrics snapshot: {e}')
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+            try:
+                await self.snapshot()  # Keep the final numbers
+            except OSError as e:
+                self.logger.error(f'Failed to write metrics snapshot: {e}')
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
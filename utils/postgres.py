@@ -0,0 +1,401 @@
+import asyncio
+import asyncpg
+import contextlib
+import os
+import socket
+import typing
+
+from .database import BaseDBConnection, StatementStats, json_dumps, json_loads
+from time import perf_counter
+
+# Connection pool, see asyncpg.create_pool
+POOL_MIN_SIZE = int(os.environ.get('ZOTE_DB_POOL_MIN', '2'))
+POOL_MAX_SIZE = int(os.environ.get('ZOTE_DB_POOL_MAX', '10'))
+POOL_MAX_INACTIVE = float(os.environ.get('ZOTE_DB_MAX_INACTIVE', '300'))  # Seconds before an idle connection closes
+COMMAND_TIMEOUT = float(os.environ.get('ZOTE_DB_COMMAND_TIMEOUT', '10'))  # Seconds a query may take client side
+STATEMENT_TIMEOUT_MS = int(os.environ.get('ZOTE_DB_STATEMENT_TIMEOUT_MS', '10000'))  # Server side, 0 to disable
+LISTEN_PING_INTERVAL = float(os.environ.get('ZOTE_DB_LISTEN_PING', '30'))  # Seconds between listener liveness checks
+
+CHANGES_CHANNEL = 'zotebot_changes'  # Notified by the triggers in SCHEMA
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS zotebot.voice_times (
+    guild_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    voice_time_spent_ms DOUBLE PRECISION NOT NULL DEFAULT 0,
+    voice_last_joined_ms DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS voice_times_top_idx
+    ON zotebot.voice_times (guild_id, voice_time_spent_ms DESC);
+-- Changed rows are notified with the origin of the connection that changed them, NULL for manual changes
+CREATE OR REPLACE FUNCTION zotebot.notify_change() RETURNS trigger AS $f$
+DECLARE
+    row_id BIGINT;  -- NULL when every row may have changed
+BEGIN
+    IF TG_LEVEL = 'ROW' THEN
+        IF TG_OP = 'DELETE' THEN
+            row_id := OLD.id;
+        ELSE
+            row_id := NEW.id;
+        END IF;
+    END IF;
+
+    PERFORM pg_notify('zotebot_changes', json_build_object(
+        'table', TG_TABLE_NAME, 'id', row_id, 'origin', current_setting('zotebot.origin', true)
+    )::text);
+    RETURN NULL;
+END $f$ LANGUAGE plpgsql;
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT FROM pg_trigger WHERE tgname = 'guilds_notify_change') THEN
+        CREATE TRIGGER guilds_notify_change AFTER INSERT OR UPDATE OR DELETE ON zotebot.guilds
+            FOR EACH ROW EXECUTE PROCEDURE zotebot.notify_change();
+        CREATE TRIGGER guilds_notify_truncate AFTER TRUNCATE ON zotebot.guilds
+            FOR EACH STATEMENT EXECUTE PROCEDURE zotebot.notify_change();
+    END IF;
+
+    IF NOT EXISTS (SELECT FROM pg_trigger WHERE tgname = 'users_notify_change') THEN
+        CREATE TRIGGER users_notify_change AFTER INSERT OR UPDATE OR DELETE ON zotebot.users
+            FOR EACH ROW EXECUTE PROCEDURE zotebot.notify_change();
+        CREATE TRIGGER users_notify_truncate AFTER TRUNCATE ON zotebot.users
+            FOR EACH STATEMENT EXECUTE PROCEDURE zotebot.notify_change();
+    END IF;
+
+    IF (SELECT data_type FROM information_schema.columns
+            WHERE table_schema = 'zotebot' AND table_name = 'guilds' AND column_name = 'rolemenu') <> 'jsonb' THEN
+        ALTER TABLE zotebot.guilds ALTER COLUMN rolemenu TYPE jsonb USING rolemenu::jsonb;
+    END IF;
+
+    IF (SELECT data_type FROM information_schema.columns
+            WHERE table_schema = 'zotebot' AND table_name = 'users' AND column_name = 'voice') <> 'jsonb' THEN
+        ALTER TABLE zotebot.users ALTER COLUMN voice TYPE jsonb USING voice::jsonb;
+    END IF;
+END $$;
+'''
+
+
+class StatementConnection(asyncpg.Connection):
+    """
+    Pool connection holding the statements prepared for it by StatementRegistry.
+    """
+    __slots__ = ('prepared',)
+
+
+class StatementRegistry:
+    """
+    Named queries, the hot ones prepared on every pool connection, with execution counts and timings.
+    """
+    def __init__(self, schema: str, stats: typing.Dict[str, StatementStats]):
+        self.schema = schema
+        self.queries: typing.Dict[str, str] = {}  # name -> query
+        self.hot: typing.List[str] = []  # Names prepared when a connection is created
+        self.stats = stats
+
+    def register(self, name: str, query: str, hot: bool = False):
+        """Add a named query"""
+        self.queries[name] = query
+        if hot:
+            self.hot.append(name)
+
+    def update(self, table: str, columns: typing.Tuple[str, ...], returning: bool = False) -> str:
+        """
+        Get the name of the UPDATE query for a set of sorted, already checked columns.
+        The query text only depends on the columns, so each set of columns is one cached statement.
+        """
+        name = f'update_{table}:{",".join(columns)}' + (':returning' if returning else '')
+        if name not in self.queries:
+            self.queries[name] = 'UPDATE {}.{} SET {} WHERE id = $1{}'.format(
+                self.schema, table, ', '.join(f'{c} = ${n}' for n, c in enumerate(columns, 2)),
+                ' RETURNING *' if returning else ''
+            )
+
+        return name
+
+    async def prepare(self, conn):
+        """Prepare the hot queries on a new connection"""
+        conn.prepared = {name: await conn.prepare(self.queries[name]) for name in self.hot}
+
+    async def _run(self, conn, method: str, name: str, *args):
+        start = perf_counter()
+        stats = self.stats.get(name) or self.stats.setdefault(name, StatementStats())
+
+        try:
+            if (stmt := getattr(conn, 'prepared', {}).get(name)) is not None and hasattr(stmt, method):
+                return await getattr(stmt, method)(*args)  # Prepared on this connection
+
+            return await getattr(conn, method)(self.queries[name], *args)  # Uses the connection statement cache
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.observe((perf_counter() - start) * 1000)
+
+    async def fetch(self, conn, name: str, *args):
+        return await self._run(conn, 'fetch', name, *args)
+
+    async def fetchrow(self, conn, name: str, *args):
+        return await self._run(conn, 'fetchrow', name, *args)
+
+    async def execute(self, conn, name: str, *args):
+        return await self._run(conn, 'execute', name, *args)
+
+    async def executemany(self, conn, name: str, args):
+        return await self._run(conn, 'executemany', name, args)
+
+
+class PostgresConnection(BaseDBConnection):
+    """
+    Postgres backend, an asyncpg pool with the hot queries prepared on every connection.
+    """
+    def __init__(self, host: str, db_name: str, user: str,
+                 columns: typing.Dict[str, typing.Iterable[str]], schema: typing.Optional[str] = SCHEMA):
+        super().__init__(columns)
+        self.pool: typing.Optional[asyncpg.pool.Pool] = None
+        self.host = host
+        self.db_name = db_name
+        self.user = user
+        self.schema = schema  # Run once before statements are prepared
+        self.statements = StatementRegistry('zotebot', self.stats)
+        self._schema_lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+        self._schema_ready = schema is None
+        self.origin = f'{socket.gethostname()}:{os.getpid()}'  # Changes made by this process are not notified back
+
+        # Hot queries, prepared on every pool connection
+        self.statements.register('get_guilds', 'SELECT * FROM zotebot.guilds WHERE id = ANY($1::bigint[])', hot=True)
+        self.statements.register('get_users', 'SELECT * FROM zotebot.users WHERE id = ANY($1::bigint[])', hot=True)
+        # Rows inserted by the CTE are not visible to the second SELECT, so each id is returned once
+        self.statements.register('get_or_create_users', '''
+            WITH inserted AS (
+                INSERT INTO zotebot.users (id)
+                    SELECT unnest($1::bigint[])
+                    ON CONFLICT (id) DO NOTHING
+                    RETURNING *
+            )
+            SELECT * FROM inserted
+            UNION ALL
+            SELECT * FROM zotebot.users WHERE id = ANY($1::bigint[])
+        ''', hot=True)
+        self.statements.register('get_voice_time', '''
+            SELECT voice_time_spent_ms, voice_last_joined_ms FROM zotebot.voice_times
+                WHERE guild_id = $1 AND user_id = $2
+        ''', hot=True)
+        self.statements.register('add_voice_times', '''
+            INSERT INTO zotebot.voice_times (guild_id, user_id, voice_time_spent_ms)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (guild_id, user_id) DO UPDATE
+                    SET voice_time_spent_ms = voice_times.voice_time_spent_ms + EXCLUDED.voice_time_spent_ms
+        ''', hot=True)
+        # Served by voice_times_top_idx, only the top rows are read
+        self.statements.register('get_top_voice_times', '''
+            SELECT user_id, voice_time_spent_ms FROM zotebot.voice_times
+                WHERE guild_id = $1 AND voice_time_spent_ms > 0
+                ORDER BY voice_time_spent_ms DESC
+                LIMIT $2
+        ''', hot=True)
+        self.statements.register('new_guild', 'INSERT INTO zotebot.guilds (id) VALUES ($1) RETURNING *')
+        self.statements.register('new_user', 'INSERT INTO zotebot.users VALUES ($1)')
+        self.statements.register('load_guilds', 'SELECT * FROM zotebot.guilds')
+        # Only guilds on the given shards, see discord's shard formula
+        self.statements.register(
+            'load_shard_guilds', 'SELECT * FROM zotebot.guilds WHERE ((id >> 22) % $2) = ANY($1::int[])')
+        # Existing voice_times rows are kept, so running this again is harmless
+        self.statements.register('migrate_voice_times', '''
+            INSERT INTO zotebot.voice_times (guild_id, user_id, voice_time_spent_ms, voice_last_joined_ms)
+                SELECT v.key::bigint, u.id,
+                       COALESCE((v.value->>'voice_time_spent_ms')::double precision, 0),
+                       COALESCE((v.value->>'voice_last_joined_ms')::double precision, 0)
+                    FROM zotebot.users u, jsonb_each(u.voice) v
+                    WHERE jsonb_typeof(v.value) = 'object'
+                ON CONFLICT (guild_id, user_id) DO NOTHING
+        ''')
+
+    async def connect(self):
+        if self.is_connected:
+            return
+
+        async with self._connect_lock:  # Events handled during startup connect at the same time as startup
+            if self.is_connected:
+                return
+
+            self.pool = await asyncpg.create_pool(  # Create a connection pool
+                min_size=POOL_MIN_SIZE,
+                max_size=POOL_MAX_SIZE,
+                max_inactive_connection_lifetime=POOL_MAX_INACTIVE,
+                connection_class=StatementConnection,
+                init=self._init_connection,
+                **self._connect_kwargs()
+            )
+
+    def _connect_kwargs(self) -> dict:
+        return {
+            'user': self.user,
+            'password': os.environ.get('ZOTE_DB_PASSWORD'),
+            'database': self.db_name,
+            'host': self.host,
+            'command_timeout': COMMAND_TIMEOUT,
+            'server_settings': {
+                'application_name': 'zotebot',
+                'statement_timeout': str(STATEMENT_TIMEOUT_MS),
+                'zotebot.origin': self.origin  # Read by the notify_change trigger
+            }
+        }
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Acquire a pool connection, recording how long it took"""
+        start = perf_counter()
+        async with self.pool.acquire() as conn:
+            self.acquire_wait.observe((perf_counter() - start) * 1000)
+            yield conn
+
+    async def _init_connection(self, conn):
+        """Set up a new pool connection"""
+        if not self._schema_ready:
+            async with self._schema_lock:  # Pool connections are opened concurrently
+                if not self._schema_ready:
+                    await conn.execute(self.schema)  # Create any tables missing from the database
+                    self._schema_ready = True
+
+        for type_ in ('json', 'jsonb'):  # Send and receive json columns as python objects
+            await conn.set_type_codec(type_, encoder=json_dumps, decoder=json_loads, schema='pg_catalog')
+
+        await self.statements.prepare(conn)  # Prepare the hot queries
+
+    async def close(self):
+        if not self.pool:
+            self.logger.error(f'Connection pool for database {self.db_name} does not exist.')
+            return
+
+        await self.pool.close()
+        self.pool = None
+
+    @property
+    def is_connected(self) -> bool:
+        return self.pool is not None
+
+    def pool_stats(self) -> typing.Optional[dict]:
+        if not self.is_connected:
+            return None
+
+        return {
+            'size': self.pool.get_size(),
+            'idle': self.pool.get_idle_size(),
+            'min': self.pool.get_min_size(),
+            'max': self.pool.get_max_size()
+        }
+
+    # Change notifications
+
+    @property
+    def can_listen(self) -> bool:
+        return True
+
+    async def _listen_once(self, callback: typing.Callable[[str, typing.Optional[int]], None],
+                           ready: typing.Callable[[], None]):
+        conn = await asyncpg.connect(**self._connect_kwargs())  # Not from the pool, it is held while listening
+        lost = asyncio.Event()
+
+        def notified(_conn, _pid, _channel, payload: str):
+            change = json_loads(payload)
+            if change['origin'] != self.origin:  # Already applied by this process
+                callback(change['table'], change['id'])
+
+        try:
+            conn.add_termination_listener(lambda _conn: lost.set())
+            await conn.add_listener(CHANGES_CHANNEL, notified)
+            ready()
+
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), LISTEN_PING_INTERVAL)
+                except asyncio.TimeoutError:
+                    await conn.execute('SELECT 1')  # A dead connection may not be noticed otherwise
+        finally:
+            if not conn.is_closed():
+                conn.terminate()
+
+    # Guilds
+
+    async def get_guilds(self, guild_ids: typing.List[int]) -> typing.List[dict]:
+        async with self.acquire() as conn:
+            return [dict(x) for x in await self.statements.fetch(conn, 'get_guilds', guild_ids)]
+
+    async def load_guilds(self, shard_ids: typing.Optional[typing.List[int]] = None,
+                          shard_count: typing.Optional[int] = None) -> typing.List[dict]:
+        async with self.acquire() as conn:
+            if shard_ids is not None and shard_count:
+                res = await self.statements.fetch(conn, 'load_shard_guilds', shard_ids, shard_count)
+            else:
+                res = await self.statements.fetch(conn, 'load_guilds')
+
+        return [dict(x) for x in res]
+
+    async def new_guild(self, guild_id: int) -> dict:
+        async with self.acquire() as conn:
+            return dict(await self.statements.fetchrow(conn, 'new_guild', guild_id))
+
+    # Users
+
+    async def get_users(self, user_ids: typing.List[int]) -> typing.List[dict]:
+        async with self.acquire() as conn:
+            return [dict(x) for x in await self.statements.fetch(conn, 'get_users', user_ids)]
+
+    async def get_or_create_users(self, user_ids: typing.List[int]) -> typing.List[dict]:
+        async with self.acquire() as conn:
+            return [dict(x) for x in await self.statements.fetch(conn, 'get_or_create_users', user_ids)]
+
+    async def new_user(self, user_id: int):
+        async with self.acquire() as conn:
+            await self.statements.execute(conn, 'new_user', user_id)
+
+    # Updates
+
+    async def update(self, table: str, row_id: int, data: dict, returning: bool = False) -> typing.Optional[dict]:
+        columns = self.check_update(table, data)
+        name = self.statements.update(table, columns, returning)
+        values = [data[c] for c in columns]  # dicts are encoded by the jsonb codec
+
+        async with self.acquire() as conn:
+            if returning:
+                res = await self.statements.fetchrow(conn, name, row_id, *values)
+                return dict(res) if res else None
+
+            await self.statements.execute(conn, name, row_id, *values)
+
+    async def update_many(self, updates: typing.Iterable[typing.Tuple[str, int, dict]]):
+        # Rows updating the same columns share a statement
+        groups: typing.Dict[str, list] = {}
+        for table, row_id, data in updates:
+            columns = self.check_update(table, data)
+            groups.setdefault(self.statements.update(table, columns), []).append(
+                (row_id, *(data[c] for c in columns)))
+
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                for name, args in groups.items():
+                    await self.statements.executemany(conn, name, args)
+
+    # Voice
+
+    async def get_voice_time(self, guild_id: int, user_id: int) -> typing.Optional[dict]:
+        async with self.acquire() as conn:
+            res = await self.statements.fetchrow(conn, 'get_voice_time', guild_id, user_id)
+
+        return dict(res) if res else None
+
+    async def add_voice_times(self, entries: typing.Iterable[typing.Tuple[int, int, float]]):
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await self.statements.executemany(conn, 'add_voice_times', entries)  # Insert or add to voice rows
+
+    async def get_top_voice_times(self, guild_id: int, limit: int) -> typing.List[dict]:
+        async with self.acquire() as conn:
+            return [dict(x) for x in await self.statements.fetch(conn, 'get_top_voice_times', guild_id, limit)]
+
+    async def migrate_voice_times(self) -> int:
+        async with self.acquire() as conn:
+            res = await self.statements.execute(conn, 'migrate_voice_times')  # Returns 'INSERT 0 <rows>'
+
+        return int(res.split()[-1])
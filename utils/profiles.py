@@ -0,0 +1,168 @@
+import array
+import discord
+import itertools
+import os
+import sys
+import typing
+
+
+class CogNeeds:
+    """
+    What a cog needs from the gateway, from discord.py's caches and from other cogs.
+    Intents are fixed when the client is created, so needs are declared here rather than on the cogs.
+    """
+    __slots__ = ('intents', 'member_cache', 'message_cache', 'chunk', 'requires')
+
+    def __init__(self, intents: typing.Iterable[str] = (), member_cache: typing.Iterable[str] = (),
+                 message_cache: bool = False, chunk: bool = False, requires: typing.Iterable[str] = ()):
+        self.intents = frozenset(intents)  # discord.Intents flags
+        self.member_cache = frozenset(member_cache)  # discord.MemberCacheFlags flags
+        self.message_cache = message_cache  # Reads messages from the cache, eg. deleted or edited messages
+        # Needs every member cached. Without chunking, only members in voice or that joined since startup are cached
+        self.chunk = chunk
+        self.requires = tuple(requires)  # Cogs loaded before this one, see utils.startup.load_order
+
+
+# Processing commands, member converters query the gateway for members that are not cached
+COMMANDS = CogNeeds(intents=('guilds', 'guild_messages', 'dm_messages', 'members'))
+
+# Cogs that are not listed get everything
+UNKNOWN = CogNeeds(intents=discord.Intents.VALID_FLAGS, member_cache=discord.MemberCacheFlags.VALID_FLAGS,
+                   message_cache=True, chunk=True)
+
+COG_NEEDS = {  # cog file name -> needs, update when a cog starts using a new event or cache
+    'admin': CogNeeds(),
+    'basic': CogNeeds(),
+    'db': CogNeeds(),
+    'info': CogNeeds(),
+    'moderation': CogNeeds(requires=('log_events',)),  # Sends its logs through LogEvents
+    'settings': CogNeeds(),
+    # Leave and member update logs only fire for cached members, on_ready reads members in voice channels.
+    # Delete and edit logs use the bot's message store, not discord.py's message cache
+    'log_events': CogNeeds(intents=('guilds', 'members', 'bans', 'voice_states', 'guild_reactions', 'guild_messages'),
+                           member_cache=('joined', 'voice'), chunk=True)
+}
+
+
+def cog_requires(cog: str) -> typing.Tuple[str, ...]:
+    """Get the cogs a cog requires"""
+    return COG_NEEDS.get(cog, UNKNOWN).requires
+
+
+class Profile:
+    """
+    Named set of cogs and cache settings, intents and caches are only enabled if a loaded cog needs them.
+    """
+    __slots__ = ('name', 'description', 'cogs', 'commands', 'chunk', 'max_messages')
+
+    def __init__(self, name: str, description: str, cogs: typing.Optional[typing.Iterable[str]] = None,
+                 commands: bool = True, chunk: typing.Optional[bool] = None, max_messages: int = 1000):
+        self.name = name
+        self.description = description
+        self.cogs = frozenset(cogs) if cogs is not None else None  # None to load every cog
+        self.commands = commands  # Process commands
+        self.chunk = chunk  # Request every member on startup, None if any cog needs it
+        self.max_messages = max_messages  # Messages cached, if a cog reads the message cache
+
+    def select_cogs(self, available: typing.Iterable[str]) -> typing.List[str]:
+        """Get the cogs of this profile, in the order of available"""
+        return [c for c in available if self.cogs is None or c in self.cogs]
+
+    def client_options(self, cogs: typing.Iterable[str]) -> dict:
+        """Get the intents and cache options of the client for the loaded cogs"""
+        needs = [COG_NEEDS.get(c, UNKNOWN) for c in cogs] + ([COMMANDS] if self.commands else [])
+
+        intents = discord.Intents.none()
+        intents.guilds = True  # discord.py's state relies on guild events
+        member_cache = discord.MemberCacheFlags.none()
+        for n in needs:
+            for flag in n.intents:
+                setattr(intents, flag, True)
+            for flag in n.member_cache:
+                setattr(member_cache, flag, True)
+
+        chunk = any(n.chunk for n in needs) if self.chunk is None else self.chunk
+        max_messages = int(os.environ.get('ZOTE_MAX_MESSAGES', self.max_messages))
+
+        return {
+            'intents': intents,
+            'member_cache_flags': member_cache,
+            'chunk_guilds_at_startup': chunk and intents.members and member_cache.joined,
+            'max_messages': max_messages if max_messages and any(n.message_cache for n in needs) else None
+        }
+
+
+PROFILES = {p.name: p for p in (
+    Profile('full', 'every cog, every member cached on startup'),
+    Profile('watcher', 'logging only, commands are not processed', cogs=('log_events',), commands=False),
+    Profile('minimal', 'commands only, no logging and no member or message cache',
+            cogs=('admin', 'basic', 'db', 'info', 'settings'))
+)}
+
+
+def get_profile(name: typing.Optional[str] = None) -> Profile:
+    """Get a profile by name, or the one named by ZOTE_PROFILE, watcher if WATCHER_MODE is set"""
+    default = 'watcher' if os.environ.get('WATCHER_MODE', '0') == '1' else 'full'
+    name = name or os.environ.get('ZOTE_PROFILE', default)
+
+    if (profile := PROFILES.get(name)) is None:
+        raise ValueError(f'Unknown profile {name}, expected one of {", ".join(PROFILES)}')
+
+    return profile
+
+
+# Memory estimates
+
+_PLAIN = (str, bytes, int, float, tuple, list, dict, set, frozenset, array.array)  # Counted as part of an object
+_slots_cache: typing.Dict[type, typing.Tuple[str, ...]] = {}
+
+
+def _slots(cls: type) -> typing.Tuple[str, ...]:
+    if (slots := _slots_cache.get(cls)) is None:
+        slots = tuple(s for c in cls.__mro__ for s in getattr(c, '__slots__', ()) if s != '__weakref__')
+        _slots_cache[cls] = slots
+
+    return slots
+
+
+def object_size(obj) -> int:
+    """
+    Estimate the bytes used by an object and the plain values it holds.
+    Other objects it refers to, eg. the user of a member, are left out, they are counted with their own class.
+    """
+    size = sys.getsizeof(obj)
+    values = [getattr(obj, s, None) for s in _slots(type(obj))]
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+        values.extend(obj.__dict__.values())
+
+    for value in values:
+        if isinstance(value, _PLAIN):
+            size += sys.getsizeof(value)
+            if isinstance(value, (tuple, list, set, frozenset)):
+                size += sum(sys.getsizeof(v) for v in value if isinstance(v, (str, int)))
+            elif isinstance(value, dict):
+                size += sum(sys.getsizeof(v) for v in value.values() if isinstance(v, (str, int)))
+
+    return size
+
+
+def estimate_cache_memory(client: discord.Client, sample: int = 200) -> typing.List[typing.Tuple[str, int, float]]:
+    """Estimate the memory used by discord.py's caches, (name, objects, average bytes) for each kind of object"""
+    guilds = client.guilds
+    caches = {
+        'guilds': (len(guilds), guilds),
+        'channels': (sum(len(g.channels) for g in guilds), itertools.chain.from_iterable(g.channels for g in guilds)),
+        'roles': (sum(len(g.roles) for g in guilds), itertools.chain.from_iterable(g.roles for g in guilds)),
+        'members': (sum(len(g.members) for g in guilds), itertools.chain.from_iterable(g.members for g in guilds)),
+        'users': (len(client.users), client.users),
+        'emojis': (len(client.emojis), client.emojis),
+        'messages': (len(client.cached_messages), client.cached_messages)
+    }
+
+    res = []
+    for name, (count, objects) in caches.items():
+        sizes = [object_size(o) for o in itertools.islice(objects, sample)]  # Averaged over the first objects
+        res.append((name, count, sum(sizes) / len(sizes) if sizes else 0.0))
+
+    return res
@@ -0,0 +1,51 @@
+import typing
+
+
+def emoji_key(emoji) -> str:
+    """Get the key an emoji is stored under in a rolemenu, the id for custom emojis and the name otherwise"""
+    return str(emoji.name) if emoji.id is None else str(emoji.id)
+
+
+class RoleMenuIndex:
+    """
+    Reaction roles of every loaded guild, keyed by (guild id, message id, emoji key).
+    A reaction only matches an entry of its own guild and channel.
+    """
+    def __init__(self):
+        # (guild id, message id, emoji key) -> (channel id, role id)
+        self.entries: typing.Dict[typing.Tuple[int, int, str], typing.Tuple[int, int]] = {}
+        self.guild_keys: typing.Dict[int, typing.List[typing.Tuple[int, int, str]]] = {}  # guild id -> its entry keys
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self.guild_keys
+
+    def set_guild(self, guild_id: int, rolemenu: typing.Optional[dict]):
+        """Replace the entries of a guild from its rolemenu ({channel id: {message id: {emoji: role id}}})"""
+        self.remove_guild(guild_id)
+        keys = []
+
+        for channel_id, messages in (rolemenu or {}).items():
+            for message_id, emojis in messages.items():
+                for emoji, role_id in emojis.items():
+                    key = (guild_id, int(message_id), str(emoji))
+                    self.entries[key] = (int(channel_id), int(role_id))
+                    keys.append(key)
+
+        self.guild_keys[guild_id] = keys
+
+    def remove_guild(self, guild_id: int):
+        """Remove the entries of a guild"""
+        for key in self.guild_keys.pop(guild_id, ()):
+            self.entries.pop(key, None)
+
+    def get_role(self, guild_id: int, channel_id: int, message_id: int, emoji) -> typing.Optional[int]:
+        """Get the role id given by reacting to a message with an emoji, None if it is not a menu reaction"""
+        entry = self.entries.get((guild_id, message_id, emoji_key(emoji)))
+        if entry is None or entry[0] != channel_id:
+            return None
+
+        return entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.guild_keys.clear()
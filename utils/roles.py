@@ -0,0 +1,116 @@
+import asyncio
+import discord
+import logging
+import typing
+
+
+class RoleMutationQueue:
+    """
+    Collects role adds and removes per member and applies them in a single member edit after a debounce.
+    The edit replaces the member's whole role list, so it is built from the cached roles right before it is sent.
+    Members that are not cached get one request per role instead, which leaves their other roles alone.
+    """
+    def __init__(self, http, debounce: float = 1.0, concurrency: int = 4):
+        self.http = http  # discord.py HTTPClient, for role changes of members that are not cached
+        self.debounce = debounce  # Seconds to wait for more changes before editing a member
+        self.pending: typing.Dict[typing.Tuple[int, int], typing.Dict[int, bool]] = {}  # -> {role id: add}
+        self.guilds: typing.Dict[typing.Tuple[int, int], discord.Guild] = {}  # guild of each key
+        self.tasks: typing.Dict[typing.Tuple[int, int], asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)  # Member edits running at once across all guilds
+
+        # Counters
+        self.requested = 0  # Role changes queued
+        self.coalesced = 0  # Role changes merged into an already queued edit
+        self.skipped = 0  # Edits not sent because the member already had the final roles
+        self.applied = 0  # Requests sent, a member edit or a single role change
+        self.failed = 0  # Requests that raised
+
+        self.logger = logging.getLogger('utils.roles')
+
+    def add(self, member: discord.abc.Snowflake, role: discord.Role):
+        """Queue giving a role to a member, or to any object with the member's id"""
+        self._queue(role.guild, member.id, role.id, True)
+
+    def remove(self, member: discord.abc.Snowflake, role: discord.Role):
+        """Queue taking a role from a member, or from any object with the member's id"""
+        self._queue(role.guild, member.id, role.id, False)
+
+    def _queue(self, guild: discord.Guild, user_id: int, role_id: int, add: bool):
+        key = (guild.id, user_id)
+        self.requested += 1
+
+        if key in self.pending:  # Merge with the edit already waiting for this member
+            self.coalesced += 1
+
+        self.pending.setdefault(key, {})[role_id] = add  # Last change for a role wins
+        self.guilds[key] = guild
+
+        if key not in self.tasks:
+            self.tasks[key] = asyncio.create_task(self._apply(key))
+
+    async def _apply(self, key: typing.Tuple[int, int]):
+        try:
+            await asyncio.sleep(self.debounce)  # Wait for the member to stop toggling
+
+            async with self._semaphore:
+                await self._edit(key)
+        finally:
+            if self.tasks.get(key) is asyncio.current_task():  # Already removed if close cancelled it
+                del self.tasks[key]
+
+        if key in self.pending:  # Changes queued while this edit was running
+            self.tasks[key] = asyncio.create_task(self._apply(key))
+
+    async def _edit(self, key: typing.Tuple[int, int]):
+        changes = self.pending.pop(key)
+        guild = self.guilds.pop(key)
+        user_id = key[1]
+
+        # Read the roles now, after the debounce and the semaphore, roles changed meanwhile by others are kept
+        member = guild.get_member(user_id)
+        if member is not None:
+            current = {r.id for r in member.roles if not r.is_default()}
+            changes = {role_id: add for role_id, add in changes.items() if (role_id in current) != add}
+
+            if not changes:  # Changes cancelled out or were already applied
+                self.skipped += 1
+                return
+
+        try:
+            if member is None or len(changes) == 1:  # Roles unknown, or a single change needs no full list
+                for role_id, add in changes.items():
+                    if add:
+                        await self.http.add_role(guild.id, user_id, role_id)
+                    else:
+                        await self.http.remove_role(guild.id, user_id, role_id)
+                    self.applied += 1
+            else:
+                desired = current ^ set(changes)  # Only changes that toggle a role are left
+                await member.edit(roles=[discord.Object(id=role_id) for role_id in desired])  # One request
+                self.applied += 1
+        except discord.HTTPException as e:
+            self.failed += 1
+            self.logger.error(f'Failed to edit roles of {user_id} in {guild.id}: {e}')
+
+    def close(self):
+        """Cancel the edits waiting to be sent, used when the cog is unloaded"""
+        for task in self.tasks.values():
+            task.cancel()
+
+        if self.pending:
+            self.logger.warning(f'Dropping role menu changes of {len(self.pending)} members')
+
+        self.tasks.clear()
+        self.pending.clear()
+        self.guilds.clear()
+
+    def stats(self) -> dict:
+        """Get the queue counters"""
+        return {
+            'pending': len(self.pending),
+            'requested': self.requested,
+            'coalesced': self.coalesced,
+            'skipped': self.skipped,
+            'applied': self.applied,
+            'failed': self.failed
+        }
@@ -0,0 +1,329 @@
+import asyncio
+import os
+import socket
+import sqlite3
+import typing
+import uuid
+
+from .database import BaseDBConnection, StatementStats, json_dumps, json_loads
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS guilds (
+    id INTEGER PRIMARY KEY,
+    prefix TEXT,
+    logs INTEGER NOT NULL DEFAULT 0,
+    timezone TEXT,
+    afk_channel INTEGER NOT NULL DEFAULT 0,
+    rolemenu TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    access_level INTEGER NOT NULL DEFAULT 0,
+    voice TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS voice_times (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    voice_time_spent_ms REAL NOT NULL DEFAULT 0,
+    voice_last_joined_ms REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (guild_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS voice_times_top_idx ON voice_times (guild_id, voice_time_spent_ms DESC);
+-- Rows changed by each connection, read by the others to update their caches, row_id is NULL for a whole table
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    row_id INTEGER,
+    changed_at REAL NOT NULL
+);
+'''
+
+POLL_INTERVAL = float(os.environ.get('ZOTE_SQLITE_POLL', '5'))  # Seconds between checks for changes by other processes
+CHANGES_TTL = 3600.0  # Seconds rows of the changes table are kept
+PRUNE_INTERVAL = 60.0  # Seconds between removing expired rows of the changes table
+
+JSON_COLUMNS = frozenset(('rolemenu', 'voice'))  # Stored as json text
+
+# Lists of ids are passed as one json array parameter
+IDS = 'SELECT value FROM json_each(?1)'
+
+
+class SQLiteConnection(BaseDBConnection):
+    """
+    Embedded backend, a single sqlite connection used from its own thread so queries never block the event loop.
+    Each method runs as one job on that thread, so writes made by a method are one transaction.
+    """
+    def __init__(self, path: str, columns: typing.Dict[str, typing.Iterable[str]]):
+        super().__init__(columns)
+        self.path = path
+        self._conn: typing.Optional[sqlite3.Connection] = None
+        self._executor: typing.Optional[ThreadPoolExecutor] = None
+        self._lock = asyncio.Lock()
+        self.origin = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'  # Changes skipped by the poll
+        self._next_prune = 0.0
+
+    async def connect(self):
+        if self.is_connected:
+            return
+
+        async with self._lock:  # Calls made while opening wait for the same open
+            if self.is_connected:
+                return
+
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='zote-sqlite')
+            self._conn = await asyncio.get_event_loop().run_in_executor(executor, self._open_sync)
+            self._executor = executor
+
+    def _open_sync(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)  # Only used from the executor thread
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.executescript(SCHEMA)  # Create any tables missing from the database
+        conn.commit()
+        return conn
+
+    async def close(self):
+        if not self.is_connected:
+            self.logger.error(f'Database {self.path} is not open.')
+            return
+
+        executor, self._executor = self._executor, None
+        await asyncio.get_event_loop().run_in_executor(executor, self._conn.close)
+        executor.shutdown()
+        self._conn = None
+
+    @property
+    def is_connected(self) -> bool:
+        return self._executor is not None
+
+    # Change notifications
+
+    @property
+    def can_listen(self) -> bool:
+        return self.path != ':memory:'  # Other processes can only open a database file
+
+    def _record(self, conn: sqlite3.Connection, table: str, row_ids: typing.Iterable[typing.Optional[int]]):
+        """Add changed rows to the changes table, in the transaction of the change"""
+        if not (row_ids := list(row_ids)):
+            return
+
+        now = time()
+        conn.executemany('INSERT INTO changes (origin, table_name, row_id, changed_at) VALUES (?1, ?2, ?3, ?4)',
+                         [(self.origin, table, row_id, now) for row_id in row_ids])
+
+        if now >= self._next_prune:  # Pruned along with a change, so other connections see a new row
+            conn.execute('DELETE FROM changes WHERE changed_at < ?1', (now - CHANGES_TTL,))
+            self._next_prune = now + PRUNE_INTERVAL
+
+    def _poll(self, last: typing.Optional[int]) -> typing.Tuple[int, typing.Optional[int], typing.List[tuple]]:
+        """Get data_version, the oldest change kept and the changes after last, only the newest change if None"""
+        conn = self._conn
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        first, newest = conn.execute('SELECT MIN(seq), MAX(seq) FROM changes').fetchone()
+
+        if last is None:
+            return version, first, [(newest or 0, self.origin, None, None)]
+
+        rows = conn.execute('SELECT seq, origin, table_name, row_id FROM changes WHERE seq > ?1 ORDER BY seq',
+                            (last,)).fetchall()
+        return version, first, [tuple(r) for r in rows]
+
+    async def _listen_once(self, callback: typing.Callable[[str, typing.Optional[int]], None],
+                           ready: typing.Callable[[], None]):
+        """
+        sqlite has no notifications, changed rows are read from the changes table written with every change.
+        data_version changes when another connection commits, a commit without changes rows was not made by
+        a backend, eg. by hand, so every guild and user is reported as changed.
+        """
+        loop = asyncio.get_event_loop()
+        version, last = None, None
+
+        while self.is_connected:
+            current, first, rows = await loop.run_in_executor(self._executor, self._poll, last)
+            if last is None:
+                ready()
+            elif first is not None and first > last + 1:  # Changes expired before they were read
+                callback(None, None)
+            elif current != version and not any(origin != self.origin for _, origin, _, _ in rows):
+                callback(None, None)
+            else:
+                for change in {(table, row_id) for _, origin, table, row_id in rows if origin != self.origin}:
+                    callback(*change)
+
+            version = current
+            last = rows[-1][0] if rows else last
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def _run(self, name: str, func: typing.Callable, *args):
+        """Run func(conn, *args) on the database thread and commit, recording it under name"""
+        stats = self.stats.get(name) or self.stats.setdefault(name, StatementStats())
+        queued = perf_counter()
+
+        def job():
+            start = perf_counter()
+            try:
+                res = func(self._conn, *args)
+                self._conn.commit()
+                return start, res
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+        try:
+            start, res = await asyncio.get_event_loop().run_in_executor(self._executor, job)
+        except Exception:
+            stats.errors += 1
+            stats.observe((perf_counter() - queued) * 1000)
+            raise
+
+        self.acquire_wait.observe((start - queued) * 1000)  # Time spent waiting for the thread
+        stats.observe((perf_counter() - queued) * 1000)
+        return res
+
+    @staticmethod
+    def _row(row: typing.Optional[sqlite3.Row]) -> typing.Optional[dict]:
+        if row is None:
+            return None
+
+        res = dict(row)
+        for column in JSON_COLUMNS.intersection(res):
+            if res[column] is not None:
+                res[column] = json_loads(res[column])
+
+        return res
+
+    def _fetch(self, conn: sqlite3.Connection, query: str, *args) -> typing.List[dict]:
+        return [self._row(r) for r in conn.execute(query, args)]
+
+    # Guilds
+
+    async def get_guilds(self, guild_ids: typing.List[int]) -> typing.List[dict]:
+        return await self._run('get_guilds', self._fetch, f'SELECT * FROM guilds WHERE id IN ({IDS})',
+                               json_dumps(guild_ids))
+
+    async def load_guilds(self, shard_ids: typing.Optional[typing.List[int]] = None,
+                          shard_count: typing.Optional[int] = None) -> typing.List[dict]:
+        if shard_ids is not None and shard_count:
+            # Only guilds on the given shards, see discord's shard formula
+            return await self._run('load_shard_guilds', self._fetch,
+                                   f'SELECT * FROM guilds WHERE ((id >> 22) % ?2) IN ({IDS})',
+                                   json_dumps(shard_ids), shard_count)
+
+        return await self._run('load_guilds', self._fetch, 'SELECT * FROM guilds')
+
+    async def new_guild(self, guild_id: int) -> dict:
+        def new_guild(conn):
+            conn.execute('INSERT INTO guilds (id) VALUES (?1)', (guild_id,))
+            self._record(conn, 'guilds', [guild_id])
+            return self._row(conn.execute('SELECT * FROM guilds WHERE id = ?1', (guild_id,)).fetchone())
+
+        return await self._run('new_guild', new_guild)
+
+    # Users
+
+    async def get_users(self, user_ids: typing.List[int]) -> typing.List[dict]:
+        return await self._run('get_users', self._fetch, f'SELECT * FROM users WHERE id IN ({IDS})',
+                               json_dumps(user_ids))
+
+    async def get_or_create_users(self, user_ids: typing.List[int]) -> typing.List[dict]:
+        def get_or_create_users(conn, ids: str):
+            # Other connections may have cached the new users as missing
+            self._record(conn, 'users', [r[0] for r in conn.execute(
+                f'SELECT value FROM json_each(?1) WHERE value NOT IN (SELECT id FROM users)', (ids,))])
+            conn.execute(f'INSERT OR IGNORE INTO users (id) {IDS}', (ids,))
+            return self._fetch(conn, f'SELECT * FROM users WHERE id IN ({IDS})', ids)
+
+        return await self._run('get_or_create_users', get_or_create_users, json_dumps(user_ids))
+
+    async def new_user(self, user_id: int):
+        def new_user(conn):
+            conn.execute('INSERT INTO users (id) VALUES (?1)', (user_id,))
+            self._record(conn, 'users', [user_id])
+
+        await self._run('new_user', new_user)
+
+    # Updates
+
+    def _update(self, conn: sqlite3.Connection, table: str, row_id: int, data: dict) -> int:
+        columns = self.check_update(table, data)
+        values = [json_dumps(data[c]) if c in JSON_COLUMNS else data[c] for c in columns]
+        query = 'UPDATE {} SET {} WHERE id = ?1'.format(
+            table, ', '.join(f'{c} = ?{n}' for n, c in enumerate(columns, 2)))
+
+        if count := conn.execute(query, (row_id, *values)).rowcount:
+            self._record(conn, table, [row_id])
+
+        return count
+
+    async def update(self, table: str, row_id: int, data: dict, returning: bool = False) -> typing.Optional[dict]:
+        self.check_update(table, data)  # Raise before queueing the job
+
+        def update(conn):
+            if self._update(conn, table, row_id, data) and returning:
+                return self._row(conn.execute(f'SELECT * FROM {table} WHERE id = ?1', (row_id,)).fetchone())
+
+        return await self._run(f'update_{table}', update)
+
+    async def update_many(self, updates: typing.Iterable[typing.Tuple[str, int, dict]]):
+        updates = list(updates)
+        for table, _, data in updates:  # Raise before queueing the job
+            self.check_update(table, data)
+
+        def update_many(conn):
+            for table, row_id, data in updates:
+                self._update(conn, table, row_id, data)
+
+        await self._run('update_many', update_many)
+
+    # Voice
+
+    async def get_voice_time(self, guild_id: int, user_id: int) -> typing.Optional[dict]:
+        res = await self._run('get_voice_time', self._fetch, '''
+            SELECT voice_time_spent_ms, voice_last_joined_ms FROM voice_times
+                WHERE guild_id = ?1 AND user_id = ?2
+        ''', guild_id, user_id)
+
+        return res[0] if res else None
+
+    async def add_voice_times(self, entries: typing.Iterable[typing.Tuple[int, int, float]]):
+        entries = list(entries)
+
+        def add_voice_times(conn):
+            conn.executemany('''
+                INSERT INTO voice_times (guild_id, user_id, voice_time_spent_ms)
+                    VALUES (?1, ?2, ?3)
+                    ON CONFLICT (guild_id, user_id) DO UPDATE
+                        SET voice_time_spent_ms = voice_time_spent_ms + excluded.voice_time_spent_ms
+            ''', entries)
+            self._record(conn, 'voice_times', [None])  # Not cached, tells the commit was made by a backend
+
+        await self._run('add_voice_times', add_voice_times)
+
+    async def get_top_voice_times(self, guild_id: int, limit: int) -> typing.List[dict]:
+        # Served by voice_times_top_idx, only the top rows are read
+        return await self._run('get_top_voice_times', self._fetch, '''
+            SELECT user_id, voice_time_spent_ms FROM voice_times
+                WHERE guild_id = ?1 AND voice_time_spent_ms > 0
+                ORDER BY voice_time_spent_ms DESC
+                LIMIT ?2
+        ''', guild_id, limit)
+
+    async def migrate_voice_times(self) -> int:
+        # Existing voice_times rows are kept, so running this again is harmless
+        def migrate_voice_times(conn):
+            count = conn.execute('''
+                INSERT OR IGNORE INTO voice_times (guild_id, user_id, voice_time_spent_ms, voice_last_joined_ms)
+                    SELECT CAST(v.key AS INTEGER), u.id,
+                           COALESCE(json_extract(v.value, '$.voice_time_spent_ms'), 0),
+                           COALESCE(json_extract(v.value, '$.voice_last_joined_ms'), 0)
+                        FROM users u, json_each(u.voice) v
+                        WHERE v.type = 'object'
+            ''').rowcount
+            self._record(conn, 'voice_times', [None])
+            return count
+
+        return await self._run('migrate_voice_times', migrate_voice_times)
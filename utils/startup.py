@@ -0,0 +1,77 @@
+import contextlib
+import typing
+
+from time import perf_counter
+
+
+class StartupTimer:
+    """
+    Records how long each startup phase took and when things first happened, in seconds since the timer was created.
+    Phases can overlap, eg. connecting to the database while logging in.
+    """
+    def __init__(self):
+        self.start = perf_counter()
+        self.phases: typing.List[typing.Tuple[str, float, float]] = []  # (name, started, ended)
+        self.marks: typing.Dict[str, float] = {}  # name -> first time
+
+    def now(self) -> float:
+        return perf_counter() - self.start
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time the block as a phase, also when it raises"""
+        started = self.now()
+        try:
+            yield
+        finally:
+            self.phases.append((name, started, self.now()))
+
+    def mark(self, name: str) -> bool:
+        """Record the first time something happened, returns False if it already had"""
+        if name in self.marks:
+            return False
+
+        self.marks[name] = self.now()
+        return True
+
+    def report(self) -> typing.List[str]:
+        """Get a line per phase and mark, in the order they started"""
+        lines = [(started, f'{name}: {started:.2f}s - {ended:.2f}s ({(ended - started) * 1000:.0f}ms)')
+                 for name, started, ended in self.phases]
+        lines.extend((at, f'{name}: {at:.2f}s') for name, at in self.marks.items())
+
+        return [line for _, line in sorted(lines, key=lambda x: x[0])]
+
+
+def load_order(cogs: typing.Iterable[str], requires: typing.Callable[[str], typing.Iterable[str]]) \
+        -> typing.Tuple[typing.List[str], typing.Dict[str, typing.List[str]]]:
+    """
+    Order cogs so each one comes after the cogs it requires, otherwise keeping the given order.
+    Returns the order and the cogs left out because a cog they require is not in cogs, with what they miss.
+    Raises ValueError if cogs require each other.
+    """
+    cogs = list(cogs)
+    available = set(cogs)
+    deps = {c: set(requires(c)) for c in cogs}
+
+    # Leave out cogs missing a requirement, and the cogs requiring those
+    skipped: typing.Dict[str, typing.List[str]] = {}
+    changed = True
+    while changed:
+        changed = False
+        for cog in cogs:
+            if cog not in skipped and (missing := deps[cog] - (available - set(skipped))):
+                skipped[cog] = sorted(missing)
+                changed = True
+
+    order: typing.List[str] = []
+    pending = [c for c in cogs if c not in skipped]
+    while pending:
+        ready = next((c for c in pending if deps[c] <= set(order)), None)
+        if ready is None:
+            raise ValueError(f'Cogs require each other: {", ".join(pending)}')
+
+        order.append(ready)
+        pending.remove(ready)
+
+    return order, skipped
@@ -0,0 +1,50 @@
+import pytz
+import typing
+
+from datetime import datetime
+from time import time
+
+REFRESH_SECONDS = 900  # Offsets only change on transitions, which fall on a quarter hour
+
+
+class TimeFormatter:
+    """
+    Formats log timestamps for a timezone, the utc offset is only recomputed when it could have changed.
+    """
+    def __init__(self, timezone: str = 'UTC'):
+        self.tz = pytz.timezone(timezone)
+        self.offset = 0  # Seconds east of utc
+        self.label = 'UTC+0'
+        self._expires = 0.0  # Unix time the offset has to be recomputed at
+
+    def _refresh(self, now: float):
+        offset = int(datetime.fromtimestamp(now, self.tz).utcoffset().total_seconds())
+        sign = '-' if offset < 0 else '+'
+        h, m = divmod(abs(offset) // 60, 60)
+
+        self.offset = offset
+        self.label = f'UTC{sign}{h}:{m:02}' if m else f'UTC{sign}{h}'  # eg. UTC+2, UTC-3:30
+        self._expires = now - now % REFRESH_SECONDS + REFRESH_SECONDS
+
+    def format(self, now: typing.Optional[float] = None) -> str:
+        """Get the log timestamp prefix for a unix time, default now"""
+        if now is None:
+            now = time()
+
+        if now >= self._expires:
+            self._refresh(now)
+
+        m, s = divmod(int(now + self.offset) % 86400, 60)
+        h, m = divmod(m, 60)
+        return f'`[{h:02}:{m:02}:{s:02} {self.label}]`'
+
+
+_formatters: typing.Dict[str, TimeFormatter] = {}  # timezone -> formatter, shared by guilds
+
+
+def get_formatter(timezone: str) -> TimeFormatter:
+    """Get the shared formatter for a timezone"""
+    if (f := _formatters.get(timezone)) is None:
+        f = _formatters[timezone] = TimeFormatter(timezone)
+
+    return f
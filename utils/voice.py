@@ -0,0 +1,59 @@
+import asyncio
+import typing
+
+
+class VoiceTracker:
+    """
+    Keeps open voice sessions and unsaved voice time in memory, written to the database in batches by flush.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.sessions: typing.Dict[typing.Tuple[int, int], float] = {}  # (guild, member) -> voice_last_joined_ms
+        self.pending: typing.Dict[typing.Tuple[int, int], float] = {}  # (guild, member) -> unsaved time spent ms
+        self._lock = asyncio.Lock()
+
+    def join(self, guild_id: int, user_id: int, time_ms: float):
+        """Open a voice session, an already open session is kept"""
+        self.sessions.setdefault((guild_id, user_id), time_ms)
+
+    def leave(self, guild_id: int, user_id: int, time_ms: float):
+        """Close a voice session and add its length to the unsaved time"""
+        joined = self.sessions.pop((guild_id, user_id), None)
+        if joined is None:  # No open session, eg. joined before the bot started
+            return
+
+        key = (guild_id, user_id)
+        self.pending[key] = self.pending.get(key, 0) + max(time_ms - joined, 0)
+
+    def unsaved_time(self, guild_id: int, user_id: int, time_ms: float) -> float:
+        """Get the time spent by a user that is not in the database yet, including any open session"""
+        key = (guild_id, user_id)
+        spent = self.pending.get(key, 0)
+
+        if (joined := self.sessions.get(key)) is not None:
+            spent += max(time_ms - joined, 0)
+
+        return spent
+
+    async def flush(self, time_ms: typing.Optional[float] = None):
+        """
+        Write unsaved voice time to the database in one batch.
+        If time_ms is given, open sessions are also saved up to that time and continue from it.
+        """
+        async with self._lock:  # Only one flush writes at a time
+            if time_ms is not None:
+                for key, joined in self.sessions.items():
+                    self.pending[key] = self.pending.get(key, 0) + max(time_ms - joined, 0)
+                    self.sessions[key] = time_ms
+
+            if not self.pending:
+                return
+
+            batch, self.pending = self.pending, {}
+
+            try:
+                await self.db.add_voice_times([(g, u, ms) for (g, u), ms in batch.items()])
+            except Exception:
+                for key, ms in batch.items():  # Keep the time for the next flush
+                    self.pending[key] = self.pending.get(key, 0) + ms
+                raise
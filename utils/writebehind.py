@@ -0,0 +1,191 @@
+import asyncio
+import contextlib
+import logging
+import typing
+
+from time import perf_counter
+
+
+class WriteBuffer:
+    """
+    Merges row updates per (table, id) and writes them in batches, one transaction per flush.
+    """
+    def __init__(self, db, interval: float = 0.5, max_rows: int = 100, max_retries: int = 10,
+                 max_retry_delay: float = 60):
+        self.db = db
+        self.interval = interval  # Seconds updates wait before being written
+        self.max_rows = max_rows  # Buffered rows that trigger a flush before the interval
+        self.max_retries = max_retries  # Failed flushes in a row before the failing batch is dropped
+        self.max_retry_delay = max_retry_delay  # Seconds, failed flushes are retried after 2x the last delay
+        self.pending: typing.Dict[typing.Tuple[str, int], dict] = {}  # (table, id) -> {column: value}
+        self.flushing: typing.Dict[typing.Tuple[str, int], dict] = {}  # Being written, read until committed
+        self.generation = 0  # Flushes committed
+        self.committed: typing.Dict[int, dict] = {}  # generation -> batch, kept for reads started before it
+        self.readers: typing.Dict[int, int] = {}  # generation -> reads running that started in it
+        self.closed = False  # Failed flushes are not retried once closing
+        self._task: typing.Optional[asyncio.Task] = None
+        self._full = asyncio.Event()
+        self._closing = asyncio.Event()  # Cuts a retry's backoff short
+        self._lock = asyncio.Lock()
+
+        # Stats
+        self.updates = 0  # update calls buffered
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_batch = 0  # Rows written by the last flush
+        self.max_batch = 0
+        self.failures = 0  # Failed flushes in a row
+        self.rows_dropped = 0  # Rows of batches that failed max_retries times
+        self.last_latency_ms = 0.0
+        self.total_latency_ms = 0.0
+
+        self.logger = logging.getLogger('utils.writebehind')
+
+    def put(self, table: str, row_id: int, data: dict):
+        """Buffer an update of a row, merged with any update of the same row not written yet"""
+        self.db.backend.check_update(table, data)  # Reject unknown tables and columns before buffering
+        self.pending.setdefault((table, row_id), {}).update(data)
+        self.updates += 1
+        self._schedule()
+
+        if len(self.pending) >= self.max_rows:  # Don't wait for the interval
+            self._full.set()
+
+    def _schedule(self, delay: typing.Optional[float] = None):
+        if self._task is None:  # Start the flush timer
+            self._task = asyncio.create_task(self._flush_later(delay))
+
+    def get(self, table: str, row_id: int) -> typing.Optional[dict]:
+        """Get the buffered columns of a row, including ones being written, None if nothing is buffered"""
+        key = (table, row_id)
+        flushing, pending = self.flushing.get(key), self.pending.get(key)
+
+        if flushing is None or pending is None:
+            return pending if flushing is None else flushing
+
+        return {**flushing, **pending}  # Newer updates win
+
+    def overlay(self, table: str, row_id: int, row: typing.Optional[dict],
+                since: typing.Optional[int] = None) -> typing.Optional[dict]:
+        """
+        Apply buffered columns to a row read from the database.
+        since is the generation the read started in, see reading, batches committed after it are applied too.
+        """
+        if row is None:
+            return row
+
+        if since is not None:
+            for generation, batch in self.committed.items():
+                if generation > since and (data := batch.get((table, row_id))):
+                    row.update(data)
+
+        if data := self.get(table, row_id):
+            row.update(data)
+
+        return row
+
+    @contextlib.contextmanager
+    def reading(self):
+        """
+        Track a database read, yields the generation to pass to overlay.
+        A read started before a flush committed can return the old rows after it, so the batch is kept until then.
+        """
+        since = self.generation
+        self.readers[since] = self.readers.get(since, 0) + 1
+
+        try:
+            yield since
+        finally:
+            self.readers[since] -= 1
+            if not self.readers[since]:
+                del self.readers[since]
+
+            oldest = min(self.readers, default=self.generation)
+            for generation in [g for g in self.committed if g <= oldest]:  # No read needs them anymore
+                del self.committed[generation]
+
+    async def _flush_later(self, delay: typing.Optional[float] = None):
+        # A retry waits out its backoff even if the buffer fills up, only close cuts it short
+        event = self._full if delay is None else self._closing
+
+        try:
+            await asyncio.wait_for(event.wait(), self.interval if delay is None else delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._task = None
+            self._full.clear()
+
+        await self.flush()
+
+    async def flush(self):
+        """Write every buffered update now"""
+        async with self._lock:
+            if not self.pending:
+                return
+
+            # Reads see the batch until it is committed, a read missing the cache would get the old row otherwise
+            batch, self.pending = self.pending, {}
+            self.flushing = batch
+            start = perf_counter()
+
+            try:
+                await self.db.backend.update_many([(table, row_id, data) for (table, row_id), data in batch.items()])
+                self.generation += 1
+                self.failures = 0
+                if self.readers:  # Reads started before the commit still need it
+                    self.committed[self.generation] = batch
+            except Exception as e:
+                self.failures += 1
+                if self.failures > self.max_retries:  # Give up on the batch, newer updates are still written
+                    self.rows_dropped += len(batch)
+                    self.failures = 0
+                    self.logger.error(f'Dropped {len(batch)} buffered row updates after {self.max_retries + 1}'
+                                      f' failed writes: {e!r}')
+                else:
+                    for key, data in batch.items():  # Keep the updates, newer ones win
+                        self.pending[key] = {**data, **self.pending.get(key, {})}
+
+                    if self.failures == 1:
+                        self.logger.exception('Failed to write buffered updates', exc_info=e)
+                    else:
+                        self.logger.warning(f'Failed to write buffered updates {self.failures} times: {e!r}')
+
+                if not self.closed and self.pending:  # Retry with backoff
+                    self._schedule(min(self.interval * 2 ** self.failures, self.max_retry_delay))
+                return
+            finally:
+                self.flushing = {}
+
+            self.last_latency_ms = (perf_counter() - start) * 1000
+            self.total_latency_ms += self.last_latency_ms
+            self.flushes += 1
+            self.rows_written += len(batch)
+            self.last_batch = len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+
+    async def close(self):
+        """Write everything buffered, used on shutdown"""
+        self.closed = True
+        if (task := self._task) is not None:  # Let the timer flush now instead of cancelling it mid write
+            self._full.set()
+            self._closing.set()
+            await task
+
+        await self.flush()
+
+    def stats(self) -> dict:
+        """Get flush counts, batch sizes and latency"""
+        return {
+            'pending': len(self.pending),
+            'updates': self.updates,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'last_batch': self.last_batch,
+            'max_batch': self.max_batch,
+            'failures': self.failures,
+            'rows_dropped': self.rows_dropped,
+            'avg_batch': self.rows_written / self.flushes if self.flushes else 0,
+            'last_latency_ms': self.last_latency_ms,
+            'avg_latency_ms': self.total_latency_ms / self.flushes if self.flushes else 0
+        }